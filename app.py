@@ -20,14 +20,15 @@ from prompts import PROMPT_PLIEGOS
 
 from utils import (
     limpiar_respuesta_json, 
-    convertir_excel_a_texto_csv, apply_safety_margin_to_plan, 
-    analizar_docx_multimodal_con_gemini, # <-- ¡IMPORTACIÓN CLAVE AÑADIDA!
+    apply_safety_margin_to_plan, 
     get_lot_context, 
     OPCION_ANALISIS_GENERAL
 )
 
 
-from drive_utils import find_or_create_folder, get_files_in_project, download_file_from_drive_cached
+from gemini_governor import gemini_governor
+from pliegos_digest import pliegos_prompt_parts
+from drive_utils import find_or_create_folder, get_files_in_project, load_project_tree_index
 
 # =============================================================================
 #           CONFIGURACIÓN GLOBAL Y GESTIÓN DE ESTADO
@@ -81,13 +82,14 @@ def back_to_project_selection_and_cleanup():
 #           LÓGICA CENTRAL DE LA APLICACIÓN (NO-UI)
 # =============================================================================
 
-def handle_full_regeneration(model):
+def handle_full_regeneration(model, force_regenerate=False):
     """
     Función que genera un índice desde cero analizando los archivos de 'Pliegos',
     ahora con capacidad para procesar .docx con texto e imágenes.
     
     VERSIÓN MODIFICADA: Aplica un margen de seguridad al plan de extensión
     para evitar exceder el límite de páginas en la redacción final.
+    Con force_regenerate=True no se reutiliza la respuesta cacheada de Gemini.
     """
     if not st.session_state.get('drive_service') or not st.session_state.get('selected_project'):
         st.error("Error de sesión. No se puede iniciar la regeneración."); return False
@@ -108,29 +110,10 @@ def handle_full_regeneration(model):
             contexto_lote = get_lot_context()
             prompt_con_idioma = PROMPT_PLIEGOS.format(idioma=idioma_seleccionado, contexto_lote=contexto_lote)
             
-            contenido_ia = [prompt_con_idioma]
+            # Los pliegos llegan ya procesados desde su digest (solo se recalculan los que han cambiado).
+            contenido_ia = [prompt_con_idioma] + pliegos_prompt_parts(service, get_credentials(), project_folder_id)
 
-            # --- Lógica de análisis de archivos (sin cambios) ---
-            for file in document_files:
-                file_content_bytes = download_file_from_drive_cached(service, file['id'])
-                nombre_archivo = file['name']
-                mime_type = file['mimeType']
-                
-                if nombre_archivo.lower().endswith('.xlsx'):
-                    texto_csv = convertir_excel_a_texto_csv(file_content_bytes, nombre_archivo)
-                    if texto_csv:
-                        contenido_ia.append(texto_csv)
-
-                elif 'wordprocessingml' in mime_type:
-                    with st.spinner(f"Analizando '{nombre_archivo}' (texto e imágenes)..."):
-                        analisis_multimodal = analizar_docx_multimodal_con_gemini(file_content_bytes, nombre_archivo)
-                        if analisis_multimodal and "Error" not in analisis_multimodal:
-                            contenido_ia.append(analisis_multimodal)
-                else:
-                    contenido_ia.append({"mime_type": mime_type, "data": file_content_bytes.getvalue()})
-            # --- Fin de la lógica de análisis ---
-
-            response = model.generate_content(contenido_ia, generation_config={"response_mime_type": "application/json"})
+            response = gemini_governor.generate_content(model, contenido_ia, force_regenerate=force_regenerate, generation_config={"response_mime_type": "application/json"})
             
             if not response or not response.candidates:
                 st.error("La IA no generó una respuesta. Esto puede deberse a filtros de seguridad o un problema temporal.")
@@ -206,6 +189,11 @@ else:
         go_to_project_selection()
         st.rerun()
 
+    # Índice del árbol del proyecto: las búsquedas de las fases se responden
+    # desde memoria en lugar de hacer una llamada a Drive por carpeta.
+    if st.session_state.get('selected_project'):
+        load_project_tree_index(st.session_state.drive_service, st.session_state.selected_project['id'])
+
     # Barra lateral (sin cambios)
     if st.session_state.get('selected_project') and st.session_state.page != 'project_selection':
         with st.sidebar:
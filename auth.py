@@ -1,9 +1,16 @@
 import streamlit as st
+import json
+import threading
+import weakref
+import httplib2
+import google_auth_httplib2
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import Flow
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build, build_from_document
 from googleapiclient.errors import HttpError
 from google.auth.transport.requests import Request
+from storage import get_local_backend, local_storage_enabled
+from quota import credentials_key
 
 SCOPES = [
     'https://www.googleapis.com/auth/drive',
@@ -12,6 +19,11 @@ SCOPES = [
     'openid',
 ]
 
+# Timeout (segundos) de las conexiones HTTP persistentes hacia la API de Drive.
+DRIVE_HTTP_TIMEOUT = 120
+# Servicios de Drive libres que se conservan por usuario para reutilizarlos.
+DRIVE_SERVICE_POOL_SIZE = 16
+
 CLIENT_CONFIG = {
     "web": {
         "client_id": st.secrets["GOOGLE_CLIENT_ID"],
@@ -33,7 +45,11 @@ def get_google_flow():
 def get_credentials():
     """
     Gestiona el flujo de autenticación de forma robusta para Streamlit.
+    Con el backend de almacenamiento local no hay inicio de sesión con Google.
     """
+    if local_storage_enabled():
+        return Credentials(token='local')
+
     if 'credentials_info' in st.session_state:
         creds_info = st.session_state['credentials_info']
         creds = Credentials.from_authorized_user_info(creds_info, SCOPES)
@@ -91,17 +107,98 @@ def get_credentials():
             
     return None
 
+# =============================================================================
+#           CONSTRUCCIÓN Y REUTILIZACIÓN DE SERVICIOS DE DRIVE
+# =============================================================================
+# El documento de descubrimiento de la API se parsea una sola vez por proceso.
+# Cada servicio lleva su propio httplib2.Http, que mantiene abiertas las
+# conexiones (keep-alive), así que reutilizar el servicio ahorra el
+# handshake TLS. httplib2 no es seguro entre hilos: un servicio solo lo usa
+# un hilo a la vez. Cuando el hilo termina, el servicio vuelve al pool.
+
+_drive_discovery_lock = threading.Lock()
+_drive_discovery_doc = None
+
+_drive_pool_lock = threading.Lock()
+_drive_service_pool = {}  # clave de credenciales -> [servicios libres]
+_thread_drive_services = threading.local()
+
+class _ThreadDriveService:
+    """Contenedor del servicio asignado a un hilo. Al liberarse devuelve el servicio al pool."""
+    __slots__ = ('service', '__weakref__')
+
+def _get_drive_discovery_document(credentials):
+    """Devuelve el documento de descubrimiento de Drive v3 ya parseado (compartido por todo el proceso)."""
+    global _drive_discovery_doc
+    with _drive_discovery_lock:
+        if _drive_discovery_doc is None:
+            try:
+                from googleapiclient import discovery_cache
+                static_doc = discovery_cache.get_static_doc('drive', 'v3')
+            except Exception:
+                static_doc = None
+            if static_doc:
+                _drive_discovery_doc = json.loads(static_doc)
+            else:
+                _drive_discovery_doc = build('drive', 'v3', credentials=credentials)._rootDesc
+        return _drive_discovery_doc
+
+def _new_drive_service(credentials):
+    """Construye un servicio de Drive con el documento compartido y una conexión persistente propia."""
+    discovery_doc = _get_drive_discovery_document(credentials)
+    http = google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http(timeout=DRIVE_HTTP_TIMEOUT))
+    # build_from_document completa el documento in situ, así que no puede ejecutarse en paralelo.
+    with _drive_discovery_lock:
+        return build_from_document(discovery_doc, http=http)
+
+def _return_drive_service(key, service):
+    """Devuelve un servicio al pool (o lo descarta si el pool está lleno)."""
+    with _drive_pool_lock:
+        free_services = _drive_service_pool.setdefault(key, [])
+        if len(free_services) < DRIVE_SERVICE_POOL_SIZE:
+            free_services.append(service)
+
+def get_thread_drive_service(credentials):
+    """
+    Devuelve el servicio de Drive asignado al hilo actual para estas credenciales.
+    La primera llamada de cada hilo lo toma del pool (o lo construye si no hay
+    ninguno libre); las siguientes lo reutilizan sin coste.
+    Con el backend local devuelve el backend del proceso, que es seguro entre hilos.
+    """
+    if local_storage_enabled():
+        return get_local_backend()
+    key = credentials_key(credentials)
+    holders = getattr(_thread_drive_services, 'holders', None)
+    if holders is None:
+        holders = _thread_drive_services.holders = {}
+    holder = holders.get(key)
+    if holder is None:
+        with _drive_pool_lock:
+            free_services = _drive_service_pool.get(key)
+            service = free_services.pop() if free_services else None
+        if service is None:
+            service = _new_drive_service(credentials)
+        holder = _ThreadDriveService()
+        holder.service = service
+        # Cuando el hilo termina, su threading.local se libera y el servicio vuelve al pool.
+        weakref.finalize(holder, _return_drive_service, key, service)
+        holders[key] = holder
+    return holder.service
+
 # OPTIMIZACIÓN APLICADA AQUÍ
 @st.cache_resource
 def build_drive_service(_credentials):
     """
     Construye y devuelve el objeto de servicio de la API de Drive.
     Gracias a @st.cache_resource, este objeto se crea una vez y se reutiliza.
+    Con el backend local devuelve el backend del proceso.
     """
+    if local_storage_enabled():
+        return get_local_backend()
     try:
         # El argumento se llama '_credentials' para que el decorador de caché lo ignore.
         # Usamos ese argumento para construir el servicio.
-        return build('drive', 'v3', credentials=_credentials)
+        return _new_drive_service(_credentials)
     except HttpError as error:
         st.error(f"No se pudo crear el servicio de Drive: {error}")
         return None
@@ -0,0 +1,214 @@
+import io
+import asyncio
+import aiohttp
+import httplib2
+from googleapiclient.errors import HttpError
+from google.auth.transport.requests import Request
+
+from storage import DOWNLOAD_CHUNK_SIZE, local_storage_enabled
+from quota import DRIVE_RETRY_POLICY, credentials_key, drive_rate_limiters, is_retryable_drive_error
+from drive_utils import (
+    LIST_DEFAULT_FIELDS, LIST_PAGE_SIZE, TREE_INDEX_FIELDS,
+    _disk_cache_open, _disk_cache_writer, prefetch_files_from_drive
+)
+
+DRIVE_API_URL = "https://www.googleapis.com/drive/v3"
+DRIVE_UPLOAD_URL = "https://www.googleapis.com/upload/drive/v3"
+
+# Peticiones simultáneas máximas hacia Drive (y conexiones abiertas en el pool).
+DRIVE_ASYNC_MAX_CONCURRENCY = 64
+# Timeout total (segundos) de cada petición HTTP.
+DRIVE_ASYNC_TIMEOUT = 120
+
+# =============================================================================
+#           CLIENTE ASÍNCRONO DE DRIVE
+# =============================================================================
+# Cliente asyncio sobre la API REST de Drive v3. Un semáforo limita las
+# peticiones en vuelo y la sesión de aiohttp mantiene abiertas las
+# conexiones, así que cientos de corrutinas comparten el mismo pool.
+# Los errores se lanzan como googleapiclient.errors.HttpError para que el
+# resto de la aplicación los trate igual que los del cliente síncrono.
+
+async def _http_error(response):
+    """Convierte una respuesta de error de aiohttp en un HttpError de googleapiclient."""
+    content = await response.read()
+    resp = httplib2.Response({'status': response.status, 'retry-after': response.headers.get('Retry-After', '')})
+    return HttpError(resp, content, uri=str(response.url))
+
+class AsyncDriveClient:
+    """
+    Cliente asíncrono de Drive. Debe usarse como gestor de contexto:
+
+        async with AsyncDriveClient(credentials) as client:
+            contenido = await client.get_media(file_id)
+    """
+
+    def __init__(self, credentials, max_concurrency=DRIVE_ASYNC_MAX_CONCURRENCY):
+        self.credentials = credentials
+        self.max_concurrency = max_concurrency
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._token_lock = asyncio.Lock()
+        self._rate_limiters = drive_rate_limiters(credentials_key(credentials))
+        self._session = None
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency)
+        timeout = aiohttp.ClientTimeout(total=DRIVE_ASYNC_TIMEOUT)
+        self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._session.close()
+
+    async def _auth_header(self, force_refresh=False):
+        """Devuelve la cabecera Authorization, refrescando el token si ha caducado."""
+        async with self._token_lock:
+            if force_refresh or not self.credentials.valid:
+                await asyncio.to_thread(self.credentials.refresh, Request())
+            return {'Authorization': f"Bearer {self.credentials.token}"}
+
+    async def _throttle(self):
+        """Espera lo que marquen los limitadores de tasa compartidos con el cliente síncrono."""
+        wait = max(limiter.reserve() for limiter in self._rate_limiters)
+        if wait:
+            await asyncio.sleep(wait)
+
+    async def _request(self, method, url, params=None, data=None, json_body=None, headers=None, expect='json', retries=3):
+        """
+        Ejecuta una petición con reintentos. 'expect' puede ser 'json', 'bytes', None o un
+        archivo abierto, en cuyo caso el cuerpo se escribe en él por trozos.
+        """
+        refreshed = False
+        error = None
+        for attempt in range(retries):
+            await self._throttle()
+            try:
+                async with self._semaphore:
+                    request_headers = dict(headers or {})
+                    request_headers.update(await self._auth_header())
+                    async with self._session.request(method, url, params=params, data=data, json=json_body, headers=request_headers) as response:
+                        if response.status >= 400:
+                            error = await _http_error(response)
+                            if response.status == 401 and not refreshed:
+                                refreshed = True
+                                await self._auth_header(force_refresh=True)
+                                continue
+                            if is_retryable_drive_error(error) and attempt < retries - 1:
+                                await asyncio.sleep(DRIVE_RETRY_POLICY.delay(attempt, error))
+                                continue
+                            raise error
+                        if expect == 'json':
+                            return await response.json()
+                        if expect == 'bytes':
+                            return await response.read()
+                        if expect is not None:
+                            expect.seek(0)
+                            expect.truncate()
+                            async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                                expect.write(chunk)
+                        return None
+            except (asyncio.TimeoutError, aiohttp.ClientConnectionError):
+                if attempt < retries - 1:
+                    await asyncio.sleep(DRIVE_RETRY_POLICY.delay(attempt))
+                else: raise
+        # Solo se llega aquí si el último intento fue un 401 que obligó a refrescar el token.
+        raise error
+
+    async def iter_files(self, query, fields=LIST_DEFAULT_FIELDS):
+        """Generador asíncrono que recorre todas las páginas de una consulta files.list."""
+        page_token = None
+        while True:
+            params = {'q': query, 'spaces': 'drive', 'pageSize': LIST_PAGE_SIZE, 'fields': f'nextPageToken, files({fields})'}
+            if page_token:
+                params['pageToken'] = page_token
+            response = await self._request('GET', f"{DRIVE_API_URL}/files", params=params)
+            for file in response.get('files', []):
+                yield file
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                return
+
+    async def list_files(self, query, fields=LIST_DEFAULT_FIELDS):
+        """Devuelve todos los resultados de una consulta files.list."""
+        return [file async for file in self.iter_files(query, fields)]
+
+    async def get_metadata(self, file_id, fields=TREE_INDEX_FIELDS):
+        """Devuelve los metadatos de un archivo."""
+        return await self._request('GET', f"{DRIVE_API_URL}/files/{file_id}", params={'fields': fields})
+
+    async def get_media(self, file_id):
+        """Descarga el contenido de un archivo."""
+        return await self._request('GET', f"{DRIVE_API_URL}/files/{file_id}", params={'alt': 'media'}, expect='bytes')
+
+    async def get_media_to(self, file_id, fh):
+        """Descarga el contenido de un archivo escribiéndolo por trozos en 'fh'."""
+        await self._request('GET', f"{DRIVE_API_URL}/files/{file_id}", params={'alt': 'media'}, expect=fh)
+
+    async def create(self, metadata, content=None, mime_type=None, fields=TREE_INDEX_FIELDS):
+        """Crea un archivo (subida multipart) o, si no hay contenido, una carpeta/archivo vacío."""
+        if content is None:
+            return await self._request('POST', f"{DRIVE_API_URL}/files", params={'fields': fields}, json_body=metadata)
+        with aiohttp.MultipartWriter('related') as writer:
+            writer.append_json(metadata)
+            writer.append(content, {'Content-Type': mime_type or 'application/octet-stream'})
+        return await self._request('POST', f"{DRIVE_UPLOAD_URL}/files", params={'uploadType': 'multipart', 'fields': fields}, data=writer)
+
+    async def update(self, file_id, content, mime_type=None, fields=TREE_INDEX_FIELDS):
+        """Sustituye el contenido de un archivo existente conservando su id."""
+        headers = {'Content-Type': mime_type or 'application/octet-stream'}
+        return await self._request('PATCH', f"{DRIVE_UPLOAD_URL}/files/{file_id}", params={'uploadType': 'media', 'fields': fields}, data=content, headers=headers)
+
+    async def delete(self, file_id):
+        """Elimina un archivo o carpeta."""
+        await self._request('DELETE', f"{DRIVE_API_URL}/files/{file_id}", expect=None)
+
+# =============================================================================
+#           OPERACIONES EN BLOQUE
+# =============================================================================
+# Las descargas pasan por la caché en disco de drive_utils igual que sus
+# equivalentes síncronas.
+
+def run_async(coro):
+    """Ejecuta una corrutina desde código síncrono (el script de Streamlit o un hilo de trabajo)."""
+    return asyncio.run(coro)
+
+async def _download_cached(client, file_id):
+    """
+    Descarga un archivo pasando por la caché en disco de drive_utils. El cuerpo se
+    escribe por trozos en la caché y se devuelve como DriveFileView (mmap de solo lectura).
+    """
+    # Como en drive_utils, la versión se pide siempre con las credenciales del llamante
+    # (comprobación de acceso) y no se toma del índice compartido.
+    file_meta = await client.get_metadata(file_id, fields='md5Checksum, modifiedTime')
+    revision = file_meta.get('md5Checksum') or file_meta.get('modifiedTime')
+    if not revision:
+        return io.BytesIO(await client.get_media(file_id))
+
+    view = await asyncio.to_thread(_disk_cache_open, file_id, revision)
+    if view is None:
+        # Abrir y publicar el archivo de la caché (mkstemp, os.replace y la expulsión
+        # del LRU) toca el disco, así que se hace fuera del bucle de eventos.
+        writer = _disk_cache_writer(file_id, revision)
+        fh = await asyncio.to_thread(writer.__enter__)
+        try:
+            await client.get_media_to(file_id, fh)
+        except BaseException as e:
+            await asyncio.to_thread(writer.__exit__, type(e), e, e.__traceback__)
+            raise
+        await asyncio.to_thread(writer.__exit__, None, None, None)
+        view = await asyncio.to_thread(_disk_cache_open, file_id, revision)
+    return view if view is not None else io.BytesIO(await client.get_media(file_id))
+
+async def download_many_async(credentials, file_ids, max_concurrency=DRIVE_ASYNC_MAX_CONCURRENCY):
+    """Descarga todos los archivos a la vez. Devuelve sus contenidos (DriveFileView) en el mismo orden."""
+    async with AsyncDriveClient(credentials, max_concurrency) as client:
+        return await asyncio.gather(*(_download_cached(client, file_id) for file_id in file_ids))
+
+def download_many(credentials, file_ids, max_concurrency=DRIVE_ASYNC_MAX_CONCURRENCY):
+    """Versión síncrona de download_many_async."""
+    if not file_ids:
+        return []
+    # El cliente asíncrono habla con la API REST de Drive; con el backend local se usan hilos.
+    if local_storage_enabled():
+        return prefetch_files_from_drive(credentials, [{'id': file_id} for file_id in file_ids])
+    return run_async(download_many_async(credentials, file_ids, max_concurrency))
@@ -1,184 +1,859 @@
 import io
+import os
+import mmap
 import re
 import time
+import hashlib
+import tempfile
+import threading
+import contextlib
+import collections
+import concurrent.futures
 import streamlit as st
 import httplib2
 import docx
+from auth import get_thread_drive_service, get_credentials
+from storage import FOLDER_MIME_TYPE, get_storage_backend
+from quota import DRIVE_RETRY_POLICY, is_retryable_drive_error, credentials_key
 from googleapiclient.errors import HttpError
-from googleapiclient.http import MediaIoBaseUpload, MediaIoBaseDownload
 
 ROOT_FOLDER_NAME = "ProyectosLicitaciones"
 
+# Campos que guardamos de cada archivo/carpeta en el índice del proyecto.
+TREE_INDEX_FIELDS = 'id, name, mimeType, parents, md5Checksum, modifiedTime'
+# Proyección mínima por defecto para los listados paginados.
+LIST_DEFAULT_FIELDS = 'id, name, mimeType'
+# Máximo de resultados por página que admite files.list.
+LIST_PAGE_SIZE = 1000
+# Máximo de operaciones que admite el endpoint batch de Drive por petición HTTP.
+DRIVE_BATCH_MAX_REQUESTS = 100
+# Descargas simultáneas al precargar los pliegos de una carpeta.
+PREFETCH_MAX_WORKERS = 8
+# Caché persistente de descargas, compartida por todas las sesiones del servidor.
+DRIVE_DISK_CACHE_DIR = os.environ.get("IRVE_DRIVE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "irve_drive_cache"))
+DRIVE_DISK_CACHE_MAX_BYTES = int(os.environ.get("IRVE_DRIVE_CACHE_MAX_BYTES", 2 * 1024 ** 3))
+# Segundos mínimos entre dos consultas al feed de cambios de Drive para un mismo proyecto.
+TREE_INDEX_SYNC_INTERVAL = 5
+# Campos que se piden al feed de cambios (files.list no devuelve 'trashed' pero aquí hace falta).
+CHANGES_FIELDS = f'nextPageToken, newStartPageToken, changes(fileId, removed, file({TREE_INDEX_FIELDS}, trashed))'
+# Número de carpetas padre que se agrupan en una sola consulta de files.list.
+TREE_INDEX_PARENTS_PER_QUERY = 40
+# Guiones cuyo texto extraído se conserva en memoria (clave: archivo + versión).
+GUION_TEXT_CACHE_MAX_ENTRIES = 2000
+
+# =============================================================================
+#           ÍNDICE EN MEMORIA DEL ÁRBOL DE CARPETAS DEL PROYECTO
+# =============================================================================
+# Un único índice por proceso, compartido entre sesiones e hilos de trabajo.
+# Solo se registran en '_tree_children' las carpetas cuyo contenido completo
+# conocemos, de modo que una carpeta indexada puede responder "no existe"
+# sin preguntar a Drive. Las escrituras de este módulo lo actualizan in situ.
+# El feed de cambios de Drive es de cada usuario, así que su token y el
+# cerrojo que serializa su consumo van por (usuario, proyecto).
+
+_tree_lock = threading.RLock()
+_tree_nodes = {}      # file_id -> metadatos (TREE_INDEX_FIELDS)
+_tree_children = {}   # folder_id -> {nombre: [file_id, ...]}
+_tree_projects = {}   # (usuario, project_folder_id) -> {'page_token': token del feed de cambios, 'synced_at': time.time()}
+_tree_sync_locks = {}  # (usuario, project_folder_id) -> Lock que serializa el consumo de ese feed
+
+def _tree_sync_lock(feed_key):
+    """Devuelve el cerrojo del feed de cambios de un usuario para un proyecto."""
+    with _tree_lock:
+        return _tree_sync_locks.setdefault(feed_key, threading.Lock())
+
+def _tree_forget_project(project_folder_id):
+    """Descarta el índice de un proyecto y el estado del feed de todos sus usuarios."""
+    with _tree_lock:
+        for feed_key in [key for key in _tree_projects if key[1] == project_folder_id]:
+            del _tree_projects[feed_key]
+        _index_remove_subtree(project_folder_id)
+
+def _index_add_node(file_meta, is_new=False):
+    """Añade (o actualiza) un archivo en el índice. Una carpeta recién creada se marca como indexada y vacía."""
+    file_id = file_meta.get('id')
+    if not file_id:
+        return
+    with _tree_lock:
+        previous = _tree_nodes.get(file_id)
+        if previous:
+            _index_unlink(previous)
+        _tree_nodes[file_id] = dict(file_meta)
+        for parent_id in file_meta.get('parents', []):
+            names = _tree_children.get(parent_id)
+            if names is None:
+                continue
+            ids = names.setdefault(file_meta.get('name'), [])
+            if file_id not in ids:
+                ids.append(file_id)
+        if is_new and file_meta.get('mimeType') == FOLDER_MIME_TYPE:
+            _tree_children.setdefault(file_id, {})
+
+def _index_remove_node(file_id):
+    """Elimina un archivo del índice. Si es una carpeta, elimina también todo su contenido."""
+    with _tree_lock:
+        file_meta = _tree_nodes.pop(file_id, None)
+        for names in _tree_children.pop(file_id, {}).values():
+            for child_id in names:
+                _index_remove_node(child_id)
+        if file_meta:
+            _index_unlink(file_meta)
+
+def _index_unlink(file_meta):
+    """Quita un archivo de los listados de sus carpetas padre."""
+    for parent_id in file_meta.get('parents', []):
+        names = _tree_children.get(parent_id, {})
+        ids = names.get(file_meta.get('name'))
+        if ids and file_meta['id'] in ids:
+            ids.remove(file_meta['id'])
+            if not ids:
+                del names[file_meta.get('name')]
+
+def _index_remove_subtree(folder_id):
+    """Olvida el contenido indexado de una carpeta (pero no la carpeta en sí)."""
+    with _tree_lock:
+        for names in _tree_children.pop(folder_id, {}).values():
+            for child_id in names:
+                _index_remove_node(child_id)
+
+def _index_list_children(folder_id):
+    """Devuelve copias de los metadatos del contenido de una carpeta, o None si no está indexada."""
+    with _tree_lock:
+        names = _tree_children.get(folder_id)
+        if names is None:
+            return None
+        return [dict(_tree_nodes[fid]) for ids in names.values() for fid in ids if fid in _tree_nodes]
+
+def _index_find_by_name(folder_id, name, mime_type=None):
+    """Busca por nombre dentro de una carpeta indexada. Devuelve None si la carpeta no está indexada."""
+    with _tree_lock:
+        names = _tree_children.get(folder_id)
+        if names is None:
+            return None
+        found = [dict(_tree_nodes[fid]) for fid in names.get(name, []) if fid in _tree_nodes]
+    if mime_type:
+        found = [f for f in found if f.get('mimeType') == mime_type]
+    return found
+
+def get_indexed_file_metadata(file_id):
+    """Devuelve los metadatos indexados de un archivo (md5Checksum, modifiedTime...) o None."""
+    with _tree_lock:
+        file_meta = _tree_nodes.get(file_id)
+        return dict(file_meta) if file_meta else None
+
+def _walk_folders(service, folder_ids, retries=3):
+    """
+    Recorre por niveles el contenido de las carpetas indicadas. Cada nivel se resuelve
+    con una consulta files.list por cada grupo de carpetas padre, en lugar de una
+    consulta por carpeta. Devuelve (nodos, hijos) listos para volcar en el índice.
+    """
+    nodes = {}
+    children = {folder_id: {} for folder_id in folder_ids}
+    frontier = list(folder_ids)
+
+    while frontier:
+        next_frontier = []
+        for i in range(0, len(frontier), TREE_INDEX_PARENTS_PER_QUERY):
+            group = frontier[i:i + TREE_INDEX_PARENTS_PER_QUERY]
+            for file in _iter_query(service, {'parent_ids': group}, TREE_INDEX_FIELDS, retries):
+                nodes[file['id']] = file
+                for parent_id in file.get('parents', []):
+                    if parent_id in children:
+                        children[parent_id].setdefault(file['name'], []).append(file['id'])
+                if file.get('mimeType') == FOLDER_MIME_TYPE and file['id'] not in children:
+                    children[file['id']] = {}
+                    next_frontier.append(file['id'])
+        frontier = next_frontier
+    return nodes, children
+
+def build_project_tree_index(service, project_folder_id, retries=3):
+    """
+    Construye el índice completo de la carpeta de un proyecto y guarda el token de
+    inicio del feed de cambios. El token se pide antes de listar para que ningún
+    cambio ocurrido durante el recorrido se pierda (como mucho se aplica dos veces).
+    """
+    page_token = get_storage_backend(service).get_start_page_token()
+    nodes, children = _walk_folders(service, [project_folder_id], retries)
+
+    with _tree_lock:
+        _index_remove_subtree(project_folder_id)
+        _tree_nodes.update(nodes)
+        _tree_children.update(children)
+        _tree_projects[(service_user_key(service), project_folder_id)] = {'page_token': page_token, 'synced_at': time.time()}
+
+def _apply_drive_change(service, change, retries=3):
+    """
+    Aplica un cambio del feed de Drive al índice y a las cachés acotadas.
+    Solo interesan los archivos que ya están indexados o cuyo nuevo padre es una
+    carpeta indexada; el resto del Drive del usuario se ignora.
+    """
+    file_id = change.get('fileId')
+    file_meta = change.get('file') or {}
+    previous = get_indexed_file_metadata(file_id)
+    with _tree_lock:
+        in_project = any(parent_id in _tree_children for parent_id in file_meta.get('parents', []))
+    gone = change.get('removed') or file_meta.get('trashed') or not in_project
+
+    if previous is None and gone:
+        return
+    if previous is not None:
+        invalidate_file_cache(file_id)
+        for parent_id in previous.get('parents', []):
+            invalidate_folder_cache(parent_id)
+    if gone:
+        _index_remove_node(file_id)
+        return
+
+    file_meta = {key: value for key, value in file_meta.items() if key != 'trashed'}
+    _index_add_node(file_meta)
+    for parent_id in file_meta.get('parents', []):
+        invalidate_folder_cache(parent_id)
+    # Una carpeta que aparece en el proyecto (creada fuera o movida desde otro sitio)
+    # puede traer contenido: se recorre solo esa rama.
+    if file_meta.get('mimeType') == FOLDER_MIME_TYPE and previous is None:
+        nodes, children = _walk_folders(service, [file_id], retries)
+        with _tree_lock:
+            _tree_nodes.update(nodes)
+            _tree_children.update(children)
+
+def sync_project_tree_index(service, project_folder_id, retries=3):
+    """
+    Aplica al índice los cambios ocurridos en Drive desde la última sincronización.
+    Si no hay nada nuevo cuesta una sola llamada, sea cual sea el tamaño del proyecto.
+    Devuelve el número de cambios leídos del feed.
+    """
+    feed_key = (service_user_key(service), project_folder_id)
+    with _tree_lock:
+        state = _tree_projects.get(feed_key)
+        page_token = state['page_token'] if state else None
+    if not page_token:
+        build_project_tree_index(service, project_folder_id, retries)
+        return 0
+
+    applied = 0
+    while True:
+        response = get_storage_backend(service).list_changes(page_token, LIST_PAGE_SIZE, CHANGES_FIELDS)
+        for change in response.get('changes', []):
+            _apply_drive_change(service, change, retries)
+            applied += 1
+        page_token = response.get('nextPageToken') or response.get('newStartPageToken')
+        if not response.get('nextPageToken'):
+            break
+
+    with _tree_lock:
+        _tree_projects[feed_key] = {'page_token': page_token, 'synced_at': time.time()}
+    return applied
+
+def load_project_tree_index(service, project_folder_id, min_interval=TREE_INDEX_SYNC_INTERVAL):
+    """
+    Garantiza que el índice del proyecto está al día. Se llama en cada render: la
+    primera vez construye el índice completo y después solo consume el feed de
+    cambios de Drive, como mucho una vez cada 'min_interval' segundos.
+    Si algo falla, el índice del proyecto se descarta y las funciones de búsqueda
+    vuelven a consultar a Drive hasta la siguiente reconstrucción.
+    """
+    if not project_folder_id:
+        return
+    feed_key = (service_user_key(service), project_folder_id)
+    with _tree_lock:
+        state = _tree_projects.get(feed_key)
+    if state is not None and time.time() - state['synced_at'] < min_interval:
+        return
+    # Si otra sesión del mismo usuario ya está sincronizando este proyecto, se usa
+    # el índice tal como está. Otros proyectos u otros usuarios no esperan.
+    sync_lock = _tree_sync_lock(feed_key)
+    if not sync_lock.acquire(blocking=False):
+        return
+    try:
+        sync_project_tree_index(service, project_folder_id)
+    except Exception as e:
+        print(f"AVISO: No se pudo sincronizar el índice del proyecto {project_folder_id}: {e}")
+        # El índice es compartido: sin él, el token de los demás usuarios ya no vale.
+        _tree_forget_project(project_folder_id)
+    finally:
+        sync_lock.release()
+
+# =============================================================================
+#           INVALIDACIÓN ACOTADA DE LA CACHÉ
+# =============================================================================
+# En lugar de vaciar todo st.cache_data en cada escritura (lo que obligaba a
+# todos los usuarios a volver a descargar los pliegos), cada carpeta y cada
+# archivo tiene un número de generación. Las funciones cacheadas lo reciben
+# como argumento, así que incrementarlo solo deja obsoletas las entradas de
+# esa carpeta o archivo.
+
+# Máximo de entradas que conserva cada listado cacheado (las generaciones
+# antiguas se descartan por antigüedad).
+LIST_CACHE_MAX_ENTRIES = 1000
+
+_cache_generations_lock = threading.Lock()
+_cache_generations = {}  # folder_id / file_id -> int
+
+def _cache_generation(key):
+    """Devuelve la generación actual de una carpeta o archivo."""
+    with _cache_generations_lock:
+        return _cache_generations.get(key, 0)
+
+def invalidate_folder_cache(folder_id):
+    """Invalida los listados y búsquedas cacheados de una carpeta."""
+    with _cache_generations_lock:
+        _cache_generations[folder_id] = _cache_generations.get(folder_id, 0) + 1
+
+def invalidate_file_cache(file_id):
+    """Invalida las descargas cacheadas de un archivo."""
+    invalidate_folder_cache(file_id)
+
+# =============================================================================
+#           CACHÉ DE DESCARGAS EN DISCO
+# =============================================================================
+# Cada archivo se guarda bajo una clave que combina su file_id con su
+# md5Checksum (o modifiedTime si Drive no da checksum), de modo que una
+# nueva versión del archivo nunca devuelve el contenido antiguo. Las
+# escrituras son atómicas (archivo temporal + os.replace) y el tamaño total
+# se limita expulsando primero los archivos usados hace más tiempo.
+# La caché la comparten todas las sesiones, así que antes de servir un archivo
+# se pide su versión a Drive con las credenciales de quien lo solicita: si ese
+# usuario no tiene acceso, files.get falla y nunca llega a leer la caché.
+
+_disk_cache_guard = threading.Lock()
+_disk_cache_file_locks = {}  # file_id -> [Lock, hilos que lo usan]; se borra al quedar libre
+
+@contextlib.contextmanager
+def _disk_cache_lock(file_id):
+    """Cerrojo de un archivo: evita descargarlo dos veces a la vez sin acumular un cerrojo por archivo."""
+    with _disk_cache_guard:
+        entry = _disk_cache_file_locks.setdefault(file_id, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _disk_cache_guard:
+            entry[1] -= 1
+            if not entry[1]:
+                del _disk_cache_file_locks[file_id]
+
+def _disk_cache_path(file_id, revision):
+    """Ruta del archivo de caché para una versión concreta de un archivo de Drive."""
+    key = hashlib.sha256(f"{file_id}:{revision}".encode('utf-8')).hexdigest()
+    return os.path.join(DRIVE_DISK_CACHE_DIR, key + ".bin")
+
+class DriveFileView(io.BufferedIOBase):
+    """
+    Archivo de solo lectura sobre un mmap de la caché en disco. Se usa igual que un
+    BytesIO (read, seek, getvalue), pero las páginas las comparte el sistema operativo
+    entre todos los hilos y sesiones en lugar de copiarse en la memoria de cada uno.
+    getbuffer() devuelve un memoryview de solo lectura sin copiar nada.
+    No es un BytesIO: los widgets de Streamlit (st.download_button...) no lo aceptan
+    y hay que pasarles getvalue().
+    """
+
+    def __init__(self, view, name=None):
+        super().__init__()
+        self._view = view
+        self._position = 0
+        self.name = name
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read(self, size=-1):
+        end = len(self._view) if size is None or size < 0 else min(len(self._view), self._position + size)
+        data = self._view[self._position:end].tobytes()
+        self._position = max(self._position, end)
+        return data
+
+    read1 = read
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: len(self._view)}[whence]
+        self._position = max(0, base + offset)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def getbuffer(self):
+        return self._view
+
+    def getvalue(self):
+        return self._view.tobytes()
+
+def _disk_cache_open(file_id, revision):
+    """Devuelve un DriveFileView sobre el archivo cacheado o None. Un acierto renueva su posición en el LRU."""
+    path = _disk_cache_path(file_id, revision)
+    try:
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                view = memoryview(b'')
+            else:
+                # El mmap sigue siendo válido aunque la caché expulse (borre) el archivo después.
+                view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        os.utime(path, None)
+        return DriveFileView(view, name=file_id)
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        print(f"AVISO: No se pudo leer la caché de disco para {file_id}: {e}")
+        return None
+
+def _disk_cache_fill(service, file_id, revision, retries=3):
+    """Descarga un archivo por trozos directamente a la caché en disco, sin pasar por memoria."""
+    backend = get_storage_backend(service)
+    with _disk_cache_writer(file_id, revision) as f:
+        def stream():
+            f.seek(0)
+            f.truncate()
+            backend.download_to(file_id, f)
+        DRIVE_RETRY_POLICY.call(stream, retries=retries)
+
+@contextlib.contextmanager
+def _disk_cache_writer(file_id, revision):
+    """
+    Abre un archivo temporal en la caché. Al salir sin errores lo publica de forma
+    atómica como la versión 'revision' del archivo y recorta la caché; si hay un
+    error, lo borra.
+    """
+    os.makedirs(DRIVE_DISK_CACHE_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=DRIVE_DISK_CACHE_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            yield f
+        os.replace(tmp_path, _disk_cache_path(file_id, revision))
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    _disk_cache_evict()
+
+def _disk_cache_evict(max_bytes=None):
+    """Elimina los archivos menos usados hasta que la caché quede por debajo del límite."""
+    max_bytes = DRIVE_DISK_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    with _disk_cache_guard:
+        entries = []
+        with os.scandir(DRIVE_DISK_CACHE_DIR) as it:
+            for entry in it:
+                if entry.name.endswith(".bin"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                pass
+
+def _get_file_revision(service, file_id):
+    """
+    Devuelve un identificador de la versión actual del archivo (md5Checksum o modifiedTime).
+    Siempre hace una llamada ligera a files.get con el servicio del llamante: el índice
+    es del proceso y no sirve para comprobar que este usuario puede leer el archivo.
+    """
+    file_meta = get_storage_backend(service).get_metadata(file_id, fields='md5Checksum, modifiedTime')
+    return file_meta.get('md5Checksum') or file_meta.get('modifiedTime')
+
+def service_user_key(service):
+    """Clave del usuario dueño de un servicio de Drive (la misma que usan los limitadores de cuota)."""
+    return credentials_key(getattr(getattr(service, '_http', None), 'credentials', None))
+
+# =============================================================================
+#           LISTADOS PAGINADOS
+# =============================================================================
+
+def _iter_query(service, filters, fields=LIST_DEFAULT_FIELDS, retries=3):
+    """
+    Generador que recorre todas las páginas de un listado (ver StorageBackend.list_files
+    para los filtros admitidos). Pide la siguiente página solo cuando el llamante ha
+    consumido la anterior, así que quien deja de iterar no paga las páginas restantes.
+    """
+    backend = get_storage_backend(service)
+    page_token = None
+    while True:
+        response = DRIVE_RETRY_POLICY.call(
+            backend.list_files, fields=fields, page_size=LIST_PAGE_SIZE, page_token=page_token, retries=retries, **filters
+        )
+        yield from response.get('files', [])
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            return
+
+def iter_files_in_folder(service, folder_id, mime_type=None, fields=LIST_DEFAULT_FIELDS, retries=3):
+    """
+    Itera de forma perezosa el contenido de una carpeta (opcionalmente filtrado por mimeType).
+    Si la carpeta está indexada no hace ninguna llamada a Drive.
+    """
+    indexed = _index_list_children(folder_id)
+    if indexed is not None:
+        yield from (f for f in indexed if not mime_type or f.get('mimeType') == mime_type)
+        return
+    yield from _iter_query(service, {'parent_ids': [folder_id], 'mime_type': mime_type}, fields, retries)
+
+def iter_folders_in_folder(service, folder_id, retries=3):
+    """Itera de forma perezosa las subcarpetas de una carpeta."""
+    return iter_files_in_folder(service, folder_id, mime_type=FOLDER_MIME_TYPE, fields='id, name, mimeType', retries=retries)
+
+# =============================================================================
+#           FUNCIONES DE ACCESO A DRIVE
+# =============================================================================
+
 # --- OPTIMIZACIÓN APLICADA ---
-# Se añade @st.cache_data a las funciones de lectura.
+# Las búsquedas responden primero desde el índice del proyecto. Solo si la
+# carpeta no está indexada se consulta a Drive, con @st.cache_data y la
+# generación de la carpeta como parte de la clave.
 # El argumento 'service' se renombra a '_service' para que el decorador lo ignore.
 
-@st.cache_data
-def find_or_create_folder(_service, folder_name, parent_id=None, retries=3):
+def find_or_create_folder(service, folder_name, parent_id=None, retries=3):
     """
     Busca una carpeta. Si no la encuentra, la crea.
-    Cacheada porque la parte de 'buscar' es una operación de lectura.
+    Si la carpeta padre está indexada, la búsqueda no hace ninguna llamada a Drive.
     """
-    query = f"name = '{folder_name}' and mimeType = 'application/vnd.google-apps.folder' and trashed = false"
-    if parent_id:
-        query += f" and '{parent_id}' in parents"
-    
-    for attempt in range(retries):
-        try:
-            response = _service.files().list(q=query, spaces='drive', fields='files(id, name)').execute()
-            files = response.get('files', [])
-            if files:
-                return files[0]['id']
-            else:
-                # Si la carpeta no existe, la creamos y limpiamos el caché para
-                # que la próxima llamada refleje el cambio.
-                st.cache_data.clear()
-                file_metadata = {'name': folder_name, 'mimeType': 'application/vnd.google-apps.folder'}
-                if parent_id:
-                    file_metadata['parents'] = [parent_id]
-                folder = _service.files().create(body=file_metadata, fields='id').execute()
-                st.toast(f"Carpeta '{folder_name}' creada en tu Drive.")
-                return folder.get('id')
-        except (TimeoutError, httplib2.ServerNotFoundError) as e:
-            if attempt < retries - 1:
-                time.sleep(2 ** attempt)
-            else: raise
-        except Exception as e:
+    indexed = _index_find_by_name(parent_id, folder_name, FOLDER_MIME_TYPE) if parent_id else None
+    if indexed:
+        return indexed[0]['id']
+    if indexed is None:
+        folder_id = _find_folder_in_drive(service, folder_name, parent_id, retries, generation=_cache_generation(parent_id))
+        if folder_id:
+            return folder_id
+    return _create_folder_in_drive(service, folder_name, parent_id, retries)
+
+@st.cache_data(max_entries=LIST_CACHE_MAX_ENTRIES)
+def _find_folder_in_drive(_service, folder_name, parent_id=None, retries=3, generation=0):
+    """Busca una carpeta directamente en Drive. Cacheada porque es una operación de lectura."""
+    backend = get_storage_backend(_service)
+    try:
+        response = DRIVE_RETRY_POLICY.call(
+            backend.list_files, parent_ids=[parent_id] if parent_id else None, name=folder_name,
+            mime_type=FOLDER_MIME_TYPE, fields='id, name', page_size=1, retries=retries
+        )
+    except Exception as e:
+        if not is_retryable_drive_error(e):
             st.error(f"Ocurrió un error inesperado con Google Drive: {e}")
-            raise
+        raise
+    files = response.get('files', [])
+    return files[0]['id'] if files else None
+
+def _create_folder_in_drive(service, folder_name, parent_id=None, retries=3):
+    """Crea una carpeta en Drive y la registra en el índice. Operación de escritura, NO se cachea."""
+    backend = get_storage_backend(service)
+    try:
+        folder = DRIVE_RETRY_POLICY.call(backend.create_folder, folder_name, parent_id, fields=TREE_INDEX_FIELDS, retries=retries)
+    except Exception as e:
+        if not is_retryable_drive_error(e):
+            st.error(f"Ocurrió un error inesperado con Google Drive: {e}")
+        raise
+    _index_add_node(folder, is_new=True)
+    # Solo invalidamos las búsquedas de la carpeta padre.
+    invalidate_folder_cache(parent_id)
+    st.toast(f"Carpeta '{folder_name}' creada en tu Drive.")
+    return folder.get('id')
 
 def upload_file_to_drive(service, file_object, folder_id, retries=3):
     """
     Sube un objeto de archivo a una carpeta de Drive.
     Esta es una operación de escritura, por lo que NO se cachea.
     """
-    # Al final de una subida exitosa, limpiamos el caché de las funciones
-    # que listan archivos para que reflejen el nuevo fichero.
-    st.cache_data.clear()
-    for attempt in range(retries):
-        try:
-            file_metadata = {'name': file_object.name, 'parents': [folder_id]}
-            file_object.seek(0) 
-            media = MediaIoBaseUpload(file_object, mimetype=file_object.type, resumable=True)
-            file = service.files().create(body=file_metadata, media_body=media, fields='id').execute()
-            st.toast(f"📄 Archivo '{file_object.name}' guardado en Drive.")
-            return file.get('id')
-        except (TimeoutError, httplib2.ServerNotFoundError) as e:
-            if attempt < retries - 1:
-                time.sleep(2 ** attempt)
-            else: raise
-        except Exception as e:
+    backend = get_storage_backend(service)
+    try:
+        file = DRIVE_RETRY_POLICY.call(
+            backend.create_file, file_object.name, folder_id, file_object, file_object.type, fields=TREE_INDEX_FIELDS, retries=retries
+        )
+    except Exception as e:
+        if not is_retryable_drive_error(e):
             st.error(f"Error inesperado al subir archivo: {e}")
-            raise
+        raise
+    _index_add_node(file)
+    # Solo se invalidan los listados de la carpeta de destino.
+    invalidate_folder_cache(folder_id)
+    st.toast(f"📄 Archivo '{file_object.name}' guardado en Drive.")
+    return file.get('id')
+
+def upsert_file_to_drive(service, file_object, folder_id, retries=3):
+    """
+    Guarda un archivo por nombre en una carpeta: si ya existe sustituye su contenido
+    con files().update y, si no, lo crea. En el caso habitual es una sola petición
+    y el id del archivo no cambia, así que los enlaces y las cachés siguen siendo válidos.
+    """
+    backend = get_storage_backend(service)
+    existing_id = find_file_by_name(service, file_object.name, folder_id)
+    try:
+        file = None
+        if existing_id:
+            try:
+                file = DRIVE_RETRY_POLICY.call(
+                    backend.update_file, existing_id, file_object, file_object.type, fields=TREE_INDEX_FIELDS, retries=retries
+                )
+                invalidate_file_cache(existing_id)
+            except HttpError as error:
+                # El archivo se borró desde fuera de la aplicación: lo creamos de nuevo.
+                if getattr(error.resp, 'status', None) != 404:
+                    raise
+                _index_remove_node(existing_id)
+        if file is None:
+            file = DRIVE_RETRY_POLICY.call(
+                backend.create_file, file_object.name, folder_id, file_object, file_object.type, fields=TREE_INDEX_FIELDS, retries=retries
+            )
+    except Exception as e:
+        if not is_retryable_drive_error(e):
+            st.error(f"Error inesperado al guardar archivo: {e}")
+        raise
+    _index_add_node(file)
+    invalidate_folder_cache(folder_id)
+    st.toast(f"📄 Archivo '{file_object.name}' guardado en Drive.")
+    return file.get('id')
 
 def delete_file_from_drive(service, file_id, retries=3):
     """
     Elimina un archivo o carpeta. Operación de escritura, NO se cachea.
+    Invalida solo la caché del propio archivo y de sus carpetas padre.
     """
-    # Limpiamos el caché para reflejar la eliminación.
-    st.cache_data.clear()
-    for attempt in range(retries):
-        try:
-            service.files().delete(fileId=file_id).execute()
-            return True
-        except (TimeoutError, httplib2.ServerNotFoundError) as e:
-            if attempt < retries - 1:
-                time.sleep(2 ** attempt)
-            else: return False
-        except HttpError as error:
-            st.error(f"No se pudo eliminar el archivo: {error}")
-            return False
+    try:
+        parent_ids = DRIVE_RETRY_POLICY.call(_get_parent_ids, service, file_id, retries=retries)
+        DRIVE_RETRY_POLICY.call(get_storage_backend(service).delete, file_id, retries=retries)
+    except HttpError as error:
+        st.error(f"No se pudo eliminar el archivo: {error}")
+        return False
+    except Exception as e:
+        print(f"ERROR al eliminar {file_id}: {e}")
+        return False
+    _index_remove_node(file_id)
+    invalidate_file_cache(file_id)
+    for parent_id in parent_ids:
+        invalidate_folder_cache(parent_id)
+    return True
 
-@st.cache_data
-def find_file_by_name(_service, file_name, folder_id, retries=3):
-    """Busca un archivo por nombre dentro de una carpeta, con reintentos."""
-    query = f"name = '{file_name}' and '{folder_id}' in parents and trashed = false"
-    for attempt in range(retries):
-        try:
-            response = _service.files().list(q=query, spaces='drive', fields='files(id)').execute()
-            files = response.get('files', [])
-            return files[0]['id'] if files else None
-        except (TimeoutError, httplib2.ServerNotFoundError) as e:
-            if attempt < retries - 1:
-                time.sleep(2 ** attempt)
-            else: raise
-        except Exception as e:
+def _get_parent_ids(service, file_id):
+    """Devuelve las carpetas padre de un archivo, desde el índice o con una consulta de metadatos."""
+    file_meta = get_indexed_file_metadata(file_id)
+    if file_meta is None:
+        file_meta = get_storage_backend(service).get_metadata(file_id, fields='parents')
+    return file_meta.get('parents', [])
+
+def find_file_by_name(service, file_name, folder_id, retries=3):
+    """Busca un archivo por nombre dentro de una carpeta. Responde desde el índice si es posible."""
+    indexed = _index_find_by_name(folder_id, file_name)
+    if indexed is not None:
+        return indexed[0]['id'] if indexed else None
+    return _find_file_in_drive(service, file_name, folder_id, retries, generation=_cache_generation(folder_id))
+
+@st.cache_data(max_entries=LIST_CACHE_MAX_ENTRIES)
+def _find_file_in_drive(_service, file_name, folder_id, retries=3, generation=0):
+    """Busca un archivo por nombre dentro de una carpeta de Drive, con reintentos."""
+    backend = get_storage_backend(_service)
+    try:
+        response = DRIVE_RETRY_POLICY.call(backend.list_files, parent_ids=[folder_id], name=file_name, fields='id', page_size=1, retries=retries)
+    except Exception as e:
+        if not is_retryable_drive_error(e):
             st.error(f"Error inesperado al buscar archivo: {e}")
-            raise
+        raise
+    files = response.get('files', [])
+    return files[0]['id'] if files else None
 
 
-@st.cache_data
-def download_file_from_drive_cached(_service, file_id, retries=3):
+def download_file_from_drive_cached(service, file_id, retries=3):
     """
     Descarga el contenido de un archivo de Drive.
     USA EL CACHÉ. Solo debe ser llamada desde el hilo principal de Streamlit.
     """
-    for attempt in range(retries):
-        try:
-            request = _service.files().get_media(fileId=file_id)
-            fh = io.BytesIO()
-            downloader = MediaIoBaseDownload(fh, request)
-            done = False
-            while done is False:
-                status, done = downloader.next_chunk()
-            fh.seek(0)
-            return fh
-        except (TimeoutError, httplib2.ServerNotFoundError) as e:
-            if attempt < retries - 1:
-                time.sleep(2 ** attempt)
-            else: raise
-        except Exception as e:
-            st.error(f"Error inesperado al descargar (cached): {e}")
-            raise
+    try:
+        revision = _get_file_revision_cached(service, file_id, service_user_key(service), generation=_cache_generation(file_id))
+        return _download_with_disk_cache(service, file_id, retries, revision=revision)
+    except Exception as e:
+        st.error(f"Error inesperado al descargar (cached): {e}")
+        raise
+
+@st.cache_data(max_entries=LIST_CACHE_MAX_ENTRIES)
+def _get_file_revision_cached(_service, file_id, user_key, generation=0):
+    """
+    Versión de un archivo, cacheada por file_id, usuario y generación. Solo se guarda el
+    identificador de versión: el contenido vive en la caché en disco, no en st.cache_data.
+    La clave incluye al usuario para que cada uno pase su propia comprobación de acceso.
+    """
+    return _get_file_revision(_service, file_id)
 
 
 def download_file_from_drive_uncached(service, file_id, retries=3):
     """
     Descarga el contenido de un archivo de Drive.
-    NO USA EL CACHÉ. Es segura para ser llamada desde múltiples hilos.
+    NO USA st.cache_data. Es segura para ser llamada desde múltiples hilos y
+    pasa por la caché en disco, así que solo descarga si el archivo ha cambiado.
+    """
+    try:
+        return _download_with_disk_cache(service, file_id, retries)
+    except Exception as e:
+        print(f"ERROR en hilo de descarga (uncached) para file_id {file_id}: {e}")
+        raise
+
+def _download_with_disk_cache(service, file_id, retries=3, revision=None):
+    """
+    Devuelve el contenido como un DriveFileView sobre la caché en disco. La descarga
+    se escribe por trozos en la caché, así que nunca hay una copia completa en memoria.
+    Si no se puede conocer la versión del archivo, se descarga a un BytesIO.
     """
-    for attempt in range(retries):
+    if revision is None:
         try:
-            request = service.files().get_media(fileId=file_id)
-            fh = io.BytesIO()
-            downloader = MediaIoBaseDownload(fh, request)
-            done = False
-            while done is False:
-                status, done = downloader.next_chunk()
-            fh.seek(0)
-            return fh
-        except (TimeoutError, httplib2.ServerNotFoundError) as e:
-            if attempt < retries - 1:
-                time.sleep(2 ** attempt)
-            else: raise
+            revision = _get_file_revision(service, file_id)
         except Exception as e:
-            print(f"ERROR en hilo de descarga (uncached) para file_id {file_id}: {e}")
-            raise
+            print(f"AVISO: No se pudo revalidar {file_id}, se descarga sin caché de disco: {e}")
+            return _fetch_file_content(service, file_id, retries)
+    if not revision:
+        return _fetch_file_content(service, file_id, retries)
 
+    with _disk_cache_lock(file_id):
+        view = _disk_cache_open(file_id, revision)
+        if view is None:
+            try:
+                _disk_cache_fill(service, file_id, revision, retries)
+            except OSError as e:
+                if isinstance(e, (TimeoutError, ConnectionError)):
+                    raise
+                print(f"AVISO: No se pudo escribir la caché de disco para {file_id}: {e}")
+                return _fetch_file_content(service, file_id, retries)
+            view = _disk_cache_open(file_id, revision)
+    return view if view is not None else _fetch_file_content(service, file_id, retries)
 
-@st.cache_data
-def list_project_folders(_service, root_folder_id, retries=3):
-    """Lista las subcarpetas (proyectos) dentro de la carpeta raíz, con reintentos."""
-    query = f"'{root_folder_id}' in parents and mimeType = 'application/vnd.google-apps.folder' and trashed = false"
-    for attempt in range(retries):
-        try:
-            response = _service.files().list(q=query, spaces='drive', fields='files(id, name)').execute()
-            return {file['name']: file['id'] for file in response.get('files', [])}
-        except (TimeoutError, httplib2.ServerNotFoundError) as e:
-            if attempt < retries - 1:
-                time.sleep(2 ** attempt)
-            else: return {} 
-        except Exception as e:
-            st.error(f"Error inesperado al listar proyectos: {e}")
-            return {}
+def _fetch_file_content(service, file_id, retries=3):
+    """Descarga el contenido de un archivo de Drive en memoria, con reintentos."""
+    backend = get_storage_backend(service)
+    return io.BytesIO(DRIVE_RETRY_POLICY.call(backend.download, file_id, retries=retries))
 
-@st.cache_data
-def get_files_in_project(_service, project_folder_id):
-    """Obtiene los archivos dentro de una carpeta de proyecto."""
-    query = f"'{project_folder_id}' in parents and trashed = false"
-    response = _service.files().list(q=query, spaces='drive', fields='files(id, name, mimeType)').execute()
-    return response.get('files', [])
+
+def prefetch_files_from_drive(credentials, files, max_workers=PREFETCH_MAX_WORKERS):
+    """
+    Descarga en paralelo todos los archivos de la lista y devuelve sus contenidos (DriveFileView,
+    de solo lectura) en el mismo orden. Los hilos escriben en la caché en disco y los lectores
+    comparten sus páginas, así que la memoria no crece con el número de hilos.
+    Cada hilo usa su propio servicio de Drive del pool, ya que httplib2 no es seguro entre hilos.
+    """
+    if not files:
+        return []
+
+    def download(file_info):
+        return download_file_from_drive_uncached(get_thread_drive_service(credentials), file_info['id'])
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(files))) as executor:
+        return list(executor.map(download, files))
+
+def list_project_folders(service, root_folder_id, retries=3):
+    """Lista las subcarpetas (proyectos) dentro de una carpeta. Responde desde el índice si es posible."""
+    indexed = _index_list_children(root_folder_id)
+    if indexed is not None:
+        return {f['name']: f['id'] for f in indexed if f.get('mimeType') == FOLDER_MIME_TYPE}
+    return _list_folders_in_drive(service, root_folder_id, retries, generation=_cache_generation(root_folder_id))
+
+@st.cache_data(max_entries=LIST_CACHE_MAX_ENTRIES)
+def _list_folders_in_drive(_service, root_folder_id, retries=3, generation=0):
+    """Lista todas las subcarpetas de una carpeta de Drive, página a página."""
+    try:
+        return {file['name']: file['id'] for file in iter_folders_in_folder(_service, root_folder_id, retries)}
+    except (TimeoutError, httplib2.ServerNotFoundError):
+        return {}
+    except Exception as e:
+        st.error(f"Error inesperado al listar proyectos: {e}")
+        return {}
+
+def get_files_in_project(service, project_folder_id):
+    """Obtiene los archivos dentro de una carpeta de proyecto. Responde desde el índice si es posible."""
+    indexed = _index_list_children(project_folder_id)
+    if indexed is not None:
+        return indexed
+    return _get_files_in_drive_folder(service, project_folder_id, generation=_cache_generation(project_folder_id))
+
+@st.cache_data(max_entries=LIST_CACHE_MAX_ENTRIES)
+def _get_files_in_drive_folder(_service, project_folder_id, generation=0):
+    """Obtiene todos los archivos de una carpeta consultando directamente a Drive, página a página."""
+    return list(iter_files_in_folder(_service, project_folder_id))
     
+# =============================================================================
+#           PETICIONES AGRUPADAS (BATCH)
+# =============================================================================
+
+def execute_drive_batch(service, operations, retries=3):
+    """
+    Ejecuta operaciones de almacenamiento (nombre_del_método, kwargs) agrupándolas en
+    lotes de hasta DRIVE_BATCH_MAX_REQUESTS por petición HTTP.
+    Devuelve una lista de tuplas (respuesta, excepción) en el mismo orden.
+    """
+    backend = get_storage_backend(service)
+    results = []
+    for start in range(0, len(operations), DRIVE_BATCH_MAX_REQUESTS):
+        chunk = operations[start:start + DRIVE_BATCH_MAX_REQUESTS]
+        chunk_results = DRIVE_RETRY_POLICY.call(backend.execute_batch, chunk, retries=retries)
+        # Las operaciones que fallan por cuota o por un error transitorio se
+        # repiten en un batch nuevo, tras la espera de la política de reintentos.
+        for attempt in range(retries - 1):
+            pending = [i for i, (_, error) in enumerate(chunk_results) if error is not None and is_retryable_drive_error(error)]
+            if not pending:
+                break
+            time.sleep(DRIVE_RETRY_POLICY.delay(attempt, chunk_results[pending[0]][1]))
+            retried = DRIVE_RETRY_POLICY.call(backend.execute_batch, [chunk[i] for i in pending], retries=retries)
+            for i, result in zip(pending, retried):
+                chunk_results[i] = result
+        results.extend(chunk_results)
+    return results
+
+def batch_create_folders(service, folder_names, parent_id):
+    """
+    Crea varias carpetas bajo un mismo padre con peticiones batch.
+    Devuelve ({nombre: id} de las creadas, {nombre: excepción} de las que fallaron).
+    """
+    operations = [
+        ('create_folder', {'name': name, 'parent_id': parent_id, 'fields': TREE_INDEX_FIELDS})
+        for name in folder_names
+    ]
+    created, failed = {}, {}
+    for name, (folder, error) in zip(folder_names, execute_drive_batch(service, operations)):
+        if error:
+            print(f"ERROR al crear la carpeta '{name}' en lote: {error}")
+            failed[name] = error
+            continue
+        _index_add_node(folder, is_new=True)
+        created[name] = folder['id']
+    invalidate_folder_cache(parent_id)
+    return created, failed
+
+def batch_find_files_by_name(service, lookups):
+    """
+    Resuelve varias búsquedas (file_name, folder_id) a la vez. Las carpetas indexadas
+    se responden desde memoria y el resto se agrupa en peticiones batch.
+    Devuelve (lista de ids o None en el mismo orden, {posición: excepción} de las
+    búsquedas que fallaron). Un None sin error significa que el archivo no existe.
+    """
+    results = [None] * len(lookups)
+    failed = {}
+    pending = []
+    for position, (file_name, folder_id) in enumerate(lookups):
+        indexed = _index_find_by_name(folder_id, file_name)
+        if indexed is None:
+            pending.append(position)
+        elif indexed:
+            results[position] = indexed[0]['id']
+
+    operations = [
+        ('list_files', {'parent_ids': [lookups[p][1]], 'name': lookups[p][0], 'fields': 'id', 'page_size': 1})
+        for p in pending
+    ]
+    for position, (response, error) in zip(pending, execute_drive_batch(service, operations)):
+        if error:
+            print(f"ERROR al buscar '{lookups[position][0]}' en lote: {error}")
+            failed[position] = error
+            continue
+        files = response.get('files', [])
+        results[position] = files[0]['id'] if files else None
+    return results, failed
+
 # El resto de las funciones en drive_utils.py no se modifican ya que
 # o bien son wrappers de otras funciones o realizan operaciones de escritura
 # que no deben ser cacheadas.
@@ -209,52 +884,90 @@ def get_text_from_docx(_service, file_bytes):
         st.warning(f"No se pudo leer un archivo .docx para el contexto: {e}")
         return ""
 
-def get_context_from_lots(service, project_folder_id, context_lot_names):
+# Texto extraído de los guiones, compartido por todas las sesiones. Como la clave
+# incluye la versión del archivo, un guion modificado nunca devuelve texto antiguo.
+_guion_text_lock = threading.Lock()
+_guion_text_cache = collections.OrderedDict()  # (file_id, revisión) -> texto
+
+def _get_guion_text(service, file_meta):
+    """Devuelve el texto de un guion .docx, extrayéndolo solo si su versión no está en caché."""
+    revision = file_meta.get('md5Checksum') or file_meta.get('modifiedTime')
+    key = (file_meta['id'], revision)
+    if revision:
+        with _guion_text_lock:
+            if key in _guion_text_cache:
+                _guion_text_cache.move_to_end(key)
+                return _guion_text_cache[key]
+
+    file_bytes = _download_with_disk_cache(service, file_meta['id'])
+    try:
+        doc = docx.Document(file_bytes)
+        texto = "\n".join(p.text for p in doc.paragraphs if p.text.strip())
+    except Exception as e:
+        print(f"AVISO: No se pudo leer el guion '{file_meta.get('name')}' para el contexto: {e}")
+        return ""
+
+    if revision:
+        with _guion_text_lock:
+            _guion_text_cache[key] = texto
+            while len(_guion_text_cache) > GUION_TEXT_CACHE_MAX_ENTRIES:
+                _guion_text_cache.popitem(last=False)
+    return texto
+
+def get_context_from_lots(service, project_folder_id, context_lot_names, credentials=None, max_workers=PREFETCH_MAX_WORKERS):
     """
     Recopila todo el texto de los guiones generados para una lista de lotes.
+    Los listados salen del índice del proyecto cuando es posible y los guiones se
+    descargan y leen en paralelo, cada hilo con su propio servicio de Drive (de
+    'credentials' o, si no se pasan, de las credenciales de la sesión). El resultado
+    se une una sola vez al final. Solo debe llamarse desde el hilo principal de Streamlit.
     """
     if not context_lot_names:
         return ""
+    if credentials is None:
+        credentials = get_credentials()
 
-    final_context_str = "\n\n--- INICIO DEL CONTEXTO DE LOTES RELACIONADOS ---\n"
-    
     # Usamos st.spinner aquí porque es una operación de cara al usuario
     with st.spinner(f"Cargando contexto desde {len(context_lot_names)} lote(s)..."):
-        # Obtiene una lista de todas las subcarpetas del proyecto de una vez
-        query = f"'{project_folder_id}' in parents and mimeType = 'application/vnd.google-apps.folder' and trashed = false"
-        response = service.files().list(q=query, spaces='drive', fields='files(id, name)').execute()
-        all_project_folders = {file['name']: file['id'] for file in response.get('files', [])}
-        
+        # Primero se resuelven las carpetas de subapartados de todos los lotes.
+        all_project_folders = list_project_folders(service, project_folder_id)
+        lotes = []
         for lot_name in context_lot_names:
-            clean_name = clean_folder_name(lot_name)
-            lot_folder_id = all_project_folders.get(clean_name)
-            
-            if lot_folder_id:
-                guiones_folder_id = find_file_by_name(service, "Guiones de Subapartados", lot_folder_id)
-                
-                if guiones_folder_id:
-                    final_context_str += f"\n--- Contenido del Lote: '{lot_name}' ---\n"
-                    # Obtenemos las carpetas de los subapartados
-                    query_sub = f"'{guiones_folder_id}' in parents and mimeType = 'application/vnd.google-apps.folder' and trashed = false"
-                    response_sub = service.files().list(q=query_sub, spaces='drive', fields='files(id, name)').execute()
-                    subapartado_folders = {file['name']: file['id'] for file in response_sub.get('files', [])}
-                    
-                    for sub_name, sub_id in subapartado_folders.items():
-                        guion_files = get_files_in_project(service, sub_id)
-                        docx_file = next((f for f in guion_files if f['name'].endswith('.docx')), None)
-                        if docx_file:
-                            # -------- ¡AQUÍ ESTÁ LA CORRECCIÓN! --------
-                            # Se usa la función correcta que sí existe.
-                            file_bytes = download_file_from_drive_uncached(service, docx_file['id'])
-                            texto = get_text_from_docx(service, file_bytes)
-                            final_context_str += f"\n**Subapartado: {sub_name}**\n{texto}\n"
-    
-    final_context_str += "\n--- FIN DEL CONTEXTO DE LOTES RELACIONADOS ---\n"
-    return final_context_str
+            lot_folder_id = all_project_folders.get(clean_folder_name(lot_name))
+            if not lot_folder_id:
+                continue
+            guiones_folder_id = find_file_by_name(service, "Guiones de Subapartados", lot_folder_id)
+            if guiones_folder_id:
+                lotes.append((lot_name, list(list_project_folders(service, guiones_folder_id).items())))
+
+        def load_subapartado(sub_id):
+            worker_service = get_thread_drive_service(credentials) if credentials else service
+            # Nos detenemos en el primer .docx sin pedir el resto de páginas.
+            docx_file = next((f for f in iter_files_in_folder(worker_service, sub_id, fields=TREE_INDEX_FIELDS) if f['name'].endswith('.docx')), None)
+            return _get_guion_text(worker_service, docx_file) if docx_file else None
+
+        sub_ids = [sub_id for _, subapartados in lotes for _, sub_id in subapartados]
+        workers = min(max_workers, len(sub_ids)) if credentials else 1
+        textos = iter([])
+        if sub_ids:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                textos = iter(list(executor.map(load_subapartado, sub_ids)))
+
+    parts = ["\n\n--- INICIO DEL CONTEXTO DE LOTES RELACIONADOS ---\n"]
+    for lot_name, subapartados in lotes:
+        parts.append(f"\n--- Contenido del Lote: '{lot_name}' ---\n")
+        for sub_name, _ in subapartados:
+            texto = next(textos)
+            if texto is not None:
+                parts.append(f"\n**Subapartado: {sub_name}**\n{texto}\n")
+    parts.append("\n--- FIN DEL CONTEXTO DE LOTES RELACIONADOS ---\n")
+    return "".join(parts)
 
 def sync_guiones_folders_with_index(service, active_lot_folder_id, index_structure):
     """
     Crea las carpetas para los guiones en Google Drive.
+    Lista una sola vez las carpetas existentes y crea las que faltan en lote.
+    Si el listado falla no se crea nada.
     """
     try:
         if not index_structure or 'estructura_memoria' not in index_structure:
@@ -265,16 +978,23 @@ def sync_guiones_folders_with_index(service, active_lot_folder_id, index_structu
         hay_subapartados = any(seccion.get('subapartados') for seccion in estructura)
 
         if hay_subapartados:
-            for seccion in estructura:
-                for subapartado_titulo in seccion.get('subapartados', []):
-                    if subapartado_titulo:
-                        folder_name = clean_folder_name(subapartado_titulo)
-                        find_or_create_folder(service, folder_name, parent_id=guiones_main_folder_id)
+            titulos = [sub for seccion in estructura for sub in seccion.get('subapartados', []) if sub]
         else:
-            for seccion in estructura:
-                apartado_titulo = seccion.get('apartado')
-                if apartado_titulo:
-                    folder_name = clean_folder_name(apartado_titulo)
-                    find_or_create_folder(service, folder_name, parent_id=guiones_main_folder_id)
+            titulos = [seccion.get('apartado') for seccion in estructura if seccion.get('apartado')]
+
+        # Listado sin caché y sin capturar errores: si falla, la sincronización se aborta.
+        # Con un listado vacío por un error transitorio se duplicarían todas las carpetas.
+        existing_folders = {folder['name'] for folder in iter_folders_in_folder(service, guiones_main_folder_id)}
+        missing = []
+        for titulo in titulos:
+            folder_name = clean_folder_name(titulo)
+            if folder_name and folder_name not in existing_folders and folder_name not in missing:
+                missing.append(folder_name)
+        if missing:
+            created, failed = batch_create_folders(service, missing, guiones_main_folder_id)
+            if created:
+                st.toast(f"{len(created)} carpeta(s) de guiones creadas en tu Drive.")
+            if failed:
+                st.error(f"No se pudieron crear {len(failed)} carpeta(s) de guiones: {', '.join(failed)}. Vuelve a intentarlo.")
     except Exception as e:
         st.error(f"Error durante la sincronización de carpetas: {e}")
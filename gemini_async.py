@@ -0,0 +1,301 @@
+import os
+import json
+import time
+import queue
+import asyncio
+import threading
+import google.api_core.exceptions
+
+from gemini_governor import gemini_governor, estimate_tokens
+from gemini_files import gemini_files, is_file_reference_error, has_file_parts
+from gemini_response_cache import gemini_response_cache, fingerprint
+from prompts import PROMPT_PAQUETE_FRAGMENTOS
+from utils import (
+    MedicionStreaming, limite_caracteres_fragmento, _error_fragmento, _resultado_fragmento
+)
+
+# Peticiones a Gemini en vuelo a la vez en la redacción asíncrona. Es solo un tope:
+# el ritmo real lo marcan los presupuestos de peticiones y tokens por minuto.
+GEMINI_ASYNC_MAX_CONCURRENCY = int(os.environ.get("IRVE_GEMINI_ASYNC_MAX_CONCURRENCY", 256))
+# Cada cuánto (segundos) se vuelve a mirar si hay hueco en el gobernador cuando lo
+# han liberado llamadas síncronas (las asíncronas avisan al liberarlo).
+GEMINI_ASYNC_SLOT_POLL = 0.1
+
+# Empaquetado de fragmentos pequeños (opcional; "1" lo activa por defecto en la interfaz).
+FRAGMENTOS_EMPAQUETADOS = os.environ.get("IRVE_PACK_FRAGMENTS", "0") == "1"
+# Un fragmento es pequeño si su máximo no pasa de estos caracteres.
+FRAGMENTO_PEQUENO_MAX_CARACTERES = 1500
+# Tope de un paquete: fragmentos y suma de sus máximos de caracteres.
+PAQUETE_MAX_FRAGMENTOS = 6
+PAQUETE_MAX_CARACTERES = 6000
+
+# =============================================================================
+#           CLIENTE ASÍNCRONO DE GEMINI
+# =============================================================================
+# La redacción de la fase 5 lanzaba cada fragmento en un hilo, así que el número
+# de hilos limitaba las peticiones en vuelo. Aquí son corrutinas sobre el cliente
+# asíncrono de Gemini. Comparten con las llamadas síncronas los presupuestos RPM/TPM
+# y la concurrencia adaptativa del gobernador (que se reduce a la mitad con cada
+# ResourceExhausted); el semáforo es solo un tope adicional. La caché de respuestas
+# y la re-subida de archivos caducados funcionan igual.
+
+class AsyncGeminiClient:
+    """Llamadas asíncronas a Gemini bajo los presupuestos del gobernador del proceso."""
+
+    def __init__(self, governor=gemini_governor, max_concurrency=GEMINI_ASYNC_MAX_CONCURRENCY):
+        self.governor = governor
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._slot_released = asyncio.Condition()
+
+    async def _throttle(self, estimated_tokens):
+        """Espera lo que marquen los presupuestos de peticiones y tokens del gobernador."""
+        wait = max(self.governor.requests_budget.reserve(), self.governor.tokens_budget.reserve(estimated_tokens))
+        if wait:
+            await asyncio.sleep(wait)
+
+    async def _acquire_slot(self):
+        """Espera hueco en la concurrencia adaptativa del gobernador sin bloquear el bucle."""
+        while not self.governor.try_acquire_slot():
+            async with self._slot_released:
+                try:
+                    await asyncio.wait_for(self._slot_released.wait(), GEMINI_ASYNC_SLOT_POLL)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _release_slot(self, rate_limited):
+        self.governor._release_slot(rate_limited)
+        async with self._slot_released:
+            self._slot_released.notify_all()
+
+    async def _attempt(self, fn, contents, estimated_tokens, kwargs):
+        await self._throttle(estimated_tokens)
+        async with self._semaphore:
+            await self._acquire_slot()
+            rate_limited = False
+            try:
+                response = await fn(contents, **kwargs)
+            except google.api_core.exceptions.ResourceExhausted:
+                rate_limited = True
+                raise
+            finally:
+                await self._release_slot(rate_limited)
+        # Se corrige el presupuesto de tokens con el uso real que informa Gemini.
+        try:
+            usage = getattr(response, 'usage_metadata', None)
+        except Exception:
+            usage = None  # Un streaming cortado antes de terminar no tiene uso final.
+        actual = getattr(usage, 'total_token_count', None) if usage else None
+        if actual:
+            self.governor.tokens_budget.reserve(actual - estimated_tokens)
+        return response
+
+    async def _call(self, fn, contents, retries, kwargs):
+        """Llama a fn(contents) con los reintentos del gobernador; si un archivo subido ha caducado, lo vuelve a subir una vez."""
+        policy = self.governor.retry_policy
+        attempts = retries or policy.retries
+        estimated_tokens = estimate_tokens(contents)
+        refreshed = False
+        attempt = 0
+        while True:
+            try:
+                return await self._attempt(fn, contents, estimated_tokens, kwargs)
+            except Exception as e:
+                if not refreshed and is_file_reference_error(e) and has_file_parts(contents):
+                    print(f"AVISO: Un archivo de la File API de Gemini ya no está disponible; se vuelve a subir. {e}")
+                    contents = await asyncio.to_thread(gemini_files.refresh, contents)
+                    refreshed = True
+                    continue
+                attempt += 1
+                if attempt >= attempts or not policy.is_retryable(e):
+                    raise
+                await asyncio.sleep(policy.delay(attempt - 1, e))
+
+    async def _cached_call(self, fn, model, contents, retries, force_regenerate, kwargs):
+        # El bucle de eventos lo comparten todas las sesiones: nada bloqueante en él.
+        # fit_request puede llamar a count_tokens (una petición a Gemini), la huella hashea
+        # los archivos en línea y la caché de respuestas lee, escribe y recorta archivos.
+        contents = await asyncio.to_thread(self.governor.fit_request, model, contents)
+        key = await asyncio.to_thread(fingerprint, model, contents, kwargs)
+        if not force_regenerate:
+            cached = await asyncio.to_thread(gemini_response_cache.get, key)
+            if cached is not None:
+                return cached
+        response = await self._call(fn, contents, retries, kwargs)
+        await asyncio.to_thread(gemini_response_cache.put, key, response)
+        return response
+
+    async def generate_content(self, model, contents, retries=None, force_regenerate=False, **kwargs):
+        """Equivalente asíncrono de gemini_governor.generate_content."""
+        return await self._cached_call(model.generate_content_async, model, contents, retries, force_regenerate, kwargs)
+
+    async def generate_content_stream(self, model, contents, consume, retries=None, force_regenerate=False, **kwargs):
+        """
+        Equivalente asíncrono de gemini_governor.generate_content_stream. 'consume' es una
+        corrutina consume(respuesta, inicio) que recorre los trozos con 'async for'.
+        """
+        async def stream(contents, **kwargs):
+            started = time.monotonic()
+            return await consume(await model.generate_content_async(contents, stream=True, **kwargs), started)
+        return await self._cached_call(stream, model, contents, retries, force_regenerate, kwargs)
+
+# =============================================================================
+#           REDACCIÓN ASÍNCRONA DE LA FASE 5
+# =============================================================================
+# La redacción corre en un hilo propio con su bucle de eventos y va dejando en
+# una cola eventos (tipo, prompt_id, dato) que el script de Streamlit consume
+# para actualizar la interfaz:
+#   ('progreso', prompt_id, caracteres)   -- solo en streaming
+#   ('completado', prompt_id, resultado)  -- el mismo dict que generar_fragmento_individual
+#   ('fin', None, error o None)           -- siempre el último
+
+async def generate_fragment_async(client, model, prompt_info, reintentos=5, streaming=False, on_progress=None, force_regenerate=False):
+    """Versión asíncrona de utils.generar_fragmento_individual; devuelve el mismo resultado."""
+    prompt_a_enviar = prompt_info.get("prompt_para_asistente")
+    prompt_id = prompt_info.get("prompt_id")
+
+    if not prompt_a_enviar:
+        return {'success': False, 'error': 'El prompt estaba vacío.', 'prompt_id': prompt_id}
+
+    medicion = MedicionStreaming(prompt_id, limite_caracteres_fragmento(prompt_info), on_progress) if streaming else None
+
+    async def consumir(response, inicio):
+        # Si hay reintento, la medición empieza de nuevo.
+        medicion.reiniciar(inicio)
+        async for chunk in response:
+            if medicion.anotar(chunk):
+                break
+        return medicion.terminar(response)
+
+    try:
+        if streaming:
+            response = await client.generate_content_stream(model, prompt_a_enviar, consumir, retries=reintentos, force_regenerate=force_regenerate)
+        else:
+            response = await client.generate_content(model, prompt_a_enviar, retries=reintentos, force_regenerate=force_regenerate)
+    except Exception as e:
+        return _error_fragmento(prompt_id, e, reintentos)
+
+    return _resultado_fragmento(prompt_id, response, medicion)
+
+# =============================================================================
+#           PAQUETES DE FRAGMENTOS PEQUEÑOS
+# =============================================================================
+# Muchos prompts del plan son pequeños (un párrafo, una lista, una tabla HTML) y
+# cada uno pagaba una petición completa. Con el empaquetado, los pequeños de un
+# mismo subapartado van juntos en una petición que devuelve un array JSON, y el
+# resultado se reparte por prompt_id. Lo que falte en la respuesta (o si no es un
+# JSON válido) se vuelve a pedir fragmento a fragmento.
+
+def pack_prompts(prompts, max_fragments=PAQUETE_MAX_FRAGMENTOS, max_chars=PAQUETE_MAX_CARACTERES):
+    """Agrupa los prompts pequeños de cada subapartado en paquetes; el resto va en paquetes de uno."""
+    packs, open_packs = [], {}  # (apartado, subapartado) -> [paquete, suma de máximos]
+    for prompt_info in prompts:
+        limite = limite_caracteres_fragmento(prompt_info)
+        if not limite or limite > FRAGMENTO_PEQUENO_MAX_CARACTERES:
+            packs.append([prompt_info])
+            continue
+        key = (prompt_info.get("apartado_referencia"), prompt_info.get("subapartado_referencia"))
+        current = open_packs.get(key)
+        if current is None or len(current[0]) >= max_fragments or current[1] + limite > max_chars:
+            current = open_packs[key] = [[], 0]
+            packs.append(current[0])
+        current[0].append(prompt_info)
+        current[1] += limite
+    return packs
+
+async def generate_packed_fragments_async(client, model, prompts, reintentos=5, force_regenerate=False):
+    """
+    Redacta varios fragmentos en una sola petición. Devuelve {prompt_id: resultado} con
+    los que vengan bien en la respuesta; los que falten hay que pedirlos por separado.
+    """
+    tareas = [{'prompt_id': p.get("prompt_id"), 'instrucciones': p.get("prompt_para_asistente")} for p in prompts]
+    prompt = PROMPT_PAQUETE_FRAGMENTOS.format(num_tareas=len(tareas), tareas=json.dumps(tareas, indent=2, ensure_ascii=False))
+    try:
+        response = await client.generate_content(model, prompt, retries=reintentos, force_regenerate=force_regenerate, generation_config={"response_mime_type": "application/json"})
+        piezas = json.loads(response.text)
+    except Exception as e:
+        print(f"AVISO: Falló el paquete de {len(prompts)} fragmentos; se piden por separado. {e}")
+        return {}
+
+    ids = {tarea['prompt_id'] for tarea in tareas}
+    resultados = {}
+    for pieza in piezas if isinstance(piezas, list) else []:
+        if not isinstance(pieza, dict):
+            continue
+        prompt_id, contenido = pieza.get("prompt_id"), pieza.get("contenido")
+        if prompt_id in ids and isinstance(contenido, str) and contenido.strip():
+            resultados[prompt_id] = {'success': True, 'content': contenido, 'prompt_id': prompt_id}
+    if len(resultados) < len(ids):
+        print(f"AVISO: El paquete devolvió {len(resultados)} de {len(ids)} fragmentos; el resto se pide por separado.")
+    return resultados
+
+async def write_fragments_async(model, prompts, events, streaming=False, packing=False, max_concurrency=GEMINI_ASYNC_MAX_CONCURRENCY, force_regenerate=False):
+    """
+    Redacta todos los fragmentos a la vez y publica en 'events' cada uno según termina.
+    Con packing=True los fragmentos pequeños se piden en paquetes (sin streaming).
+    Con force_regenerate=True se ignoran las respuestas cacheadas.
+    """
+    client = AsyncGeminiClient(max_concurrency=max_concurrency)
+
+    def on_progress(prompt_id, caracteres):
+        events.put(('progreso', prompt_id, caracteres))
+
+    async def run(prompt_info):
+        try:
+            resultado = await generate_fragment_async(client, model, prompt_info, streaming=streaming, on_progress=on_progress, force_regenerate=force_regenerate)
+        except Exception as exc:
+            resultado = {'success': False, 'error': f"Error de tarea: {str(exc)}", 'prompt_id': prompt_info.get("prompt_id")}
+        events.put(('completado', prompt_info.get("prompt_id"), resultado))
+
+    async def run_pack(pack):
+        if len(pack) == 1:
+            return await run(pack[0])
+        resultados = await generate_packed_fragments_async(client, model, pack, force_regenerate=force_regenerate)
+        pendientes = []
+        for prompt_info in pack:
+            resultado = resultados.get(prompt_info.get("prompt_id"))
+            if resultado is None:
+                pendientes.append(prompt_info)
+            else:
+                events.put(('completado', prompt_info.get("prompt_id"), resultado))
+        await asyncio.gather(*(run(prompt_info) for prompt_info in pendientes))
+
+    packs = pack_prompts(prompts) if packing else [[prompt_info] for prompt_info in prompts]
+    await asyncio.gather(*(run_pack(pack) for pack in packs))
+
+# El cliente asíncrono de Gemini (grpc_asyncio) queda ligado al bucle de eventos en
+# que se usa por primera vez, y la librería lo guarda en el modelo y en el proceso.
+# Por eso todas las redacciones, de todas las sesiones, corren en un único bucle
+# de larga vida en su propio hilo, en lugar de crear (y cerrar) uno por redacción.
+_loop = None
+_loop_lock = threading.Lock()
+
+def _background_loop():
+    """Bucle de eventos compartido de las llamadas asíncronas a Gemini (se crea la primera vez)."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="gemini-async", daemon=True).start()
+        return _loop
+
+def start_fragment_writing(model, prompts, streaming=False, packing=False, max_concurrency=GEMINI_ASYNC_MAX_CONCURRENCY, force_regenerate=False):
+    """
+    Lanza la redacción en segundo plano y devuelve la cola de eventos. Se puede llamar
+    desde el script de Streamlit: el bucle de la redacción no toca la interfaz.
+    """
+    events = queue.Queue()
+
+    def finished(future):
+        error = None
+        try:
+            future.result()
+        except BaseException as e:  # También la cancelación.
+            print(f"AVISO: La redacción asíncrona de la fase 5 terminó con un error. {e}")
+            error = e
+        events.put(('fin', None, error))
+
+    future = asyncio.run_coroutine_threadsafe(
+        write_fragments_async(model, prompts, events, streaming, packing, max_concurrency, force_regenerate), _background_loop()
+    )
+    future.add_done_callback(finished)
+    return events
@@ -0,0 +1,161 @@
+import os
+import time
+import hashlib
+import datetime
+import threading
+import contextlib
+import concurrent.futures
+import google.generativeai as genai
+
+from gemini_files import FilePart
+from gemini_governor import gemini_governor, estimate_tokens
+from gemini_response_cache import alias_cached_content
+from token_budget import register_cached_prefix, forget_cached_prefix
+
+# "0" desactiva el caché de contexto: el prefijo se envía completo en cada llamada.
+GEMINI_CONTEXT_CACHE_ENABLED = os.environ.get("IRVE_GEMINI_CONTEXT_CACHE", "1") != "0"
+# Gemini no admite cachés por debajo de un mínimo de tokens; con prefijos pequeños tampoco compensa.
+GEMINI_CONTEXT_CACHE_MIN_TOKENS = int(os.environ.get("IRVE_GEMINI_CONTEXT_CACHE_MIN_TOKENS", 4096))
+# Vida del caché (segundos). Se prolonga mientras el lote lo siga usando y se borra al terminar;
+# el TTL solo importa si el proceso muere a mitad de un lote.
+GEMINI_CONTEXT_CACHE_TTL = 15 * 60
+# Si al caché le queda menos de esto al usarlo, se prolonga otro TTL.
+GEMINI_CONTEXT_CACHE_RENEW_MARGIN = 5 * 60
+
+def create_cached_content(model, contents, ttl):
+    """
+    Crea en Gemini un caché con la instrucción de sistema del modelo y 'contents'.
+    Devuelve (caché, modelo que lo usa).
+    """
+    from google.generativeai import caching  # No existe en versiones antiguas de la librería.
+    cache = caching.CachedContent.create(
+        model=model.model_name,
+        system_instruction=getattr(model, '_system_instruction', None),
+        contents=contents,
+        ttl=datetime.timedelta(seconds=ttl),
+    )
+    cached_model = genai.GenerativeModel.from_cached_content(
+        cached_content=cache,
+        generation_config=getattr(model, '_generation_config', None),
+        safety_settings=getattr(model, '_safety_settings', None),
+    )
+    return cache, cached_model
+
+def _contents_digest(contents):
+    """Huella del prefijo: dos lotes con el mismo prefijo comparten caché."""
+    digest = hashlib.sha256()
+    for part in contents:
+        if isinstance(part, FilePart):
+            digest.update(part.key[0].encode('utf-8'))
+        elif isinstance(part, dict):
+            digest.update(hashlib.sha256(part.get('data', b'')).digest())
+        else:
+            digest.update(str(part).encode('utf-8'))
+    return digest.hexdigest()
+
+# =============================================================================
+#           PREFIJO COMPARTIDO DE UN LOTE DE LLAMADAS
+# =============================================================================
+# Las llamadas de un lote (p. ej. todos los guiones de la fase 3) empiezan con el
+# mismo prefijo grande: prompt de sistema, prompt de la fase y pliegos. Ese prefijo
+# se cachea una vez en Gemini y cada llamada envía solo su parte variable.
+
+class SharedPrefix:
+    """
+    Prefijo común de un lote. 'model' es el modelo que deben usar las llamadas y
+    'contents' lo que deben anteponer a su parte variable (vacío si está cacheado).
+    """
+
+    def __init__(self, model, contents, cache=None, ttl=GEMINI_CONTEXT_CACHE_TTL):
+        self.model = model
+        self.contents = [] if cache is not None else list(contents)
+        self.cache = cache
+        self.ttl = ttl
+        self.expires_at = time.time() + ttl
+        self._lock = threading.Lock()
+
+    def _renew(self):
+        """Prolonga la vida del caché si está a punto de caducar en mitad del lote."""
+        if self.cache is None:
+            return
+        with self._lock:
+            if self.expires_at - time.time() > GEMINI_CONTEXT_CACHE_RENEW_MARGIN:
+                return
+            try:
+                self.cache.update(ttl=datetime.timedelta(seconds=self.ttl))
+                self.expires_at = time.time() + self.ttl
+            except Exception as e:
+                print(f"AVISO: No se pudo prolongar el caché de contexto de Gemini. {e}")
+
+    def request(self, suffix):
+        """Contenido de una llamada del lote: el prefijo (si no está cacheado) más 'suffix'."""
+        self._renew()
+        return self.contents + list(suffix)
+
+class ContextCacheRegistry:
+    """Cachés de contexto en uso, compartidos por clave (proyecto/lote) y contados por usuario."""
+
+    def __init__(self, creator=create_cached_content, min_tokens=GEMINI_CONTEXT_CACHE_MIN_TOKENS):
+        self.creator = creator
+        self.min_tokens = min_tokens
+        self._entries = {}  # (clave, modelo, huella) -> Future con el SharedPrefix
+        self._users = {}    # (clave, modelo, huella) -> lotes que lo están usando
+        self._lock = threading.Lock()
+
+    def _create(self, model, contents, ttl, digest):
+        if self.creator is None or estimate_tokens(contents) < self.min_tokens:
+            return SharedPrefix(model, contents, ttl=ttl)
+        try:
+            cache, cached_model = gemini_governor.call(self.creator, model, contents, ttl, estimated_tokens=estimate_tokens(contents))
+        except Exception as e:
+            print(f"AVISO: No se pudo crear el caché de contexto de Gemini; se envía el prefijo completo. {e}")
+            return SharedPrefix(model, contents, ttl=ttl)
+        # Las respuestas cacheadas de un lote siguen valiendo si el caché de contexto se recrea.
+        alias_cached_content(getattr(cache, 'name', None), digest)
+        # Los tokens del caché siguen contando en el presupuesto de cada petición que lo use.
+        usage = getattr(cache, 'usage_metadata', None)
+        register_cached_prefix(getattr(cache, 'name', None), getattr(usage, 'total_token_count', 0) or estimate_tokens(contents))
+        return SharedPrefix(cached_model, contents, cache=cache, ttl=ttl)
+
+    @contextlib.contextmanager
+    def shared_prefix(self, model, key, contents, ttl=GEMINI_CONTEXT_CACHE_TTL):
+        """
+        Prefijo compartido mientras dure el bloque 'with'. El caché se crea al entrar
+        (o se reutiliza si otro lote con el mismo prefijo sigue activo) y se borra
+        cuando el último lote que lo usa termina.
+        El caché se crea fuera del cerrojo del registro: mientras tanto, los lotes con
+        otra clave siguen adelante y los que comparten la misma esperan al mismo Future.
+        """
+        digest = _contents_digest(contents)
+        entry_key = (key, getattr(model, 'model_name', None), digest)
+        with self._lock:
+            future = self._entries.get(entry_key)
+            creator = future is None
+            if creator:
+                future = self._entries[entry_key] = concurrent.futures.Future()
+            self._users[entry_key] = self._users.get(entry_key, 0) + 1
+        prefix = None
+        try:
+            if creator:
+                try:
+                    future.set_result(self._create(model, contents, ttl, digest))
+                except BaseException as e:
+                    future.set_exception(e)
+                    raise
+            prefix = future.result()
+            yield prefix
+        finally:
+            with self._lock:
+                self._users[entry_key] -= 1
+                last_user = self._users[entry_key] == 0
+                if last_user:
+                    del self._users[entry_key]
+                    self._entries.pop(entry_key, None)
+            if last_user and prefix is not None and prefix.cache is not None:
+                forget_cached_prefix(getattr(prefix.cache, 'name', None))
+                try:
+                    prefix.cache.delete()
+                except Exception as e:
+                    print(f"AVISO: No se pudo borrar el caché de contexto de Gemini (caducará solo). {e}")
+
+gemini_context_cache = ContextCacheRegistry(create_cached_content if GEMINI_CONTEXT_CACHE_ENABLED else None)
@@ -0,0 +1,186 @@
+import os
+import re
+import time
+import hashlib
+import tempfile
+import threading
+import itertools
+import google.api_core.exceptions
+import google.generativeai as genai
+
+# Backend de la File API: "gemini" (la API real), "local" (un sustituto en memoria
+# para pruebas, sin red) u "off" (los archivos se envían en línea, como antes).
+GEMINI_FILES_BACKEND = os.environ.get("IRVE_GEMINI_FILES_BACKEND", "gemini")
+# Gemini borra los archivos subidos a las 48 horas.
+GEMINI_FILE_TTL = 48 * 3600
+# Un archivo que caduca antes de este margen (segundos) se vuelve a subir en lugar de reutilizarse.
+GEMINI_FILE_EXPIRY_MARGIN = 3600
+# Espera máxima (segundos) a que Gemini termine de procesar un archivo recién subido.
+GEMINI_FILE_PROCESSING_TIMEOUT = 120
+
+# =============================================================================
+#           SUBIDORES (API REAL Y SUSTITUTO LOCAL)
+# =============================================================================
+# Un subidor recibe (bytes, mime_type, nombre) y devuelve un dict con 'uri',
+# 'name' y 'expires_at' (timestamp). Cualquier excepción hace que el archivo
+# vaya en línea en esa petición.
+
+def upload_to_gemini(data, mime_type, display_name=None):
+    """Sube los bytes a la File API de Gemini y espera a que el archivo esté activo."""
+    # upload_file acepta una ruta en todas las versiones de la librería.
+    with tempfile.NamedTemporaryFile(delete=False) as tmp:
+        tmp.write(data)
+    try:
+        uploaded = genai.upload_file(path=tmp.name, mime_type=mime_type, display_name=display_name)
+    finally:
+        os.remove(tmp.name)
+
+    deadline = time.monotonic() + GEMINI_FILE_PROCESSING_TIMEOUT
+    while uploaded.state.name == "PROCESSING":
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Gemini no terminó de procesar '{display_name}'.")
+        time.sleep(1)
+        uploaded = genai.get_file(uploaded.name)
+    if uploaded.state.name == "FAILED":
+        raise RuntimeError(f"Gemini no pudo procesar '{display_name}'.")
+
+    expiration = getattr(uploaded, 'expiration_time', None)
+    expires_at = expiration.timestamp() if expiration else time.time() + GEMINI_FILE_TTL
+    return {'uri': uploaded.uri, 'name': uploaded.name, 'expires_at': expires_at}
+
+class LocalFileUploader:
+    """
+    Sustituto de la File API para pruebas: guarda los archivos en memoria y
+    devuelve URIs 'local://'. 'ttl' permite simular caducidades y 'expire()'
+    borra un archivo como haría Gemini al caducar.
+    """
+
+    def __init__(self, ttl=GEMINI_FILE_TTL):
+        self.ttl = ttl
+        self.files = {}  # uri -> {'data', 'mime_type', 'display_name'}
+        self.uploads = 0
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def __call__(self, data, mime_type, display_name=None):
+        with self._lock:
+            name = f"files/local-{next(self._ids)}"
+            uri = f"local://{name}"
+            self.files[uri] = {'data': data, 'mime_type': mime_type, 'display_name': display_name}
+            self.uploads += 1
+        return {'uri': uri, 'name': name, 'expires_at': time.time() + self.ttl}
+
+    def get(self, uri):
+        """Contenido de un archivo subido, o NotFound si ha caducado (como en Gemini)."""
+        try:
+            return self.files[uri]
+        except KeyError:
+            raise google.api_core.exceptions.NotFound(f"File {uri} not found or expired.")
+
+    def expire(self, uri):
+        self.files.pop(uri, None)
+
+# =============================================================================
+#           REGISTRO DE ARCHIVOS SUBIDOS
+# =============================================================================
+# Cada pliego se sube una sola vez por contenido (hash SHA-256) y las peticiones
+# lo referencian por URI. Antes, un lote de 40 subapartados enviaba los mismos
+# PDF en línea 40 veces.
+
+class FilePart(dict):
+    """
+    Parte de una petición a Gemini que referencia un archivo subido ('file_data').
+    Conserva la parte en línea original para poder volver a subirla si caduca.
+    """
+
+    def __init__(self, file_data, inline):
+        super().__init__(file_data=file_data)
+        self.inline = inline
+
+# Mensajes de Gemini cuando un archivo referenciado ha caducado o se ha borrado, p. ej.
+# "You do not have permission to access the File abc or it may not exist" o
+# "File abc not found". Un 403/404/400 que no habla de un archivo no se reintenta.
+FILE_REFERENCE_ERROR_PATTERN = re.compile(
+    r"\bfiles?\b.*\b(not found|not exist|does not exist|expired|permission|not in an active state)", re.IGNORECASE | re.DOTALL
+)
+
+def is_file_reference_error(error):
+    """Indica si Gemini rechazó la petición porque un archivo referenciado ya no existe."""
+    if not isinstance(error, (google.api_core.exceptions.NotFound, google.api_core.exceptions.PermissionDenied,
+                              google.api_core.exceptions.InvalidArgument)):
+        return False
+    return FILE_REFERENCE_ERROR_PATTERN.search(str(error)) is not None
+
+def has_file_parts(contents):
+    """Indica si una petición contiene alguna parte que referencia un archivo subido."""
+    if isinstance(contents, (list, tuple)):
+        return any(isinstance(part, FilePart) for part in contents)
+    return isinstance(contents, FilePart)
+
+class GeminiFileRegistry:
+    """Registro, seguro entre hilos, de los archivos subidos a Gemini por hash de contenido."""
+
+    def __init__(self, uploader=upload_to_gemini, expiry_margin=GEMINI_FILE_EXPIRY_MARGIN):
+        self.uploader = uploader
+        self.expiry_margin = expiry_margin
+        self._entries = {}  # (hash, mime_type) -> {'uri', 'name', 'expires_at'}
+        self._locks = {}  # (hash, mime_type) -> Lock: dos hilos no suben el mismo archivo a la vez
+        self._lock = threading.Lock()
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def _get_entry(self, key, data, mime_type, display_name):
+        with self._key_lock(key):
+            entry = self._entries.get(key)
+            if entry and entry['expires_at'] - self.expiry_margin > time.time():
+                return entry
+            entry = self.uploader(data, mime_type, display_name)
+            self._entries[key] = entry
+            return entry
+
+    def part(self, data, mime_type, display_name=None):
+        """
+        Devuelve la parte de la petición para 'data': una referencia al archivo subido
+        o, si no se puede subir, la parte en línea de siempre.
+        """
+        inline = {"mime_type": mime_type, "data": data}
+        if self.uploader is None:
+            return inline
+        key = (hashlib.sha256(data).hexdigest(), mime_type)
+        try:
+            entry = self._get_entry(key, data, mime_type, display_name)
+        except Exception as e:
+            print(f"AVISO: No se pudo subir '{display_name}' a la File API de Gemini; se envía en línea. {e}")
+            return inline
+        part = FilePart({"mime_type": mime_type, "file_uri": entry['uri']}, inline)
+        part.key, part.display_name = key, display_name
+        return part
+
+    def forget(self, part):
+        """Olvida el archivo de una parte (p. ej. porque Gemini ya lo ha borrado)."""
+        with self._lock:
+            self._entries.pop(getattr(part, 'key', None), None)
+
+    def refresh(self, contents):
+        """Vuelve a subir los archivos referenciados en 'contents' y devuelve la petición actualizada."""
+        if isinstance(contents, FilePart):
+            self.forget(contents)
+            return self.part(contents.inline['data'], contents.inline['mime_type'], getattr(contents, 'display_name', None))
+        if isinstance(contents, (list, tuple)):
+            return [self.refresh(part) if isinstance(part, FilePart) else part for part in contents]
+        return contents
+
+def _default_uploader():
+    if GEMINI_FILES_BACKEND == "local":
+        return LocalFileUploader()
+    if GEMINI_FILES_BACKEND == "off":
+        return None
+    return upload_to_gemini
+
+gemini_files = GeminiFileRegistry(_default_uploader())
+
+def gemini_file_part(data, mime_type, display_name=None):
+    """Atajo para gemini_files.part(): la parte de la petición para un archivo."""
+    return gemini_files.part(data, mime_type, display_name)
@@ -0,0 +1,201 @@
+import os
+import time
+import threading
+import google.api_core.exceptions
+from PIL import Image
+
+from quota import TokenBucket, RetryPolicy
+from gemini_files import gemini_files, is_file_reference_error, has_file_parts
+from gemini_response_cache import gemini_response_cache, fingerprint
+from token_budget import fit_to_budget
+
+# Presupuesto de la cuota de Gemini del proyecto (peticiones y tokens por minuto).
+GEMINI_RPM = float(os.environ.get("IRVE_GEMINI_RPM", 1000))
+GEMINI_TPM = float(os.environ.get("IRVE_GEMINI_TPM", 1_000_000))
+# Límites de la concurrencia adaptativa (llamadas a Gemini en vuelo a la vez).
+GEMINI_INITIAL_CONCURRENCY = int(os.environ.get("IRVE_GEMINI_INITIAL_CONCURRENCY", 4))
+GEMINI_MIN_CONCURRENCY = 1
+GEMINI_MAX_CONCURRENCY = int(os.environ.get("IRVE_GEMINI_MAX_CONCURRENCY", 32))
+# Tras reducir la concurrencia, los ResourceExhausted de las llamadas que ya estaban
+# en vuelo no vuelven a reducirla hasta que pasa este tiempo (segundos).
+GEMINI_DECREASE_COOLDOWN = 5.0
+# Reintentos ante cuota agotada o servicio saturado.
+GEMINI_RETRIES = 5
+GEMINI_RETRY_BASE_DELAY = 2.0
+GEMINI_RETRY_MAX_DELAY = 60.0
+
+# Aproximación local de tokens mientras no se conoce el uso real de la respuesta.
+CHARS_PER_TOKEN = 4
+TOKENS_PER_IMAGE = 258
+TOKENS_PER_PDF_PAGE = 258
+
+def is_retryable_gemini_error(error):
+    """Cuota agotada (429) o modelo saturado (503): merece la pena reintentar."""
+    return isinstance(error, (google.api_core.exceptions.ResourceExhausted, google.api_core.exceptions.ServiceUnavailable))
+
+def estimate_tokens(contents):
+    """Estimación barata de los tokens de entrada de una petición a Gemini."""
+    if contents is None:
+        return 0
+    # Una referencia a un archivo subido cuenta lo mismo que el archivo en línea.
+    inline = getattr(contents, 'inline', None)
+    if inline is not None:
+        return estimate_tokens(inline)
+    if isinstance(contents, str):
+        return len(contents) // CHARS_PER_TOKEN + 1
+    if isinstance(contents, Image.Image):
+        return TOKENS_PER_IMAGE
+    if isinstance(contents, dict):
+        data = contents.get('data', b'')
+        if contents.get('mime_type') == 'application/pdf':
+            pages = data.count(b'/Type /Page') - data.count(b'/Type /Pages')
+            return max(1, pages) * TOKENS_PER_PDF_PAGE
+        if str(contents.get('mime_type', '')).startswith('image/'):
+            return TOKENS_PER_IMAGE
+        return len(data) // CHARS_PER_TOKEN + 1
+    if isinstance(contents, (list, tuple)):
+        return sum(estimate_tokens(part) for part in contents)
+    return len(str(contents)) // CHARS_PER_TOKEN + 1
+
+# =============================================================================
+#           GOBERNADOR DE LLAMADAS A GEMINI
+# =============================================================================
+# Todas las llamadas a Gemini del proceso pasan por aquí, vengan del hilo de
+# Streamlit o de los hilos de las fases 3, 4 y 5. Se respetan dos presupuestos
+# (peticiones y tokens por minuto) y la concurrencia se ajusta sola: sube de
+# forma aditiva con cada éxito y baja a la mitad cuando Gemini responde
+# ResourceExhausted (AIMD). Así el rendimiento sigue a la cuota real.
+
+class GeminiGovernor:
+    """Limita y reintenta las llamadas a Gemini de todo el proceso."""
+
+    def __init__(self, rpm=GEMINI_RPM, tpm=GEMINI_TPM, initial_concurrency=GEMINI_INITIAL_CONCURRENCY,
+                 min_concurrency=GEMINI_MIN_CONCURRENCY, max_concurrency=GEMINI_MAX_CONCURRENCY):
+        self.requests_budget = TokenBucket(rpm / 60.0, rpm)
+        self.tokens_budget = TokenBucket(tpm / 60.0, tpm)
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.limit = float(initial_concurrency)
+        self.retry_policy = RetryPolicy(GEMINI_RETRIES, GEMINI_RETRY_BASE_DELAY, GEMINI_RETRY_MAX_DELAY, is_retryable_gemini_error)
+        self._in_flight = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    def _acquire_slot(self):
+        with self._condition:
+            while self._in_flight >= int(self.limit):
+                self._condition.wait()
+            self._in_flight += 1
+
+    def try_acquire_slot(self):
+        """Versión sin espera de _acquire_slot (para el cliente asíncrono): True si ha tomado hueco."""
+        with self._condition:
+            if self._in_flight >= int(self.limit):
+                return False
+            self._in_flight += 1
+            return True
+
+    def _release_slot(self, rate_limited=False):
+        with self._condition:
+            self._in_flight -= 1
+            now = time.monotonic()
+            if rate_limited:
+                if now - self._last_decrease >= GEMINI_DECREASE_COOLDOWN:
+                    self.limit = max(self.min_concurrency, self.limit / 2)
+                    self._last_decrease = now
+                    print(f"AVISO: Cuota de Gemini agotada. Concurrencia reducida a {int(self.limit)}.")
+            else:
+                self.limit = min(self.max_concurrency, self.limit + 1.0 / self.limit)
+            self._condition.notify_all()
+
+    def _attempt(self, fn, args, kwargs, estimated_tokens):
+        """Una llamada: espera hueco y presupuesto, la ejecuta y ajusta la concurrencia."""
+        self.requests_budget.acquire()
+        self.tokens_budget.acquire(estimated_tokens)
+        self._acquire_slot()
+        rate_limited = False
+        try:
+            response = fn(*args, **kwargs)
+        except google.api_core.exceptions.ResourceExhausted:
+            rate_limited = True
+            raise
+        finally:
+            self._release_slot(rate_limited)
+        # Se corrige el presupuesto de tokens con el uso real que informa Gemini.
+        try:
+            usage = getattr(response, 'usage_metadata', None)
+        except Exception:
+            usage = None  # Un streaming cortado antes de terminar no tiene uso final.
+        actual = getattr(usage, 'total_token_count', None) if usage else None
+        if actual:
+            self.tokens_budget.reserve(actual - estimated_tokens)
+        return response
+
+    def call(self, fn, *args, estimated_tokens=1, retries=None, **kwargs):
+        """Ejecuta fn(*args, **kwargs) bajo los límites del gobernador, reintentando los errores de cuota."""
+        return self.retry_policy.call(self._attempt, fn, args, kwargs, estimated_tokens, retries=retries)
+
+    def _call_with_files(self, fn, contents, retries, kwargs):
+        """Llama a fn(contents) y, si un archivo subido ha caducado, lo vuelve a subir y repite una vez."""
+        estimated_tokens = estimate_tokens(contents)
+        try:
+            return self.call(fn, contents, estimated_tokens=estimated_tokens, retries=retries, **kwargs)
+        except Exception as e:
+            if not (is_file_reference_error(e) and has_file_parts(contents)):
+                raise
+            print(f"AVISO: Un archivo de la File API de Gemini ya no está disponible; se vuelve a subir. {e}")
+            return self.call(fn, gemini_files.refresh(contents), estimated_tokens=estimated_tokens, retries=retries, **kwargs)
+
+    def fit_request(self, model, contents):
+        """Ajusta la petición al presupuesto de tokens de entrada (ver token_budget.fit_to_budget)."""
+        return fit_to_budget(model, contents, estimate_tokens, CHARS_PER_TOKEN)
+
+    def _cached_call(self, fn, model, contents, retries, force_regenerate, kwargs):
+        """Sirve la respuesta desde la caché persistente si ya se hizo la misma petición."""
+        contents = self.fit_request(model, contents)
+        key = fingerprint(model, contents, kwargs)
+        if not force_regenerate:
+            cached = gemini_response_cache.get(key)
+            if cached is not None:
+                return cached
+        response = self._call_with_files(fn, contents, retries, kwargs)
+        gemini_response_cache.put(key, response)
+        return response
+
+    def generate_content(self, model, contents, retries=None, force_regenerate=False, **kwargs):
+        """
+        Equivalente a model.generate_content(contents, **kwargs) bajo el gobernador.
+        Con force_regenerate=True se ignora la respuesta cacheada (se pide una nueva).
+        """
+        return self._cached_call(model.generate_content, model, contents, retries, force_regenerate, kwargs)
+
+    def generate_content_stream(self, model, contents, consume, retries=None, force_regenerate=False, **kwargs):
+        """
+        Como generate_content, pero en streaming: consume(respuesta, inicio) recorre los
+        trozos a medida que llegan ('inicio' es el time.monotonic() en que salió la
+        petición) y devuelve la respuesta. Puede dejar de recorrerlos para cortarla;
+        una respuesta cortada no se cachea. Una respuesta cacheada se devuelve sin
+        pasar por consume.
+        """
+        def stream(contents, **kwargs):
+            started = time.monotonic()
+            return consume(model.generate_content(contents, stream=True, **kwargs), started)
+        return self._cached_call(stream, model, contents, retries, force_regenerate, kwargs)
+
+    def send_message(self, chat, contents, retries=None, force_regenerate=False, **kwargs):
+        """
+        Equivalente a chat.send_message(contents, **kwargs) bajo el gobernador. Solo el
+        primer mensaje de un chat se cachea: después la respuesta depende del historial.
+        """
+        if getattr(chat, 'history', None):
+            return self._call_with_files(chat.send_message, self.fit_request(chat.model, contents), retries, kwargs)
+        return self._cached_call(chat.send_message, chat.model, contents, retries, force_regenerate, kwargs)
+
+    def pool_size(self, num_tasks):
+        """
+        Hilos que conviene lanzar para 'num_tasks' tareas. El gobernador decide cuántas
+        llamadas hay realmente en vuelo, así que basta con no quedarse por debajo del máximo.
+        """
+        return max(1, min(num_tasks, self.max_concurrency))
+
+gemini_governor = GeminiGovernor()
@@ -0,0 +1,208 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+from PIL import Image
+
+from gemini_files import FilePart
+
+# Caché persistente de respuestas de Gemini, compartida por todas las sesiones del servidor.
+# "0" en IRVE_LLM_CACHE la desactiva.
+LLM_CACHE_ENABLED = os.environ.get("IRVE_LLM_CACHE", "1") != "0"
+LLM_CACHE_DIR = os.environ.get("IRVE_LLM_CACHE_DIR", os.path.join(tempfile.gettempdir(), "irve_llm_cache"))
+LLM_CACHE_MAX_BYTES = int(os.environ.get("IRVE_LLM_CACHE_MAX_BYTES", 256 * 1024 ** 2))
+# Vida de una respuesta cacheada (segundos).
+LLM_CACHE_TTL = float(os.environ.get("IRVE_LLM_CACHE_TTL", 7 * 24 * 3600))
+# El tamaño de la caché se lleva en memoria; cada tanto (segundos) se vuelve a medir el
+# directorio entero por si otros procesos del servidor también escriben en él.
+LLM_CACHE_RESCAN_INTERVAL = 300
+# Al pasarse del límite se expulsa hasta esta fracción, para que quepan muchas
+# respuestas nuevas antes del siguiente recorrido.
+LLM_CACHE_EVICT_TARGET = 0.9
+
+class CachedResponse:
+    """Respuesta servida desde la caché. Expone lo que la app usa de una respuesta de Gemini."""
+
+    from_cache = True
+
+    def __init__(self, text):
+        self.text = text
+        self.candidates = [text]
+        self.prompt_feedback = None
+        self.usage_metadata = None
+
+# =============================================================================
+#           HUELLA DE UNA PETICIÓN
+# =============================================================================
+# La clave de una respuesta es el hash del modelo, su configuración y cada parte
+# del prompt. De los archivos se usa el hash del contenido, no el URI (que cambia
+# al volver a subirlos).
+
+_cached_content_aliases = {}  # nombre del caché de contexto de Gemini -> huella de su contenido
+
+def alias_cached_content(name, digest):
+    """
+    Registra la huella del prefijo guardado en un caché de contexto de Gemini, para
+    que las peticiones que lo usan tengan la misma clave aunque el caché se recree.
+    """
+    _cached_content_aliases[name] = digest
+
+def _normalize(value):
+    """Convierte configuraciones (dicts, dataclasses, protos) en algo serializable y estable."""
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if isinstance(value, dict):
+        return {str(k): _normalize(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    if hasattr(type(value), 'to_dict'):  # Mensajes proto-plus (p. ej. la instrucción de sistema).
+        return _normalize(type(value).to_dict(value))
+    if hasattr(value, '__dict__'):
+        return {k: _normalize(v) for k, v in vars(value).items() if not k.startswith('_')}
+    return str(value)
+
+def _part_digest(part):
+    if isinstance(part, FilePart):
+        return ['file', part.key[0], part.key[1]]
+    if isinstance(part, dict) and 'data' in part:
+        return ['inline', part.get('mime_type'), hashlib.sha256(part['data']).hexdigest()]
+    if isinstance(part, Image.Image):
+        return ['image', part.mode, list(part.size), hashlib.sha256(part.tobytes()).hexdigest()]
+    if isinstance(part, str):
+        return ['text', hashlib.sha256(part.encode('utf-8')).hexdigest()]
+    return ['other', hashlib.sha256(repr(_normalize(part)).encode('utf-8')).hexdigest()]
+
+def fingerprint(model, contents, kwargs):
+    """Clave de caché de model.generate_content(contents, **kwargs)."""
+    cached_content = getattr(model, 'cached_content', None)
+    parts = contents if isinstance(contents, (list, tuple)) else [contents]
+    request = {
+        'model': getattr(model, 'model_name', None),
+        'system_instruction': str(getattr(model, '_system_instruction', None)),
+        'cached_content': _cached_content_aliases.get(cached_content, cached_content),
+        'generation_config': _normalize(kwargs.get('generation_config', getattr(model, '_generation_config', None))),
+        'safety_settings': _normalize(kwargs.get('safety_settings', getattr(model, '_safety_settings', None))),
+        'parts': [_part_digest(part) for part in parts],
+    }
+    return hashlib.sha256(json.dumps(request, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+# =============================================================================
+#           ALMACÉN EN DISCO
+# =============================================================================
+# Un archivo JSON por respuesta. Igual que la caché de descargas de Drive, las
+# escrituras son atómicas y el tamaño total se limita expulsando primero las
+# respuestas usadas hace más tiempo. El recorrido del directorio solo se hace
+# cuando el tamaño llevado en memoria supera el límite (o toca volver a medirlo),
+# no en cada escritura.
+
+class ResponseCache:
+    """Caché de respuestas de Gemini en disco, con TTL y tamaño máximo."""
+
+    def __init__(self, directory=LLM_CACHE_DIR, max_bytes=LLM_CACHE_MAX_BYTES, ttl=LLM_CACHE_TTL, enabled=LLM_CACHE_ENABLED):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._total_bytes = None  # Tamaño del directorio según el último recorrido más lo escrito después
+        self._scanned_at = 0.0
+
+    def _account(self, delta):
+        """Suma al tamaño llevado en memoria los bytes escritos (o restados) fuera de evict()."""
+        with self._lock:
+            if self._total_bytes is not None:
+                self._total_bytes += delta
+
+    def _needs_eviction(self):
+        with self._lock:
+            return (
+                self._total_bytes is None or self._total_bytes > self.max_bytes
+                or time.time() - self._scanned_at > LLM_CACHE_RESCAN_INTERVAL
+            )
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def get(self, key):
+        """Devuelve la respuesta cacheada (CachedResponse) o None si no hay o ha caducado."""
+        if not self.enabled:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            print(f"AVISO: No se pudo leer la caché de respuestas de Gemini ({key}): {e}")
+            return None
+        if time.time() - entry.get('created', 0) > self.ttl:
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+                self._account(-size)
+            except OSError:
+                pass
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return CachedResponse(entry['text'])
+
+    def put(self, key, response):
+        """Guarda el texto de una respuesta válida. Las respuestas bloqueadas o vacías no se cachean."""
+        if not self.enabled or not getattr(response, 'candidates', None):
+            return
+        try:
+            text = response.text
+        except Exception:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({'created': time.time(), 'text': text}, f, ensure_ascii=False)
+            size = os.path.getsize(tmp_path)
+            path = self._path(key)
+            try:
+                size -= os.path.getsize(path)  # Se sustituye una respuesta anterior.
+            except FileNotFoundError:
+                pass
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"AVISO: No se pudo escribir en la caché de respuestas de Gemini: {e}")
+            return
+        self._account(size)
+        if self._needs_eviction():
+            self.evict()
+
+    def evict(self):
+        """
+        Recorre el directorio y, si la caché supera el límite, elimina las respuestas
+        menos usadas hasta dejarla en LLM_CACHE_EVICT_TARGET del límite. Deja medido el
+        tamaño para las escrituras siguientes.
+        """
+        with self._lock:
+            entries = []
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if entry.name.endswith(".json"):
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            target = self.max_bytes * LLM_CACHE_EVICT_TARGET if total > self.max_bytes else self.max_bytes
+            for _, size, path in sorted(entries):
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                except FileNotFoundError:
+                    pass
+            self._total_bytes = total
+            self._scanned_at = time.time()
+
+gemini_response_cache = ResponseCache()
@@ -0,0 +1,157 @@
+import io
+import csv
+import json
+import hashlib
+import docx
+
+from drive_utils import (
+    find_or_create_folder, iter_files_in_folder, find_file_by_name, download_file_from_drive_cached,
+    upsert_file_to_drive, prefetch_files_from_drive, TREE_INDEX_FIELDS
+)
+from gemini_files import gemini_file_part
+from utils import (
+    convertir_excel_a_texto_csv, extraer_tablas_excel, analizar_docx_multimodal_con_gemini,
+    extraer_texto_pdf, extraer_paginas_pdf
+)
+
+# Digest de los pliegos: un JSON en "Documentos aplicación" del proyecto.
+PLIEGOS_DIGEST_FILENAME = "digest_pliegos.json"
+# Si cambia la forma de extraer el contenido, se sube la versión y los digests se recalculan.
+PLIEGOS_DIGEST_VERSION = 2
+# Si más de esta fracción de las páginas de un PDF está escaneada, se envía el PDF completo.
+PDF_MAX_FRACCION_ESCANEADA = 0.5
+
+# =============================================================================
+#           DIGEST DE LOS PLIEGOS
+# =============================================================================
+# Las fases 1 a 3 leían los pliegos en bruto cada vez: los .xlsx se convertían a
+# CSV de nuevo, los .docx se analizaban con Gemini de nuevo y los PDF se adjuntaban
+# de nuevo. Ahora cada pliego se procesa una sola vez y el resultado normalizado
+# (texto, tablas, análisis de imágenes y hash del contenido) se guarda en Drive.
+# Solo se recalcula el de los pliegos cuyo checksum ha cambiado.
+
+def _file_checksum(file_info):
+    return file_info.get('md5Checksum') or file_info.get('modifiedTime')
+
+def _docx_tables(document):
+    """Tablas de un .docx como CSV."""
+    tables = []
+    for i, table in enumerate(document.tables, start=1):
+        output = io.StringIO()
+        writer = csv.writer(output, lineterminator='\n')
+        for row in table.rows:
+            writer.writerow([cell.text.strip() for cell in row.cells])
+        tables.append({'title': f"Tabla {i}", 'csv': output.getvalue()})
+    return tables
+
+def _digest_pliego(file_info, file_bytes_io):
+    """Procesa un pliego y devuelve su entrada del digest."""
+    name = file_info['name']
+    data = file_bytes_io.getvalue()
+    entry = {
+        'id': file_info['id'],
+        'name': name,
+        'mimeType': file_info['mimeType'],
+        'checksum': _file_checksum(file_info),
+        'content_hash': hashlib.sha256(data).hexdigest(),
+        'text': "",
+        'tables': [],
+        'analysis': "",
+        # Páginas de un PDF que son imagen: se envían a Gemini como PDF junto al texto del resto.
+        'scanned_pages': [],
+        # Los PDF sin texto útil (y cualquier otro formato) se siguen enviando tal cual a Gemini.
+        'send_original': True,
+    }
+    if name.lower().endswith('.xlsx'):
+        entry['text'] = convertir_excel_a_texto_csv(io.BytesIO(data), name)
+        if entry['text']:
+            entry['tables'] = extraer_tablas_excel(io.BytesIO(data))
+        entry['send_original'] = False
+    elif 'wordprocessingml' in file_info['mimeType']:
+        document = docx.Document(io.BytesIO(data))
+        entry['text'] = "\n".join(p.text for p in document.paragraphs if p.text.strip())
+        entry['tables'] = _docx_tables(document)
+        analysis = analizar_docx_multimodal_con_gemini(io.BytesIO(data), name)
+        entry['analysis'] = analysis or ""
+        entry['send_original'] = False
+        if analysis is None:
+            # Sin checksum, el análisis fallido se vuelve a intentar la próxima vez.
+            # Un análisis vacío (documento sin texto ni imágenes) es válido y se conserva.
+            entry['checksum'] = None
+    elif file_info['mimeType'] == 'application/pdf':
+        text, scanned_pages, page_count = extraer_texto_pdf(io.BytesIO(data), name)
+        if text and len(scanned_pages) <= PDF_MAX_FRACCION_ESCANEADA * page_count:
+            entry['text'] = text
+            entry['scanned_pages'] = scanned_pages
+            entry['send_original'] = False
+    return entry
+
+def _load_saved_digest(service, docs_app_folder_id):
+    digest_id = find_file_by_name(service, PLIEGOS_DIGEST_FILENAME, docs_app_folder_id)
+    if not digest_id:
+        return {}
+    try:
+        saved = json.loads(download_file_from_drive_cached(service, digest_id).getvalue().decode('utf-8'))
+    except Exception as e:
+        print(f"AVISO: No se pudo leer el digest de los pliegos; se recalcula. {e}")
+        return {}
+    if saved.get('version') != PLIEGOS_DIGEST_VERSION:
+        return {}
+    return {entry['id']: entry for entry in saved.get('pliegos', [])}
+
+def get_pliegos_digest(service, credentials, project_folder_id):
+    """
+    Devuelve el digest de los pliegos del proyecto (una entrada por archivo, en el
+    orden de la carpeta 'Pliegos'). Procesa solo los pliegos nuevos o modificados y,
+    si hay alguno, guarda el digest actualizado en "Documentos aplicación".
+    Solo debe llamarse desde el hilo principal de Streamlit.
+    """
+    pliegos_folder_id = find_or_create_folder(service, "Pliegos", parent_id=project_folder_id)
+    docs_app_folder_id = find_or_create_folder(service, "Documentos aplicación", parent_id=project_folder_id)
+    pliegos = list(iter_files_in_folder(service, pliegos_folder_id, fields=TREE_INDEX_FIELDS))
+    saved = _load_saved_digest(service, docs_app_folder_id)
+
+    pending = [f for f in pliegos if f['id'] not in saved or saved[f['id']].get('checksum') != _file_checksum(f)]
+    for file_info, file_bytes_io in zip(pending, prefetch_files_from_drive(credentials, pending)):
+        saved[file_info['id']] = _digest_pliego(file_info, file_bytes_io)
+
+    entries = [saved[f['id']] for f in pliegos]
+    if pending or len(saved) != len(entries):
+        digest_bytes = json.dumps({'version': PLIEGOS_DIGEST_VERSION, 'pliegos': entries}, indent=2, ensure_ascii=False).encode('utf-8')
+        digest_file = io.BytesIO(digest_bytes); digest_file.name = PLIEGOS_DIGEST_FILENAME; digest_file.type = "application/json"
+        upsert_file_to_drive(service, digest_file, docs_app_folder_id)
+    return entries
+
+def pliegos_prompt_parts(service, credentials, project_folder_id, binary_only=False):
+    """
+    Partes de una petición a Gemini con el contenido de todos los pliegos, sacadas del
+    digest: texto para los .xlsx, los .docx y los PDF con texto (más sus páginas escaneadas
+    como PDF) y el archivo original (por la File API) para el resto.
+    Con binary_only=True se omite el texto: el que lo pide lo aporta por otra vía
+    (p. ej. los fragmentos recuperados para un subapartado).
+    """
+    entries = get_pliegos_digest(service, credentials, project_folder_id)
+    originals = [e for e in entries if e['send_original'] or e.get('scanned_pages')]
+    buffers = dict(zip((e['id'] for e in originals), prefetch_files_from_drive(credentials, originals)))
+
+    parts = []
+    for entry in entries:
+        if entry['send_original']:
+            parts.append(gemini_file_part(buffers[entry['id']].getvalue(), entry['mimeType'], entry['name']))
+        elif binary_only:
+            pass
+        elif 'wordprocessingml' in entry['mimeType']:
+            # El análisis multimodal solo ve el texto y las imágenes; las tablas se añaden aparte.
+            body = entry['analysis'] or entry['text']
+            tables = "".join(f"\n--- {t['title']} de '{entry['name']}' ---\n{t['csv']}" for t in entry['tables'])
+            if body or tables:
+                parts.append(body + tables)
+        elif entry['text']:
+            parts.append(entry['text'])
+        if not entry['send_original'] and entry.get('scanned_pages'):
+            # Solo las páginas escaneadas viajan como PDF; el resto ya va como texto.
+            paginas = ", ".join(str(n) for n in entry['scanned_pages'])
+            parts.append(f"--- Páginas escaneadas de '{entry['name']}' (se adjuntan como PDF): {paginas} ---")
+            scanned_pdf = extraer_paginas_pdf(buffers[entry['id']], entry['scanned_pages'])
+            parts.append(gemini_file_part(scanned_pdf, 'application/pdf', f"{entry['name']} (páginas escaneadas)"))
+    return parts
@@ -0,0 +1,177 @@
+import os
+import re
+import math
+import threading
+import unicodedata
+import collections
+
+from pliegos_digest import get_pliegos_digest
+
+# "0" desactiva la recuperación: cada guion recibe los pliegos completos, como antes.
+PLIEGOS_RETRIEVAL_ENABLED = os.environ.get("IRVE_PLIEGOS_RETRIEVAL", "1") != "0"
+# Fragmentos de los pliegos que recibe cada subapartado, y tope de caracteres entre todos.
+PLIEGOS_RETRIEVAL_TOP_K = int(os.environ.get("IRVE_PLIEGOS_RETRIEVAL_TOP_K", 8))
+PLIEGOS_RETRIEVAL_MAX_CHARS = int(os.environ.get("IRVE_PLIEGOS_RETRIEVAL_MAX_CHARS", 24000))
+# Tamaño orientativo de un fragmento (caracteres) cuando el texto no viene ya por páginas.
+PLIEGOS_CHUNK_CHARS = 1500
+# Índices que se mantienen en memoria (uno por licitación).
+PLIEGOS_INDEX_MAX_ENTRIES = 8
+
+# Parámetros de BM25.
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# Palabras vacías: aparecen en todos los fragmentos y no ayudan a distinguirlos.
+STOPWORDS = frozenset("""
+a al algo ante antes como con contra cual cuando de del desde donde durante e el ella ellas ellos en entre era
+es esa ese eso esta este esto estos estas fue ha han hasta la las le les lo los mas me mi mis muy ni no nos o
+otra otro para pero por que se ser si sin sobre su sus tambien te tiene todo todos tu un una uno unos unas y ya
+""".split())
+
+def _tokenize(text):
+    """Palabras en minúsculas y sin tildes, sin palabras vacías."""
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return [token for token in re.findall(r'\w{2,}', text) if token not in STOPWORDS]
+
+def _split_text(text, max_chars=PLIEGOS_CHUNK_CHARS):
+    """Parte un texto en trozos de unos max_chars caracteres, sin cortar líneas."""
+    chunks, current, size = [], [], 0
+    for line in text.splitlines():
+        if size + len(line) > max_chars and current:
+            chunks.append("\n".join(current))
+            current, size = [], 0
+        current.append(line)
+        size += len(line) + 1
+    if current:
+        chunks.append("\n".join(current))
+    return [chunk for chunk in chunks if chunk.strip()]
+
+def _entry_passages(entry):
+    """Fragmentos recuperables de un pliego del digest: (etiqueta, texto)."""
+    name = entry['name']
+    if entry['send_original']:
+        return []  # Sin texto: el archivo se envía completo a Gemini.
+    if entry['mimeType'] == 'application/pdf':
+        pages = re.split(r'^\[Página (\d+)\]\n', entry['text'], flags=re.MULTILINE)
+        # re.split con un grupo devuelve [preámbulo, número, texto, número, texto...]
+        return [(f"{name}, página {number}", text.strip()) for number, text in zip(pages[1::2], pages[2::2]) if text.strip()]
+    passages = []
+    # En los .xlsx todo el contenido está en las tablas.
+    body = (entry['analysis'] or entry['text']) if 'wordprocessingml' in entry['mimeType'] else ""
+    for i, chunk in enumerate(_split_text(body), start=1):
+        passages.append((f"{name}, parte {i}", chunk))
+    for table in entry['tables']:
+        for i, chunk in enumerate(_split_text(table['csv']), start=1):
+            passages.append((f"{name}, {table['title']} ({i})", chunk))
+    return passages
+
+# =============================================================================
+#           ÍNDICE BM25 DE LOS PLIEGOS
+# =============================================================================
+# Cada guion de la fase 3 recibía todos los pliegos aunque un subapartado como
+# "Plan de calidad" solo necesite unas pocas páginas. El texto del digest se
+# trocea (por páginas en los PDF, por partes y tablas en el resto) y cada
+# subapartado recibe solo los fragmentos más relevantes para su título e
+# indicaciones, así que el tamaño del prompt ya no crece con la licitación.
+
+class PliegosIndex:
+    """Índice BM25 sobre los fragmentos de texto de los pliegos de una licitación."""
+
+    def __init__(self, passages):
+        self.passages = passages  # [(etiqueta, texto)]
+        self.term_freqs = [collections.Counter(_tokenize(label + " " + text)) for label, text in passages]
+        self.lengths = [sum(tf.values()) for tf in self.term_freqs]
+        self.avg_length = (sum(self.lengths) / len(self.lengths)) if self.lengths else 0
+        doc_freq = collections.Counter(term for tf in self.term_freqs for term in tf)
+        n = len(passages)
+        self.idf = {term: math.log(1 + (n - df + 0.5) / (df + 0.5)) for term, df in doc_freq.items()}
+
+    def _score(self, query_terms, i):
+        tf, length = self.term_freqs[i], self.lengths[i]
+        score = 0.0
+        for term in query_terms:
+            freq = tf.get(term)
+            if freq:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * length / self.avg_length)
+                score += self.idf[term] * freq * (BM25_K1 + 1) / (freq + norm)
+        return score
+
+    def _select(self, candidates, top_k, max_chars):
+        """Los fragmentos de 'candidates' (por orden de preferencia) que caben, en el orden de los pliegos."""
+        selected, total = [], 0
+        for i in candidates:
+            if len(selected) >= top_k:
+                break
+            if total + len(self.passages[i][1]) > max_chars and selected:
+                continue
+            selected.append(i)
+            total += len(self.passages[i][1])
+        return [self.passages[i] for i in sorted(selected)]
+
+    def search(self, query, top_k=PLIEGOS_RETRIEVAL_TOP_K, max_chars=PLIEGOS_RETRIEVAL_MAX_CHARS):
+        """Los fragmentos más relevantes para 'query', en el orden en que aparecen en los pliegos."""
+        query_terms = set(_tokenize(query))
+        scored = sorted(((self._score(query_terms, i), i) for i in range(len(self.passages))), reverse=True)
+        return self._select([i for score, i in scored if score > 0], top_k, max_chars)
+
+    def leading(self, top_k=PLIEGOS_RETRIEVAL_TOP_K, max_chars=PLIEGOS_RETRIEVAL_MAX_CHARS):
+        """Los primeros fragmentos de los pliegos (todo el texto si cabe)."""
+        return self._select(range(len(self.passages)), top_k, max_chars)
+
+    def context_for(self, query, top_k=PLIEGOS_RETRIEVAL_TOP_K, max_chars=PLIEGOS_RETRIEVAL_MAX_CHARS):
+        """
+        Texto listo para el prompt con los fragmentos relevantes para 'query'. Si ninguno
+        coincide, el guion no se queda sin pliegos: recibe sus primeros fragmentos.
+        """
+        passages = self.search(query, top_k, max_chars)
+        header = "--- FRAGMENTOS RELEVANTES DE LOS PLIEGOS PARA ESTE APARTADO ---\n"
+        if not passages:
+            passages = self.leading(top_k, max_chars)
+            if not passages:
+                return ""
+            first_line = query.strip().splitlines()[0] if query.strip() else ""
+            print(f"AVISO: Ningún fragmento de los pliegos coincide con '{first_line[:60]}'; se envía el principio de los pliegos.")
+            header = "--- TEXTO DE LOS PLIEGOS (INICIO; NINGÚN FRAGMENTO COINCIDÍA CON ESTE APARTADO) ---\n"
+        body = "\n\n".join(f"[{label}]\n{text}" for label, text in passages)
+        return header + body
+
+_index_lock = threading.Lock()
+_indexes = collections.OrderedDict()  # huella de los pliegos -> PliegosIndex
+
+def get_pliegos_index(service, credentials, project_folder_id):
+    """
+    Índice de recuperación de los pliegos del proyecto. Se construye una vez por
+    licitación (y por versión de los pliegos) y se reutiliza en memoria.
+    Solo debe llamarse desde el hilo principal de Streamlit (lee el digest).
+    """
+    entries = get_pliegos_digest(service, credentials, project_folder_id)
+    key = tuple((entry['id'], entry['content_hash']) for entry in entries)
+    with _index_lock:
+        index = _indexes.get(key)
+        if index is not None:
+            _indexes.move_to_end(key)
+            return index
+    index = PliegosIndex([passage for entry in entries for passage in _entry_passages(entry)])
+    with _index_lock:
+        _indexes[key] = index
+        while len(_indexes) > PLIEGOS_INDEX_MAX_ENTRIES:
+            _indexes.popitem(last=False)
+    return index
+
+def retrieval_query(titulo, indicaciones):
+    """Texto de búsqueda de un subapartado: su título y todos los textos de sus indicaciones."""
+    texts = [titulo or ""]
+
+    def collect(value):
+        if isinstance(value, str):
+            texts.append(value)
+        elif isinstance(value, dict):
+            for item in value.values():
+                collect(item)
+        elif isinstance(value, (list, tuple)):
+            for item in value:
+                collect(item)
+
+    collect(indicaciones)
+    return "\n".join(texts)
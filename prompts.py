@@ -767,3 +767,22 @@ Tu única salida DEBE ser un objeto JSON válido con exactamente dos claves:
 
 
 
+
+PROMPT_PAQUETE_FRAGMENTOS = """
+Actúa como un redactor técnico experto y silencioso. Vas a recibir {num_tareas} tareas de redacción independientes, cada una con su identificador ("prompt_id") y sus instrucciones.
+Redacta el contenido de CADA tarea siguiendo al pie de la letra sus instrucciones (idioma, formato, longitud en caracteres), exactamente como si la recibieras por separado.
+
+# REGLAS ABSOLUTAS
+1. Tu respuesta debe ser ÚNICAMENTE un array JSON válido, con un objeto por tarea y en el mismo orden.
+2. Cada objeto tiene exactamente dos claves: "prompt_id" (copiado literalmente de la tarea) y "contenido" (el texto o el código HTML final de esa tarea, como cadena JSON).
+3. No mezcles el contenido de unas tareas con otras, no omitas ninguna y no añadas explicaciones fuera del array.
+
+# EJEMPLO DE SALIDA JSON
+[
+  {{"prompt_id": "2.1_PART1_TEXT", "contenido": "El plan de calidad se basa en..."}},
+  {{"prompt_id": "2.1_PART2_HTML_VISUAL", "contenido": "<!DOCTYPE html><html>...</html>"}}
+]
+
+# TAREAS
+{tareas}
+"""
@@ -0,0 +1,140 @@
+import os
+import json
+import time
+import random
+import hashlib
+import threading
+import httplib2
+from googleapiclient.errors import HttpError
+
+# Peticiones por segundo (y ráfaga máxima) que se permiten a cada usuario contra Drive.
+# Drive limita por usuario y por proyecto de Google Cloud; quedarse justo por debajo
+# evita que las fases en paralelo acumulen errores 403/429.
+DRIVE_USER_RATE = float(os.environ.get("IRVE_DRIVE_USER_RATE", 50))
+DRIVE_USER_BURST = float(os.environ.get("IRVE_DRIVE_USER_BURST", 100))
+# Límite del proyecto de Google Cloud (por defecto 12.000 consultas por minuto),
+# compartido por todos los usuarios del servidor.
+DRIVE_PROJECT_RATE = float(os.environ.get("IRVE_DRIVE_PROJECT_RATE", 180))
+DRIVE_PROJECT_BURST = float(os.environ.get("IRVE_DRIVE_PROJECT_BURST", 360))
+
+# Reintentos: espera aleatoria entre 0 y min(máximo, base * 2^intento) ("full jitter").
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 32.0
+
+# Códigos HTTP que indican un error transitorio o de cuota.
+RETRYABLE_HTTP_STATUSES = (429, 500, 502, 503, 504)
+# Motivos de un 403 que significan "más despacio", no "sin permiso".
+RATE_LIMIT_REASONS = ('userRateLimitExceeded', 'rateLimitExceeded', 'sharingRateLimitExceeded')
+
+# =============================================================================
+#           LIMITADOR DE TASA (TOKEN BUCKET)
+# =============================================================================
+
+class TokenBucket:
+    """
+    Cubo de tokens seguro entre hilos: se rellena a 'rate' tokens por segundo hasta
+    'capacity'. Cada petición consume un token y, si no hay, espera lo justo.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens=1):
+        """Reserva 'tokens' y devuelve cuántos segundos hay que esperar antes de usarlos."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= tokens
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def acquire(self, tokens=1):
+        """Bloquea el hilo hasta que haya tokens disponibles."""
+        wait = self.reserve(tokens)
+        if wait:
+            time.sleep(wait)
+
+_buckets_lock = threading.Lock()
+_buckets = {}  # clave -> TokenBucket
+
+def get_rate_limiter(key, rate, capacity):
+    """Devuelve el limitador compartido de una clave (usuario o proyecto), creándolo si no existe."""
+    with _buckets_lock:
+        bucket = _buckets.get(key)
+        if bucket is None:
+            bucket = _buckets[key] = TokenBucket(rate, capacity)
+        return bucket
+
+def credentials_key(credentials):
+    """Clave estable por usuario a partir de sus credenciales."""
+    raw = f"{getattr(credentials, 'client_id', '')}:{getattr(credentials, 'refresh_token', None) or getattr(credentials, 'token', '')}"
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+def drive_rate_limiters(user_key):
+    """Limitadores que debe atravesar una petición a Drive: el del usuario y el del proyecto."""
+    return (
+        get_rate_limiter(('drive-user', user_key), DRIVE_USER_RATE, DRIVE_USER_BURST),
+        get_rate_limiter('drive-project', DRIVE_PROJECT_RATE, DRIVE_PROJECT_BURST),
+    )
+
+# =============================================================================
+#           POLÍTICA DE REINTENTOS
+# =============================================================================
+
+def _http_error_reason(error):
+    """Extrae el motivo ('reason') del cuerpo JSON de un HttpError de Google."""
+    try:
+        content = error.content.decode('utf-8') if isinstance(error.content, bytes) else error.content
+        details = json.loads(content).get('error', {})
+        errors = details.get('errors') or [{}]
+        return errors[0].get('reason') or details.get('status')
+    except Exception:
+        return None
+
+def is_retryable_drive_error(error):
+    """Indica si un error de Drive es transitorio (red, 5xx) o de cuota (429, 403 por tasa)."""
+    if isinstance(error, (TimeoutError, ConnectionError, httplib2.ServerNotFoundError)):
+        return True
+    if isinstance(error, HttpError):
+        status = int(getattr(error.resp, 'status', 0) or 0)
+        if status in RETRYABLE_HTTP_STATUSES:
+            return True
+        return status == 403 and _http_error_reason(error) in RATE_LIMIT_REASONS
+    return False
+
+class RetryPolicy:
+    """Reintentos con backoff exponencial y full jitter. Respeta la cabecera Retry-After."""
+
+    def __init__(self, retries=3, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY, is_retryable=is_retryable_drive_error):
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.is_retryable = is_retryable
+
+    def delay(self, attempt, error=None):
+        """Segundos de espera antes del reintento número 'attempt' (empezando en 0)."""
+        resp = getattr(error, 'resp', None)
+        retry_after = resp.get('retry-after') if hasattr(resp, 'get') else None
+        if retry_after:
+            try:
+                return min(self.max_delay, float(retry_after))
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def call(self, fn, *args, retries=None, **kwargs):
+        """Ejecuta fn(*args, **kwargs) reintentando los errores transitorios."""
+        attempts = retries or self.retries
+        for attempt in range(attempts):
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                if attempt >= attempts - 1 or not self.is_retryable(e):
+                    raise
+                time.sleep(self.delay(attempt, e))
+
+DRIVE_RETRY_POLICY = RetryPolicy()
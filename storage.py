@@ -0,0 +1,443 @@
+import io
+import os
+import time
+import random
+import shutil
+import datetime
+import mimetypes
+import weakref
+import threading
+import collections
+import httplib2
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaIoBaseUpload, MediaIoBaseDownload
+from quota import credentials_key, drive_rate_limiters
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+# Por debajo de este tamaño las subidas son multipart (una sola petición) en lugar de reanudables.
+MULTIPART_UPLOAD_MAX_BYTES = 5 * 1024 * 1024
+# Tamaño de cada trozo de una descarga: es lo máximo que se tiene en memoria a la vez.
+DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Backend de almacenamiento: "drive" (Google Drive) o "local" (un directorio del servidor).
+STORAGE_BACKEND = os.environ.get("IRVE_STORAGE_BACKEND", "drive")
+# Directorio raíz del backend local. Hace las veces de "Mi unidad".
+LOCAL_STORAGE_DIR = os.environ.get("IRVE_LOCAL_STORAGE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "mi-carpeta"))
+# Latencia simulada (segundos) de cada ida y vuelta al backend local.
+LOCAL_STORAGE_LATENCY = float(os.environ.get("IRVE_LOCAL_STORAGE_LATENCY", 0))
+# Probabilidad (0-1) de que una ida y vuelta al backend local falle.
+LOCAL_STORAGE_ERROR_RATE = float(os.environ.get("IRVE_LOCAL_STORAGE_ERROR_RATE", 0))
+# Código HTTP de los errores simulados (503 = backendError de Drive).
+LOCAL_STORAGE_ERROR_STATUS = int(os.environ.get("IRVE_LOCAL_STORAGE_ERROR_STATUS", 503))
+
+# Id de la carpeta raíz, igual que el alias 'root' de Drive.
+LOCAL_ROOT_ID = 'root'
+
+# =============================================================================
+#           INTERFAZ DE ALMACENAMIENTO
+# =============================================================================
+# drive_utils habla con el almacenamiento solo a través de esta interfaz.
+# Los metadatos que devuelven los backends tienen la forma de los de Drive
+# (id, name, mimeType, parents, md5Checksum, modifiedTime) y los errores se
+# lanzan como googleapiclient.errors.HttpError, así que el resto de la
+# aplicación no distingue un backend de otro.
+
+class StorageBackend:
+    """Operaciones de almacenamiento que necesita la aplicación."""
+
+    def list_files(self, parent_ids=None, name=None, mime_type=None, exclude_mime_type=None,
+                   fields='id, name, mimeType', page_size=1000, page_token=None):
+        """
+        Devuelve una página {'files': [...], 'nextPageToken': ...} con los archivos no
+        eliminados que cumplen todos los filtros. 'parent_ids' admite varias carpetas
+        (el archivo debe estar en cualquiera de ellas).
+        """
+        raise NotImplementedError
+
+    def get_metadata(self, file_id, fields='id, name, mimeType, parents'):
+        """Devuelve los metadatos de un archivo o carpeta."""
+        raise NotImplementedError
+
+    def download(self, file_id):
+        """Devuelve el contenido de un archivo como bytes."""
+        fh = io.BytesIO()
+        self.download_to(file_id, fh)
+        return fh.getvalue()
+
+    def download_to(self, file_id, fh):
+        """Escribe el contenido de un archivo en 'fh' por trozos, sin cargarlo entero en memoria."""
+        raise NotImplementedError
+
+    def create_folder(self, name, parent_id=None, fields='id, name, mimeType, parents'):
+        """Crea una carpeta y devuelve sus metadatos."""
+        raise NotImplementedError
+
+    def create_file(self, name, parent_id, file_object, mime_type=None, fields='id, name, mimeType, parents'):
+        """Crea un archivo con el contenido de 'file_object' y devuelve sus metadatos."""
+        raise NotImplementedError
+
+    def update_file(self, file_id, file_object, mime_type=None, fields='id, name, mimeType, parents'):
+        """Sustituye el contenido de un archivo conservando su id."""
+        raise NotImplementedError
+
+    def delete(self, file_id):
+        """Elimina un archivo o una carpeta con todo su contenido."""
+        raise NotImplementedError
+
+    def get_start_page_token(self):
+        """Devuelve el token a partir del cual list_changes informará de los cambios."""
+        raise NotImplementedError
+
+    def list_changes(self, page_token, page_size=1000, fields=None):
+        """
+        Devuelve una página del feed de cambios con la forma de changes.list de Drive:
+        {'changes': [...], 'nextPageToken' o 'newStartPageToken': ...}.
+        """
+        raise NotImplementedError
+
+    def execute_batch(self, operations):
+        """
+        Ejecuta una lista de operaciones (nombre_del_método, kwargs) y devuelve una lista
+        de tuplas (respuesta, excepción) en el mismo orden. Por defecto las ejecuta una
+        a una; los backends que pueden agruparlas en una sola petición lo sobrescriben.
+        """
+        results = []
+        for method, kwargs in operations:
+            try:
+                results.append((getattr(self, method)(**kwargs), None))
+            except Exception as e:
+                results.append((None, e))
+        return results
+
+# =============================================================================
+#           BACKEND DE GOOGLE DRIVE
+# =============================================================================
+
+def _quote(value):
+    """Escapa un literal para usarlo dentro de una consulta de Drive."""
+    return "'" + str(value).replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+class DriveBackend(StorageBackend):
+    """
+    Backend sobre un servicio de la API de Drive v3 (googleapiclient). Cada petición
+    pasa antes por los limitadores de tasa del usuario y del proyecto.
+    """
+
+    def __init__(self, service):
+        self.service = service
+        credentials = getattr(getattr(service, '_http', None), 'credentials', None)
+        self._rate_limiters = drive_rate_limiters(credentials_key(credentials))
+
+    def _execute(self, request, cost=1):
+        """Ejecuta una petición respetando la cuota de Drive."""
+        for limiter in self._rate_limiters:
+            limiter.acquire(cost)
+        return request.execute()
+
+    def _build_upload_media(self, file_object, mime_type=None):
+        """Prepara el cuerpo de la subida: multipart si el archivo es pequeño, reanudable si no."""
+        size = file_object.seek(0, io.SEEK_END)
+        file_object.seek(0)
+        return MediaIoBaseUpload(file_object, mimetype=mime_type or getattr(file_object, 'type', None) or 'application/octet-stream',
+                                 resumable=size > MULTIPART_UPLOAD_MAX_BYTES)
+
+    def _request(self, method, **kwargs):
+        """Construye (sin ejecutar) la petición de la API equivalente a una operación de la interfaz."""
+        files = self.service.files()
+        if method == 'list_files':
+            query = ["trashed = false"]
+            if kwargs.get('parent_ids'):
+                query.insert(0, "(" + " or ".join(f"{_quote(p)} in parents" for p in kwargs['parent_ids']) + ")")
+            if kwargs.get('name') is not None:
+                query.append(f"name = {_quote(kwargs['name'])}")
+            if kwargs.get('mime_type'):
+                query.append(f"mimeType = {_quote(kwargs['mime_type'])}")
+            if kwargs.get('exclude_mime_type'):
+                query.append(f"mimeType != {_quote(kwargs['exclude_mime_type'])}")
+            return files.list(
+                q=" and ".join(query), spaces='drive', pageSize=kwargs.get('page_size', 1000),
+                pageToken=kwargs.get('page_token'),
+                fields=f"nextPageToken, files({kwargs.get('fields', 'id, name, mimeType')})"
+            )
+        if method == 'get_metadata':
+            return files.get(fileId=kwargs['file_id'], fields=kwargs.get('fields', 'id, name, mimeType, parents'))
+        if method == 'create_folder':
+            body = {'name': kwargs['name'], 'mimeType': FOLDER_MIME_TYPE}
+            if kwargs.get('parent_id'):
+                body['parents'] = [kwargs['parent_id']]
+            return files.create(body=body, fields=kwargs.get('fields', 'id, name, mimeType, parents'))
+        if method == 'create_file':
+            body = {'name': kwargs['name'], 'parents': [kwargs['parent_id']]}
+            media = self._build_upload_media(kwargs['file_object'], kwargs.get('mime_type'))
+            return files.create(body=body, media_body=media, fields=kwargs.get('fields', 'id, name, mimeType, parents'))
+        if method == 'update_file':
+            media = self._build_upload_media(kwargs['file_object'], kwargs.get('mime_type'))
+            return files.update(fileId=kwargs['file_id'], media_body=media, fields=kwargs.get('fields', 'id, name, mimeType, parents'))
+        if method == 'delete':
+            return files.delete(fileId=kwargs['file_id'])
+        raise ValueError(f"Operación de almacenamiento desconocida: {method}")
+
+    def list_files(self, **kwargs):
+        return self._execute(self._request('list_files', **kwargs))
+
+    def get_metadata(self, file_id, fields='id, name, mimeType, parents'):
+        return self._execute(self._request('get_metadata', file_id=file_id, fields=fields))
+
+    def download_to(self, file_id, fh):
+        downloader = MediaIoBaseDownload(fh, self.service.files().get_media(fileId=file_id), chunksize=DOWNLOAD_CHUNK_SIZE)
+        done = False
+        while done is False:
+            for limiter in self._rate_limiters:
+                limiter.acquire()
+            status, done = downloader.next_chunk()
+
+    def create_folder(self, name, parent_id=None, fields='id, name, mimeType, parents'):
+        return self._execute(self._request('create_folder', name=name, parent_id=parent_id, fields=fields))
+
+    def create_file(self, name, parent_id, file_object, mime_type=None, fields='id, name, mimeType, parents'):
+        return self._execute(self._request('create_file', name=name, parent_id=parent_id, file_object=file_object, mime_type=mime_type, fields=fields))
+
+    def update_file(self, file_id, file_object, mime_type=None, fields='id, name, mimeType, parents'):
+        return self._execute(self._request('update_file', file_id=file_id, file_object=file_object, mime_type=mime_type, fields=fields))
+
+    def delete(self, file_id):
+        self._execute(self._request('delete', file_id=file_id))
+
+    def get_start_page_token(self):
+        return self._execute(self.service.changes().getStartPageToken()).get('startPageToken')
+
+    def list_changes(self, page_token, page_size=1000, fields=None):
+        return self._execute(self.service.changes().list(
+            pageToken=page_token, spaces='drive', pageSize=page_size, includeRemoved=True, fields=fields
+        ))
+
+    def execute_batch(self, operations):
+        """Agrupa todas las operaciones en una sola petición batch de Drive."""
+        results = [(None, None)] * len(operations)
+
+        def callback(request_id, response, exception):
+            results[int(request_id)] = (response, exception)
+
+        batch = self.service.new_batch_http_request(callback=callback)
+        for position, (method, kwargs) in enumerate(operations):
+            batch.add(self._request(method, **kwargs), request_id=str(position))
+        # Cada operación del batch cuenta para la cuota como una petición independiente.
+        self._execute(batch, cost=len(operations))
+        return results
+
+# =============================================================================
+#           BACKEND LOCAL (DIRECTORIO DEL SERVIDOR)
+# =============================================================================
+# Cada carpeta y archivo es una ruta real bajo LOCAL_STORAGE_DIR y su id es la
+# ruta relativa, así que los ids sobreviven a reinicios. Cada operación paga
+# una ida y vuelta simulada (latencia y tasa de errores configurables) para
+# poder medir cuánto cuesta Drive sin salir de la máquina. El feed de cambios
+# solo recoge las escrituras hechas a través del backend, no las ediciones
+# manuales del directorio.
+
+class LocalBackend(StorageBackend):
+    """Backend sobre un directorio local con la misma semántica de carpetas que Drive."""
+
+    def __init__(self, root_dir=LOCAL_STORAGE_DIR, latency=LOCAL_STORAGE_LATENCY,
+                 error_rate=LOCAL_STORAGE_ERROR_RATE, error_status=LOCAL_STORAGE_ERROR_STATUS, seed=None):
+        self.root_dir = os.path.abspath(root_dir)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._batch_state = threading.local()
+        self._changes = []
+        # Idas y vueltas simuladas por operación, para comparar con Drive.
+        self.stats = collections.Counter()
+        os.makedirs(self.root_dir, exist_ok=True)
+
+    def _round_trip(self, operation):
+        """
+        Simula el coste de una petición: latencia y, con probabilidad error_rate, un error HTTP.
+        Dentro de un batch la latencia ya se ha pagado y solo se simulan los errores.
+        """
+        in_batch = getattr(self._batch_state, 'active', False)
+        with self._lock:
+            if not in_batch:
+                self.stats[operation] += 1
+            failed = self._random.random() < self.error_rate
+        if self.latency and not in_batch:
+            time.sleep(self.latency)
+        if failed:
+            raise HttpError(httplib2.Response({'status': self.error_status}), b'Error simulado del backend local', uri=operation)
+
+    def _path(self, file_id):
+        """Convierte un id en su ruta absoluta, sin permitir salir del directorio raíz."""
+        if file_id in (None, LOCAL_ROOT_ID):
+            return self.root_dir
+        path = os.path.abspath(os.path.join(self.root_dir, file_id))
+        if os.path.commonpath([path, self.root_dir]) != self.root_dir:
+            raise self._not_found(file_id)
+        return path
+
+    def _not_found(self, file_id):
+        return HttpError(httplib2.Response({'status': 404}), f'File not found: {file_id}'.encode(), uri=str(file_id))
+
+    def _meta(self, path):
+        """Metadatos con la forma de Drive. La versión se toma de la fecha de modificación."""
+        stat = os.stat(path)
+        file_id = os.path.relpath(path, self.root_dir).replace(os.sep, '/')
+        parent = os.path.dirname(path)
+        is_folder = os.path.isdir(path)
+        return {
+            'id': file_id,
+            'name': os.path.basename(path),
+            'mimeType': FOLDER_MIME_TYPE if is_folder else (mimetypes.guess_type(path)[0] or 'application/octet-stream'),
+            'parents': [LOCAL_ROOT_ID if parent == self.root_dir else os.path.relpath(parent, self.root_dir).replace(os.sep, '/')],
+            'modifiedTime': datetime.datetime.fromtimestamp(stat.st_mtime_ns / 1e9, datetime.timezone.utc).isoformat(),
+        }
+
+    def _record_change(self, file_id, removed=False, path=None):
+        with self._lock:
+            self._changes.append({'fileId': file_id, 'removed': removed, 'file': None if removed else self._meta(path)})
+
+    def _write(self, path, file_object):
+        """Escribe el contenido de forma atómica para que un lector nunca vea un archivo a medias."""
+        file_object.seek(0)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as fh:
+            shutil.copyfileobj(file_object, fh)
+        os.replace(tmp_path, path)
+
+    def list_files(self, parent_ids=None, name=None, mime_type=None, exclude_mime_type=None,
+                   fields='id, name, mimeType', page_size=1000, page_token=None):
+        self._round_trip('list_files')
+        files = []
+        for parent_id in parent_ids or [LOCAL_ROOT_ID]:
+            folder = self._path(parent_id)
+            if not os.path.isdir(folder):
+                continue
+            for entry in sorted(os.scandir(folder), key=lambda e: e.name):
+                if entry.name.endswith('.tmp') or (name is not None and entry.name != name):
+                    continue
+                meta = self._meta(entry.path)
+                if mime_type and meta['mimeType'] != mime_type:
+                    continue
+                if exclude_mime_type and meta['mimeType'] == exclude_mime_type:
+                    continue
+                files.append(meta)
+        start = int(page_token or 0)
+        response = {'files': files[start:start + page_size]}
+        if start + page_size < len(files):
+            response['nextPageToken'] = str(start + page_size)
+        return response
+
+    def get_metadata(self, file_id, fields='id, name, mimeType, parents'):
+        self._round_trip('get_metadata')
+        path = self._path(file_id)
+        if not os.path.exists(path):
+            raise self._not_found(file_id)
+        return self._meta(path)
+
+    def download_to(self, file_id, fh):
+        self._round_trip('download')
+        path = self._path(file_id)
+        if not os.path.isfile(path):
+            raise self._not_found(file_id)
+        with open(path, 'rb') as source:
+            shutil.copyfileobj(source, fh, DOWNLOAD_CHUNK_SIZE)
+
+    def create_folder(self, name, parent_id=None, fields='id, name, mimeType, parents'):
+        self._round_trip('create_folder')
+        path = os.path.join(self._path(parent_id), name)
+        os.makedirs(path, exist_ok=True)
+        meta = self._meta(path)
+        self._record_change(meta['id'], path=path)
+        return meta
+
+    def create_file(self, name, parent_id, file_object, mime_type=None, fields='id, name, mimeType, parents'):
+        # Un directorio no admite dos archivos con el mismo nombre: si ya existe, se sobrescribe.
+        self._round_trip('create_file')
+        folder = self._path(parent_id)
+        if not os.path.isdir(folder):
+            raise self._not_found(parent_id)
+        path = os.path.join(folder, name)
+        self._write(path, file_object)
+        meta = self._meta(path)
+        self._record_change(meta['id'], path=path)
+        return meta
+
+    def update_file(self, file_id, file_object, mime_type=None, fields='id, name, mimeType, parents'):
+        self._round_trip('update_file')
+        path = self._path(file_id)
+        if not os.path.isfile(path):
+            raise self._not_found(file_id)
+        self._write(path, file_object)
+        self._record_change(file_id, path=path)
+        return self._meta(path)
+
+    def delete(self, file_id):
+        self._round_trip('delete')
+        path = self._path(file_id)
+        if path == self.root_dir or not os.path.exists(path):
+            raise self._not_found(file_id)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+        self._record_change(file_id, removed=True)
+
+    def get_start_page_token(self):
+        self._round_trip('get_start_page_token')
+        with self._lock:
+            return str(len(self._changes))
+
+    def list_changes(self, page_token, page_size=1000, fields=None):
+        self._round_trip('list_changes')
+        start = int(page_token)
+        with self._lock:
+            changes = self._changes[start:start + page_size]
+            total = len(self._changes)
+        response = {'changes': changes}
+        if start + page_size < total:
+            response['nextPageToken'] = str(start + page_size)
+        else:
+            response['newStartPageToken'] = str(total)
+        return response
+
+    def execute_batch(self, operations):
+        """Un batch es una sola ida y vuelta: se paga la latencia una vez y se ejecuta cada operación."""
+        self._round_trip('batch')
+        self._batch_state.active = True
+        try:
+            return super().execute_batch(operations)
+        finally:
+            self._batch_state.active = False
+
+_drive_backends_lock = threading.Lock()
+_drive_backends = weakref.WeakKeyDictionary()  # servicio de googleapiclient -> DriveBackend
+
+_local_backend = None
+_local_backend_lock = threading.Lock()
+
+def get_local_backend():
+    """Devuelve el backend local del proceso (compartido por todas las sesiones e hilos)."""
+    global _local_backend
+    with _local_backend_lock:
+        if _local_backend is None:
+            _local_backend = LocalBackend()
+        return _local_backend
+
+def local_storage_enabled():
+    """Indica si la aplicación está configurada para usar el backend local."""
+    return STORAGE_BACKEND == 'local'
+
+def get_storage_backend(service):
+    """
+    Devuelve el backend de almacenamiento de un 'service'. Acepta tanto un backend
+    como un servicio de googleapiclient, que se envuelve en un DriveBackend.
+    """
+    if isinstance(service, StorageBackend):
+        return service
+    with _drive_backends_lock:
+        backend = _drive_backends.get(service)
+        if backend is None:
+            backend = _drive_backends[service] = DriveBackend(service)
+        return backend
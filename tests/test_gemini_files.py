@@ -0,0 +1,82 @@
+import google.api_core.exceptions
+import pytest
+
+import gemini_governor
+from gemini_files import FilePart, GeminiFileRegistry, LocalFileUploader, is_file_reference_error
+
+PDF = b"%PDF-1.4 pliego de prueba"
+
+@pytest.fixture
+def uploader():
+    return LocalFileUploader()
+
+@pytest.fixture
+def registry(uploader, monkeypatch):
+    registry = GeminiFileRegistry(uploader)
+    # El gobernador vuelve a subir los archivos a través del registro del proceso.
+    monkeypatch.setattr(gemini_governor, 'gemini_files', registry)
+    return registry
+
+def test_same_content_is_uploaded_once(registry, uploader):
+    first = registry.part(PDF, 'application/pdf', 'pliego.pdf')
+    second = registry.part(PDF, 'application/pdf', 'copia.pdf')
+    assert isinstance(first, FilePart)
+    assert first['file_data']['file_uri'] == second['file_data']['file_uri']
+    assert uploader.uploads == 1
+
+    registry.part(PDF + b"otro", 'application/pdf', 'otro.pdf')
+    assert uploader.uploads == 2
+
+def test_file_about_to_expire_is_uploaded_again():
+    uploader = LocalFileUploader(ttl=10)
+    registry = GeminiFileRegistry(uploader, expiry_margin=60)
+    registry.part(PDF, 'application/pdf')
+    registry.part(PDF, 'application/pdf')
+    assert uploader.uploads == 2
+
+def test_upload_failure_falls_back_to_inline():
+    def failing_uploader(data, mime_type, display_name=None):
+        raise RuntimeError("sin red")
+
+    part = GeminiFileRegistry(failing_uploader).part(PDF, 'application/pdf')
+    assert part == {"mime_type": "application/pdf", "data": PDF}
+
+def test_expired_file_is_reuploaded_and_request_resent(registry, uploader):
+    part = registry.part(PDF, 'application/pdf', 'pliego.pdf')
+    uploader.expire(part['file_data']['file_uri'])
+    sent = []
+
+    def send(contents):
+        # Como Gemini: una referencia a un archivo borrado falla.
+        for p in contents:
+            if isinstance(p, FilePart):
+                uploader.get(p['file_data']['file_uri'])
+        sent.append(contents)
+        return "respuesta"
+
+    governor = gemini_governor.GeminiGovernor()
+    assert governor._call_with_files(send, ["prompt", part], 1, {}) == "respuesta"
+    assert uploader.uploads == 2
+    assert sent[0][1]['file_data']['file_uri'] != part['file_data']['file_uri']
+
+def test_unrelated_errors_are_not_retried_as_file_errors(registry, uploader):
+    part = registry.part(PDF, 'application/pdf')
+
+    def send(contents):
+        raise google.api_core.exceptions.PermissionDenied("API key not valid. Please pass a valid API key.")
+
+    with pytest.raises(google.api_core.exceptions.PermissionDenied):
+        gemini_governor.GeminiGovernor()._call_with_files(send, ["prompt", part], 1, {})
+    assert uploader.uploads == 1
+
+@pytest.mark.parametrize("error, expected", [
+    (google.api_core.exceptions.NotFound("File local://files/local-1 not found or expired."), True),
+    (google.api_core.exceptions.PermissionDenied("You do not have permission to access the File abc or it may not exist."), True),
+    (google.api_core.exceptions.InvalidArgument("The File abc is not in an ACTIVE state and usage is not allowed."), True),
+    (google.api_core.exceptions.PermissionDenied("API key not valid. Please pass a valid API key."), False),
+    (google.api_core.exceptions.NotFound("models/gemini-x is not found for API version v1beta."), False),
+    (google.api_core.exceptions.InvalidArgument("Invalid value for file_data.mime_type."), False),
+    (google.api_core.exceptions.ResourceExhausted("File quota exceeded"), False),
+])
+def test_is_file_reference_error(error, expected):
+    assert is_file_reference_error(error) is expected
@@ -0,0 +1,177 @@
+import os
+import threading
+from PIL import Image
+
+from gemini_files import FilePart
+
+# Tokens de entrada que puede tener una petición a Gemini (gemini-2.5-flash admite
+# 1.048.576; se deja margen para la instrucción de sistema y el caché de contexto).
+GEMINI_INPUT_TOKEN_BUDGET = int(os.environ.get("IRVE_GEMINI_INPUT_TOKEN_BUDGET", 1_000_000))
+# Por encima de esta fracción del presupuesto, la estimación local no basta y se
+# pregunta a Gemini (count_tokens) cuántos tokens ocupa de verdad la petición.
+GEMINI_COUNT_TOKENS_THRESHOLD = 0.5
+# Las peticiones con al menos estos tokens dejan en el log su desglose por partes ("0": todas).
+GEMINI_TOKEN_LOG_MIN_TOKENS = int(os.environ.get("IRVE_GEMINI_TOKEN_LOG_MIN_TOKENS", 20_000))
+# Aviso que sustituye al final de un texto recortado.
+TEXTO_RECORTADO = "\n[... contenido recortado para no superar el límite de tokens de la petición ...]"
+
+class RequestTooLargeError(ValueError):
+    """La parte imprescindible de una petición ya supera el presupuesto de tokens."""
+
+# =============================================================================
+#           PRIORIDAD DE LAS PARTES DE UNA PETICIÓN
+# =============================================================================
+# Una parte sin prioridad es imprescindible (el prompt, los pliegos). El contexto
+# que se puede sacrificar se marca con optional_part(); cuanto mayor es la
+# prioridad, antes se descarta si la petición no cabe.
+
+class OptionalText(str):
+    """Texto prescindible de una petición. Gemini lo recibe como un str normal."""
+
+    priority = 1
+
+class OptionalInline(dict):
+    """Parte en línea (archivo o imagen) prescindible de una petición."""
+
+    priority = 1
+
+def optional_part(part, priority=1):
+    """Marca 'part' como contexto prescindible con la prioridad dada (1 = se descarta la última)."""
+    if isinstance(part, str):
+        part = OptionalText(part)
+    elif isinstance(part, FilePart):
+        pass  # Ya admite atributos.
+    elif isinstance(part, dict):
+        part = OptionalInline(part)
+    else:
+        return part  # Imágenes y otros: siempre imprescindibles.
+    part.priority = priority
+    return part
+
+def part_priority(part):
+    return getattr(part, 'priority', 0)
+
+def part_label(part):
+    """Nombre corto de una parte para el log."""
+    if isinstance(part, FilePart):
+        return f"archivo '{getattr(part, 'display_name', None) or part['file_data'].get('mime_type')}'"
+    if isinstance(part, dict):
+        return f"en línea {part.get('mime_type')}"
+    if isinstance(part, Image.Image):
+        return "imagen"
+    text = str(part).strip().splitlines()[0] if str(part).strip() else ""
+    return f"texto '{text[:40]}'"
+
+# =============================================================================
+#           PREFIJOS EN EL CACHÉ DE CONTEXTO
+# =============================================================================
+# Un modelo ligado a un caché de contexto (GenerativeModel.from_cached_content)
+# envía en cada petición, sin que aparezcan en 'contents', los tokens del caché.
+# gemini_cache los registra al crear el caché para que cuenten en el presupuesto.
+
+_cached_prefix_lock = threading.Lock()
+_cached_prefix_tokens = {}  # nombre del CachedContent -> tokens
+
+def register_cached_prefix(name, tokens):
+    """Registra los tokens de un caché de contexto recién creado."""
+    if name:
+        with _cached_prefix_lock:
+            _cached_prefix_tokens[name] = tokens
+
+def forget_cached_prefix(name):
+    """Olvida un caché de contexto borrado."""
+    with _cached_prefix_lock:
+        _cached_prefix_tokens.pop(name, None)
+
+def cached_prefix_tokens(model):
+    """Tokens del caché de contexto al que está ligado 'model' (0 si no usa ninguno)."""
+    name = getattr(model, 'cached_content', None)
+    name = getattr(name, 'name', name)  # Según la versión de la librería, el nombre o el objeto.
+    if not name:
+        return 0
+    with _cached_prefix_lock:
+        return _cached_prefix_tokens.get(name, 0)
+
+# =============================================================================
+#           CONTABILIDAD PREVIA DE TOKENS
+# =============================================================================
+# Antes no se miraba el tamaño de una petición hasta enviarla: con muchos pliegos
+# y documentos de apoyo, Gemini la rechazaba tras una larga espera. Ahora cada
+# petición se mide antes de salir y, si no cabe, se descarta o recorta primero el
+# contexto prescindible. Si ni así cabe, se falla sin llamar a Gemini.
+
+def count_request_tokens(model, parts, estimate):
+    """
+    Tokens de 'parts' según Gemini (count_tokens), o la estimación local si no se puede
+    contar. No incluye el caché de contexto del modelo: eso lo suma cached_prefix_tokens.
+    """
+    count_tokens = getattr(model, 'count_tokens', None)
+    if count_tokens is None:
+        return estimate
+    try:
+        response = count_tokens(parts)
+        return (response.total_tokens - (getattr(response, 'cached_content_token_count', 0) or 0)) or estimate
+    except Exception as e:
+        print(f"AVISO: No se pudieron contar los tokens de la petición con Gemini; se usa la estimación local. {e}")
+        return estimate
+
+def _truncate_text(part, keep_chars):
+    """El principio de un texto, cortado en un salto de línea, con el aviso de recorte."""
+    head = part[:keep_chars]
+    if "\n" in head:
+        head = head.rsplit("\n", 1)[0]
+    return optional_part(head + TEXTO_RECORTADO, part_priority(part))
+
+def fit_to_budget(model, contents, estimate_tokens, chars_per_token, budget=GEMINI_INPUT_TOKEN_BUDGET):
+    """
+    Devuelve 'contents' ajustado al presupuesto de tokens de entrada. Descarta primero
+    las partes prescindibles de mayor prioridad (y, a igual prioridad, las últimas);
+    un texto que sobra solo en parte se recorta en lugar de descartarse.
+    El caché de contexto del modelo cuenta como parte imprescindible.
+    Lanza RequestTooLargeError si lo imprescindible ya no cabe.
+    """
+    if not isinstance(contents, (list, tuple)):
+        return contents  # Una sola parte no se puede repartir.
+    parts = list(contents)
+    cached = cached_prefix_tokens(model)
+    tokens = [estimate_tokens(part) for part in parts]
+    estimated = sum(tokens)
+    counted = estimated
+    if cached + estimated > budget * GEMINI_COUNT_TOKENS_THRESHOLD:
+        counted = count_request_tokens(model, parts, estimated)
+    # La estimación por partes se escala para que sume lo que ha contado Gemini.
+    scale = counted / estimated if estimated else 1.0
+    tokens = [t * scale for t in tokens]
+    total = cached + counted
+
+    if total >= GEMINI_TOKEN_LOG_MIN_TOKENS or total > budget:
+        breakdown = ", ".join(f"{part_label(part)}: {int(t)}" for part, t in zip(parts, tokens))
+        if cached:
+            breakdown = f"caché de contexto: {cached}, {breakdown}"
+        print(f"TOKENS: Petición de ~{int(total)} tokens (presupuesto {budget}). {breakdown}")
+    if total <= budget:
+        return contents
+
+    excess = total - budget
+    shed = []
+    optional = sorted((i for i, part in enumerate(parts) if part_priority(part) > 0), key=lambda i: (-part_priority(parts[i]), -i))
+    for i in optional:
+        if excess <= 0:
+            break
+        if isinstance(parts[i], str) and tokens[i] > excess:
+            keep_chars = int((tokens[i] - excess) / scale * chars_per_token)
+            shed.append(f"{part_label(parts[i])} (recortado)")
+            parts[i] = _truncate_text(parts[i], keep_chars)
+            excess = 0
+        else:
+            shed.append(part_label(parts[i]))
+            parts[i] = None
+            excess -= tokens[i]
+
+    if excess > 0:
+        raise RequestTooLargeError(
+            f"La petición ocupa ~{int(total)} tokens y el límite es {budget}; "
+            f"la parte imprescindible sigue superándolo sin el contexto prescindible."
+        )
+    print(f"AVISO: Petición por encima de {budget} tokens; se descarta contexto prescindible: {'; '.join(shed)}.")
+    return [part for part in parts if part is not None]
@@ -6,11 +6,12 @@ import re
 import os
 import time
 import concurrent.futures
+import queue
 import docx
 import google.generativeai as genai
 
 # Imports desde tus módulos
-from auth import get_credentials
+from auth import get_credentials, get_thread_drive_service
 
 from prompts import (
     PROMPT_DETECTAR_LOTES, PROMPT_REGENERACION, PROMPT_GEMINI_PROPUESTA_ESTRATEGICA, 
@@ -19,16 +20,24 @@ from prompts import (
 )
 from drive_utils import (
     find_or_create_folder, get_files_in_project, delete_file_from_drive,
-    upload_file_to_drive, find_file_by_name, download_file_from_drive_cached, download_file_from_drive_uncached,
+    upload_file_to_drive, upsert_file_to_drive, find_file_by_name, download_file_from_drive_cached, download_file_from_drive_uncached,
     sync_guiones_folders_with_index, list_project_folders, ROOT_FOLDER_NAME,
-    get_or_create_lot_folder_id, clean_folder_name, get_context_from_lots
+    get_or_create_lot_folder_id, clean_folder_name, get_context_from_lots, batch_find_files_by_name
 )
+from drive_async import download_many
+from gemini_async import start_fragment_writing, FRAGMENTOS_EMPAQUETADOS
+from token_budget import optional_part
+from gemini_governor import gemini_governor
+from gemini_files import gemini_file_part
+from gemini_cache import gemini_context_cache, SharedPrefix
+from pliegos_digest import pliegos_prompt_parts
+from pliegos_retrieval import get_pliegos_index, retrieval_query, PLIEGOS_RETRIEVAL_ENABLED
 from utils import (
     mostrar_indice_desplegable, limpiar_respuesta_json, agregar_markdown_a_word, desensamblar_docx, reensamblar_docx_con_imagenes, 
     wrap_html_fragment, html_a_imagen, limpiar_respuesta_final, analizar_docx_multimodal_con_gemini, apply_safety_margin_to_plan,
-    corregir_numeracion_markdown, enviar_mensaje_con_reintentos, get_lot_index_info, generar_indice_word, generar_fragmento_individual,
+    corregir_numeracion_markdown, enviar_mensaje_con_reintentos, get_lot_index_info, generar_indice_word,
     get_lot_context, OPCION_ANALISIS_GENERAL, natural_sort_key, ejecutar_pase_cohesion_fragmento, 
-    convertir_excel_a_texto_csv
+    convertir_excel_a_texto_csv, limite_caracteres_fragmento, FRAGMENTOS_STREAMING
 )
 
 
@@ -165,17 +174,9 @@ def phase_1_viability_page(model, go_to_project_selection, go_to_phase2):
         with st.spinner("Analizando documentos para detectar lotes..."):
             try:
                 # ... (El contenido de esta función no necesita cambios)
-                contenido_ia = [PROMPT_DETECTAR_LOTES]
-                for file_info in documentos_pliegos:
-                    file_bytes_io = download_file_from_drive_cached(service, file_info['id'])
-                    nombre_archivo = file_info['name']
-                    if nombre_archivo.lower().endswith('.xlsx'):
-                        texto_csv = convertir_excel_a_texto_csv(file_bytes_io, nombre_archivo)
-                        if texto_csv: contenido_ia.append(texto_csv)
-                    else:
-                        contenido_ia.append({"mime_type": file_info['mimeType'], "data": file_bytes_io.getvalue()})
+                contenido_ia = [PROMPT_DETECTAR_LOTES] + pliegos_prompt_parts(service, get_credentials(), project_folder_id)
                 
-                response = model.generate_content(contenido_ia, generation_config={"response_mime_type": "application/json"})
+                response = gemini_governor.generate_content(model, contenido_ia, generation_config={"response_mime_type": "application/json"})
                 json_limpio = limpiar_respuesta_json(response.text)
                 resultado = json.loads(json_limpio)
                 lotes = resultado.get("lotes_encontrados", [])
@@ -185,9 +186,7 @@ def phase_1_viability_page(model, go_to_project_selection, go_to_phase2):
                     docs_app_folder_id = find_or_create_folder(service, "Documentos aplicación", parent_id=project_folder_id)
                     json_bytes = json.dumps(resultado, indent=2).encode('utf-8')
                     mock_file = io.BytesIO(json_bytes); mock_file.name = LOTES_FILENAME; mock_file.type = "application/json"
-                    existing_file_id = find_file_by_name(service, LOTES_FILENAME, docs_app_folder_id)
-                    if existing_file_id: delete_file_from_drive(service, existing_file_id)
-                    upload_file_to_drive(service, mock_file, docs_app_folder_id)
+                    upsert_file_to_drive(service, mock_file, docs_app_folder_id)
                     st.toast("Resultado del análisis de lotes guardado en Drive.")
                 except Exception as e:
                     st.warning(f"No se pudo guardar el resultado del análisis de lotes en Drive: {e}")
@@ -256,23 +255,15 @@ def phase_1_viability_page(model, go_to_project_selection, go_to_phase2):
         #           FIN DE LA CORRECCIÓN CLAVE 1
         # =====================================================================
 
-        def generate_and_save_analysis():
+        def generate_and_save_analysis(force_regenerate=False):
             with st.spinner("🧠 Analizando documentos con Gemini..."):
                 try:
                     # ... (El contenido de esta función no necesita cambios)
                     idioma = st.session_state.get('project_language', 'Español')
                     contexto_lote = get_lot_context()
                     prompt = PROMPT_REQUISITOS_CLAVE.format(idioma=idioma, contexto_lote=contexto_lote)
-                    contenido_ia = [prompt]
-                    for file_info in documentos_pliegos:
-                        file_bytes_io = download_file_from_drive_cached(service, file_info['id'])
-                        nombre_archivo = file_info['name']
-                        if nombre_archivo.lower().endswith('.xlsx'):
-                            texto_csv = convertir_excel_a_texto_csv(file_bytes_io, nombre_archivo)
-                            if texto_csv: contenido_ia.append(texto_csv)
-                        else:
-                            contenido_ia.append({"mime_type": file_info['mimeType'], "data": file_bytes_io.getvalue()})
-                    response = model.generate_content(contenido_ia)
+                    contenido_ia = [prompt] + pliegos_prompt_parts(service, get_credentials(), project_folder_id)
+                    response = gemini_governor.generate_content(model, contenido_ia, force_regenerate=force_regenerate)
                     if not response.candidates: st.error("Gemini no generó una respuesta."); return
                     
                     documento = docx.Document()
@@ -282,10 +273,7 @@ def phase_1_viability_page(model, go_to_project_selection, go_to_phase2):
                     buffer.name = ANALYSIS_FILENAME
                     buffer.type = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
                     
-                    if analysis_doc_id: # Usamos la variable fresca que hemos consultado
-                        delete_file_from_drive(service, analysis_doc_id)
-                        
-                    upload_file_to_drive(service, buffer, docs_app_folder_id)
+                    upsert_file_to_drive(service, buffer, docs_app_folder_id)
                     st.toast("✅ ¡Análisis guardado en tu Drive!"); st.rerun()
                 except Exception as e:
                     st.error(f"Ocurrió un error crítico durante el análisis: {e}")
@@ -298,7 +286,7 @@ def phase_1_viability_page(model, go_to_project_selection, go_to_phase2):
             # =====================================================================
             # 1. Descargamos el contenido del archivo ANTES de mostrar el botón.
             #    Gracias a la caché, esto será rápido en cargas sucesivas.
-            file_bytes_for_download = download_file_from_drive_cached(service, analysis_doc_id)
+            file_bytes_for_download = download_file_from_drive_cached(service, analysis_doc_id).getvalue()
 
             # 2. Usamos st.download_button directamente, que proporciona una experiencia de un solo clic.
             st.download_button(
@@ -314,7 +302,7 @@ def phase_1_viability_page(model, go_to_project_selection, go_to_phase2):
             
             col1, col2 = st.columns(2)
             with col1:
-                st.button("🔁 Re-generar Análisis para este Lote", on_click=generate_and_save_analysis, use_container_width=True, disabled=not documentos_pliegos)
+                st.button("🔁 Re-generar Análisis para este Lote", on_click=generate_and_save_analysis, kwargs={"force_regenerate": True}, use_container_width=True, disabled=not documentos_pliegos)
             with col2:
                 st.button("Continuar a Generación de Índice (Fase 2) →", on_click=go_to_phase2, use_container_width=True, type="primary")
         else:
@@ -457,17 +445,10 @@ def phase_2_results_page(model, go_to_phase2, go_to_phase3, handle_full_regenera
                 
                 if st.session_state.get('uploaded_pliegos'):
                     st.write("Analizando documentos de referencia para la regeneración...")
-                    for file_info in st.session_state.uploaded_pliegos:
-                        file_content_bytes = download_file_from_drive_cached(service, file_info['id'])
-                        nombre_archivo = file_info['name']
-                        if nombre_archivo.lower().endswith('.xlsx'):
-                            texto_csv = convertir_excel_a_texto_csv(file_content_bytes, nombre_archivo)
-                            if texto_csv: contenido_ia_regeneracion.append(texto_csv)
-                        else:
-                            contenido_ia_regeneracion.append({ "mime_type": file_info['mimeType'], "data": file_content_bytes.getvalue() })
+                    contenido_ia_regeneracion += pliegos_prompt_parts(service, get_credentials(), project_folder_id)
 
                 generation_config = genai.GenerationConfig(response_mime_type="application/json")
-                response_regeneracion = model.generate_content(contenido_ia_regeneracion, generation_config=generation_config)
+                response_regeneracion = gemini_governor.generate_content(model, contenido_ia_regeneracion, force_regenerate=True, generation_config=generation_config)
                 
                 if not response_regeneracion.candidates: st.error("La IA no generó una respuesta."); return
 
@@ -554,7 +535,7 @@ def phase_2_results_page(model, go_to_phase2, go_to_phase3, handle_full_regenera
     with col1:
         st.button("Regenerar con Feedback", on_click=handle_regeneration_with_feedback, use_container_width=True)
     with col2:
-        st.button("🔁 Regenerar Todo desde Cero", on_click=lambda: handle_full_regeneration(model), use_container_width=True, help="Descarta este análisis y genera uno nuevo leyendo los archivos desde cero.")
+        st.button("🔁 Regenerar Todo desde Cero", on_click=lambda: handle_full_regeneration(model, force_regenerate=True), use_container_width=True, help="Descarta este análisis y genera uno nuevo leyendo los archivos desde cero.")
 
     if st.button("Aceptar y Pasar a Fase 3 →", type="primary", use_container_width=True):
         with st.spinner("Guardando análisis final y preparando carpetas..."):
@@ -565,11 +546,7 @@ def phase_2_results_page(model, go_to_phase2, go_to_phase3, handle_full_regenera
                 mock_file_obj.name = index_filename
                 mock_file_obj.type = "application/json"
                 
-                saved_index_id = find_file_by_name(service, index_filename, index_folder_id)
-                if saved_index_id:
-                    delete_file_from_drive(service, saved_index_id)
-                
-                upload_file_to_drive(service, mock_file_obj, index_folder_id)
+                upsert_file_to_drive(service, mock_file_obj, index_folder_id)
                 st.toast(f"Análisis final guardado como '{index_filename}' en tu Drive.")
                 
                 st.toast("Creando estructura de carpetas para los guiones...")
@@ -586,14 +563,32 @@ def phase_2_results_page(model, go_to_phase2, go_to_phase3, handle_full_regenera
 #           FASE 3: CENTRO DE MANDO DE GUIONES
 # =============================================================================
 
-def ejecutar_generacion_con_gemini(model, credentials, project_folder_id, active_lot_folder_id, titulo, indicaciones_completas, contexto_adicional_lotes="", project_language='Español', company_name='La UTE'): # <-- ¡CAMBIO 1: AÑADIMOS EL PARÁMETRO company_name!
+def construir_prefijo_guiones(credentials, project_folder_id, project_language='Español', company_name='La UTE'):
+    """
+    Parte común de todas las peticiones de guiones de un lote: el prompt de la
+    propuesta estratégica y los pliegos (los .docx, ya analizados). Con la recuperación
+    activa, el texto de los pliegos llega a cada guion en fragmentos y aquí solo van
+    los archivos que no tienen texto (PDF escaneados y formatos sin extracción).
+    """
+    service = get_thread_drive_service(credentials)
+    prompt = PROMPT_GEMINI_PROPUESTA_ESTRATEGICA.format(
+        idioma=project_language, 
+        contexto_lote=get_lot_context(), 
+        nombre_empresa=company_name
+    )
+    # --- Pliegos, ya procesados en su digest ---
+    return [prompt] + pliegos_prompt_parts(service, credentials, project_folder_id, binary_only=PLIEGOS_RETRIEVAL_ENABLED)
+
+def ejecutar_generacion_con_gemini(model, credentials, project_folder_id, active_lot_folder_id, titulo, indicaciones_completas, contexto_adicional_lotes="", project_language='Español', company_name='La UTE', prefijo_compartido=None, indice_pliegos=None): # <-- ¡CAMBIO 1: AÑADIMOS EL PARÁMETRO company_name!
     """
     (VERSIÓN MEJORADA)
     Genera el guion para un subapartado. Ahora analiza correctamente los archivos .docx
     de contexto antes de enviarlos a la IA, evitando el error de MIME type.
+    En los lotes, 'prefijo_compartido' (un SharedPrefix) aporta el prompt y los pliegos
+    ya preparados (y cacheados en Gemini); la llamada solo envía lo propio del subapartado.
+    'indice_pliegos' (un PliegosIndex) aporta los fragmentos de los pliegos relevantes para él.
     """
-    from googleapiclient.discovery import build
-    service = build('drive', 'v3', credentials=credentials)
+    service = get_thread_drive_service(credentials)
 
     nombre_limpio = clean_folder_name(titulo)
     nombre_archivo = nombre_limpio + ".docx"
@@ -601,61 +596,50 @@ def ejecutar_generacion_con_gemini(model, credentials, project_folder_id, active
     try:
         guiones_folder_id = find_or_create_folder(service, "Guiones de Subapartados", parent_id=active_lot_folder_id)
         subapartado_guion_folder_id = find_or_create_folder(service, nombre_limpio, parent_id=guiones_folder_id)
-        pliegos_folder_id = find_or_create_folder(service, "Pliegos", parent_id=project_folder_id)
-        
-        contexto_lote_actual = get_lot_context()
-        
-        # <-- ¡CAMBIO 2: USAMOS company_name AL FORMATEAR EL PROMPT!
-        prompt = PROMPT_GEMINI_PROPUESTA_ESTRATEGICA.format(
-            idioma=project_language, 
-            contexto_lote=contexto_lote_actual, 
-            nombre_empresa=company_name
-        )
+
+        if prefijo_compartido is None:
+            prefijo_compartido = SharedPrefix(model, construir_prefijo_guiones(credentials, project_folder_id, project_language, company_name))
+        if indice_pliegos is None and PLIEGOS_RETRIEVAL_ENABLED:
+            indice_pliegos = get_pliegos_index(service, credentials, project_folder_id)
         
-        contenido_ia = [prompt, "--- INDICACIONES PARA ESTE APARTADO ---\n" + json.dumps(indicaciones_completas, indent=2, ensure_ascii=False)]
+        contenido_ia = ["--- INDICACIONES PARA ESTE APARTADO ---\n" + json.dumps(indicaciones_completas, indent=2, ensure_ascii=False)]
+
+        if indice_pliegos is not None:
+            fragmentos = indice_pliegos.context_for(retrieval_query(titulo, indicaciones_completas))
+            if fragmentos:
+                # Con la recuperación activa es el único texto de los pliegos de la petición:
+                # imprescindible, como lo eran los pliegos completos.
+                contenido_ia.append(fragmentos)
 
         if contexto_adicional_lotes:
             contenido_ia.append(contexto_adicional_lotes)
 
-        # --- Procesamiento de Pliegos con lógica multimodal ---
-        pliegos_en_drive = get_files_in_project(service, pliegos_folder_id)
-        for file_info in pliegos_en_drive:
-            file_bytes_io = download_file_from_drive_uncached(service, file_info['id'])
-            if 'wordprocessingml' in file_info['mimeType']:
-                analisis_multimodal = analizar_docx_multimodal_con_gemini(file_bytes_io, file_info['name'])
-                if analisis_multimodal and "Error" not in analisis_multimodal:
-                    contenido_ia.append(analisis_multimodal)
-            elif file_info['name'].lower().endswith('.xlsx'):
-                texto_csv = convertir_excel_a_texto_csv(file_bytes_io, file_info['name'])
-                if texto_csv: contenido_ia.append(texto_csv)
-            else:
-                contenido_ia.append({"mime_type": file_info['mimeType'], "data": file_bytes_io.getvalue()})
-
         # --- Procesamiento de Documentos de Apoyo con lógica multimodal (¡LA CORRECCIÓN CLAVE!) ---
         docs_de_apoyo = get_files_in_project(service, subapartado_guion_folder_id)
         docs_de_apoyo_filtrados = [f for f in docs_de_apoyo if not f['name'] == nombre_archivo]
         if docs_de_apoyo_filtrados:
-            contenido_ia.append("\n--- DOCUMENTACIÓN DE APOYO ADICIONAL ---\n")
+            # Si la petición no cabe, la documentación de apoyo es lo primero que se sacrifica.
+            contenido_ia.append(optional_part("\n--- DOCUMENTACIÓN DE APOYO ADICIONAL ---\n", priority=2))
             for uploaded_file_info in docs_de_apoyo_filtrados:
                 file_bytes_io_apoyo = download_file_from_drive_uncached(service, uploaded_file_info['id'])
                 
                 if 'wordprocessingml' in uploaded_file_info['mimeType']:
                     # ¡AQUÍ ESTÁ LA MEJORA! Si es un .docx, lo analizamos primero.
                     analisis_multimodal = analizar_docx_multimodal_con_gemini(file_bytes_io_apoyo, uploaded_file_info['name'])
-                    if analisis_multimodal and "Error" not in analisis_multimodal:
-                        contenido_ia.append(analisis_multimodal)
+                    if analisis_multimodal:
+                        contenido_ia.append(optional_part(analisis_multimodal, priority=2))
                 
                 elif uploaded_file_info['name'].lower().endswith('.xlsx'):
                     texto_csv = convertir_excel_a_texto_csv(file_bytes_io_apoyo, uploaded_file_info['name'])
-                    if texto_csv: contenido_ia.append(texto_csv)
+                    if texto_csv: contenido_ia.append(optional_part(texto_csv, priority=2))
                 
                 else:
                     # Para otros tipos de archivo soportados (como PDF), los enviamos directamente.
-                    contenido_ia.append({"mime_type": uploaded_file_info['mimeType'], "data": file_bytes_io_apoyo.getvalue()})
+                    contenido_ia.append(optional_part(gemini_file_part(file_bytes_io_apoyo.getvalue(), uploaded_file_info['mimeType'], uploaded_file_info['name']), priority=2))
         
         # El resto de la función sigue igual
-        chat = model.start_chat()
-        response = enviar_mensaje_con_reintentos(chat, contenido_ia)
+        chat = prefijo_compartido.model.start_chat()
+        response = enviar_mensaje_con_reintentos(chat, prefijo_compartido.request(contenido_ia))
         if not response or not response.candidates:
             # Imprime el feedback de la API si la respuesta fue bloqueada
             if response and hasattr(response, 'prompt_feedback'):
@@ -673,10 +657,7 @@ def ejecutar_generacion_con_gemini(model, credentials, project_folder_id, active
         word_file_obj.name = nombre_archivo
         word_file_obj.type = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
         
-        existing_guion = find_file_by_name(service, nombre_archivo, subapartado_guion_folder_id)
-        if existing_guion: delete_file_from_drive(service, existing_guion)
-        
-        upload_file_to_drive(service, word_file_obj, subapartado_guion_folder_id)
+        upsert_file_to_drive(service, word_file_obj, subapartado_guion_folder_id)
         return True
 
     except Exception as e:
@@ -696,11 +677,9 @@ def ejecutar_fase_4_en_background(model, credentials, project_folder_id, active_
     2. Unifica los resultados en un solo archivo JSON.
     Devuelve True si todo fue exitoso, False si algo falló.
     """
-    from googleapiclient.discovery import build
-    service = build('drive', 'v3', credentials=credentials)
+    service = get_thread_drive_service(credentials)
     
     st.info("Iniciando la generación de todos los planes de prompts en paralelo...")
-    MAX_WORKERS = 4
     completed_count = 0
     all_successful = True
     
@@ -718,7 +697,8 @@ def ejecutar_fase_4_en_background(model, credentials, project_folder_id, active_
         st.warning("No se encontraron guiones generados para crear planes de prompts. Asegúrate de generar los borradores primero.")
         return False
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+    # El gobernador de Gemini decide cuántas llamadas hay en vuelo; el pool solo no debe quedarse corto.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=gemini_governor.pool_size(num_items)) as executor:
         future_to_matiz = {
             executor.submit(
                 ejecutar_generacion_prompts_en_hilo, 
@@ -753,13 +733,16 @@ def ejecutar_fase_4_en_background(model, credentials, project_folder_id, active_
         plan_conjunto_final = {"plan_de_prompts": []}
         carpetas_de_guiones_actualizadas = list_project_folders(service, guiones_main_folder_id)
 
-        for nombre_carpeta, folder_id in carpetas_de_guiones_actualizadas.items():
-            plan_id = find_file_by_name(service, "prompts_individual.json", folder_id)
-            if plan_id:
-                json_bytes = download_file_from_drive_uncached(service, plan_id).getvalue()
-                plan_individual_obj = json.loads(json_bytes.decode('utf-8'))
-                prompts_de_este_plan = plan_individual_obj.get("plan_de_prompts", [])
-                plan_conjunto_final["plan_de_prompts"].extend(prompts_de_este_plan)
+        plan_ids, failed_lookups = batch_find_files_by_name(service, [("prompts_individual.json", folder_id) for folder_id in carpetas_de_guiones_actualizadas.values()])
+        if failed_lookups:
+            # Unificar sin esos planes dejaría apartados fuera del plan conjunto sin avisar.
+            st.error(f"No se pudo comprobar el plan de {len(failed_lookups)} guion(es) en Drive. Vuelve a intentar la unificación.")
+            return False
+        # Todos los planes individuales se descargan a la vez y se unen en orden.
+        for plan_bytes in download_many(credentials, [plan_id for plan_id in plan_ids if plan_id]):
+            plan_individual_obj = json.loads(plan_bytes.getvalue().decode('utf-8'))
+            prompts_de_este_plan = plan_individual_obj.get("plan_de_prompts", [])
+            plan_conjunto_final["plan_de_prompts"].extend(prompts_de_este_plan)
         
         if not plan_conjunto_final["plan_de_prompts"]:
             st.warning("No se encontraron planes para unificar, aunque la generación pareció exitosa.")
@@ -772,10 +755,7 @@ def ejecutar_fase_4_en_background(model, credentials, project_folder_id, active_
         json_bytes_finales = json.dumps(plan_conjunto_final, indent=2, ensure_ascii=False).encode('utf-8')
         mock_file_obj = io.BytesIO(json_bytes_finales); mock_file_obj.name = nombre_archivo_final; mock_file_obj.type = "application/json"
         
-        old_conjunto_id = find_file_by_name(service, nombre_archivo_final, lot_docs_app_folder_id)
-        if old_conjunto_id: delete_file_from_drive(service, old_conjunto_id)
-        
-        upload_file_to_drive(service, mock_file_obj, lot_docs_app_folder_id)
+        upsert_file_to_drive(service, mock_file_obj, lot_docs_app_folder_id)
         st.success(f"¡Plan conjunto para '{st.session_state.selected_lot}' generado! Total: {len(plan_conjunto_final['plan_de_prompts'])} prompts.")
         return True
     except Exception as e:
@@ -867,7 +847,7 @@ def phase_3_page(model, go_to_phase2_results, go_to_phase4):
 
                             if 'wordprocessingml' in mime_type:
                                 analisis_multimodal = analizar_docx_multimodal_con_gemini(file_bytes_io, file_name)
-                                if analisis_multimodal and "Error" not in analisis_multimodal:
+                                if analisis_multimodal:
                                     contenido_para_gemini.append("--- CONTENIDO DEL DOCUMENTO A CLASIFICAR (ANALIZADO) ---")
                                     contenido_para_gemini.append(analisis_multimodal)
                                 else:
@@ -882,8 +862,8 @@ def phase_3_page(model, go_to_phase2_results, go_to_phase4):
                             contenido_para_gemini.append(json_titulos)
 
                             st.write(f"Enviando contenido a la IA para clasificación...")
-                            response = model.generate_content(
-                                contenido_para_gemini,
+                            response = gemini_governor.generate_content(
+                                model, contenido_para_gemini,
                                 generation_config={"response_mime_type": "application/json"}
                             )
                             
@@ -930,8 +910,6 @@ def phase_3_page(model, go_to_phase2_results, go_to_phase4):
                 borrador_bytes = download_file_from_drive_cached(service, file_id_borrador)
                 doc = docx.Document(io.BytesIO(borrador_bytes.getvalue()))
                 borrador_original_texto = "\n".join([p.text for p in doc.paragraphs])
-                pliegos_folder_id = find_or_create_folder(service, "Pliegos", parent_id=project_folder_id)
-                pliegos_en_drive = get_files_in_project(service, pliegos_folder_id)
                 idioma = st.session_state.get('project_language', 'Español')
                 contexto_lote_actual = get_lot_context()
                 
@@ -947,15 +925,9 @@ def phase_3_page(model, go_to_phase2_results, go_to_phase4):
                     "--- FEEDBACK DEL CLIENTE (Tus correcciones y comentarios) ---\n" + feedback
                 ]
                 
-                for file_info in pliegos_en_drive:
-                    file_content_bytes = download_file_from_drive_cached(service, file_info['id'])
-                    if 'wordprocessingml' in file_info['mimeType']:
-                        analisis = analizar_docx_multimodal_con_gemini(file_content_bytes, file_info['name'])
-                        if analisis: contenido_ia.append(analisis)
-                    else:
-                        contenido_ia.append({"mime_type": file_info['mimeType'], "data": file_content_bytes.getvalue()})
+                contenido_ia += pliegos_prompt_parts(service, get_credentials(), project_folder_id)
 
-                response = model.generate_content(contenido_ia)
+                response = gemini_governor.generate_content(model, contenido_ia, force_regenerate=True)
                 if not response.candidates: st.error("La IA no generó una respuesta para la re-generación."); return
                 
                 documento_nuevo = docx.Document()
@@ -970,8 +942,7 @@ def phase_3_page(model, go_to_phase2_results, go_to_phase4):
                 guiones_folder_id = find_or_create_folder(service, "Guiones de Subapartados", parent_id=active_lot_folder_id)
                 subapartado_guion_folder_id = find_or_create_folder(service, nombre_limpio, parent_id=guiones_folder_id)
                 
-                delete_file_from_drive(service, file_id_borrador)
-                upload_file_to_drive(service, word_file_obj, subapartado_guion_folder_id)
+                upsert_file_to_drive(service, word_file_obj, subapartado_guion_folder_id)
                 st.toast(f"¡Guion para '{titulo}' re-generado con éxito!")
                 st.session_state.regenerating_item = None; st.rerun()
             except Exception as e:
@@ -1000,7 +971,7 @@ def phase_3_page(model, go_to_phase2_results, go_to_phase4):
     st.subheader("Gestión de Guiones de Subapartados")
     with st.spinner("Sincronizando guiones y archivos de contexto con Google Drive..."):
         guiones_folder_id = find_or_create_folder(service, "Guiones de Subapartados", parent_id=active_lot_folder_id)
-        carpetas_existentes = {f['name']: f['id'] for f in get_files_in_project(service, guiones_folder_id) if f['mimeType'] == 'application/vnd.google-apps.folder'}
+        carpetas_existentes = list_project_folders(service, guiones_folder_id)
         guiones_generados_data = {}
         for nombre_carpeta, folder_id in carpetas_existentes.items():
             files_in_subfolder = get_files_in_project(service, folder_id)
@@ -1014,6 +985,15 @@ def phase_3_page(model, go_to_phase2_results, go_to_phase4):
         new_state = st.session_state.get('select_all_checkbox', False)
         for key in pending_keys: st.session_state[f"cb_{key}"] = new_state
 
+    # Con lotes, los guiones ya generados de otros lotes pueden servir de contexto.
+    lotes_detectados = st.session_state.get('detected_lotes')
+    otros_lotes = [lote for lote in lotes_detectados if lote not in ("SIN_LOTES", selected_lot)] if isinstance(lotes_detectados, list) else []
+    if otros_lotes:
+        st.multiselect("Usar como contexto los guiones de estos lotes relacionados:", options=otros_lotes, key="context_lots_selector")
+
+    def cargar_contexto_lotes(credentials):
+        return get_context_from_lots(service, project_folder_id, st.session_state.get('context_lots_selector') or [], credentials=credentials)
+
     with st.container(border=True):
         st.subheader("Generación de Borradores en Lote (Paralelo)")
         col_sel_1, col_sel_2 = st.columns([1, 2])
@@ -1025,10 +1005,10 @@ def phase_3_page(model, go_to_phase2_results, go_to_phase4):
             
             if st.button(f"🚀 Generar {num_selected} borradores en paralelo", type="primary", use_container_width=True, disabled=(num_selected == 0)):
                 items_to_generate = [matiz for matiz in subapartados_a_mostrar if matiz.get('subapartado') in selected_keys]
-                MAX_WORKERS = 4
+                MAX_WORKERS = gemini_governor.pool_size(num_selected)
                 progress_bar = st.progress(0, text="Configurando generación en paralelo...")
                 st.info(f"Se generarán {num_selected} guiones usando hasta {MAX_WORKERS} hilos. Esto puede tardar varios minutos.")
-                completed_count = 0; all_successful = True
+                completed_count = 0; all_successful = True; prefijo = None
 
                 credentials = get_credentials()
                 project_language = st.session_state.get('project_language', 'Español')
@@ -1039,13 +1019,25 @@ def phase_3_page(model, go_to_phase2_results, go_to_phase4):
                 if not credentials:
                     st.error("Error de autenticación. No se puede iniciar la generación.")
                 else:
-                    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+                    try:
+                        # El prompt y los pliegos se preparan una vez y se cachean en Gemini mientras dure el lote.
+                        prefijo = construir_prefijo_guiones(credentials, project_folder_id, project_language, company_name)
+                        # El índice de recuperación se construye una vez para todo el lote.
+                        indice_pliegos = get_pliegos_index(service, credentials, project_folder_id) if PLIEGOS_RETRIEVAL_ENABLED else None
+                        contexto_lotes = cargar_contexto_lotes(credentials)
+                    except Exception as e:
+                        st.error(f"No se pudieron preparar el prompt y los pliegos del lote: {e}")
+                        prefijo = None; all_successful = False
+                if prefijo is not None:
+                    with gemini_context_cache.shared_prefix(model, ('guiones', project_folder_id, active_lot_folder_id), prefijo) as prefijo_compartido, \
+                            concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
                         future_to_matiz = {
                             executor.submit(
                                 ejecutar_generacion_con_gemini, 
                                 model, credentials, project_folder_id, active_lot_folder_id,
-                                matiz.get('subapartado'), matiz, "", project_language,
-                                company_name # <-- ¡CAMBIO CLAVE 4/5! Pasamos el nombre a cada hilo
+                                matiz.get('subapartado'), matiz, contexto_lotes, project_language,
+                                company_name, # <-- ¡CAMBIO CLAVE 4/5! Pasamos el nombre a cada hilo
+                                prefijo_compartido, indice_pliegos
                             ): matiz for matiz in items_to_generate
                         }
                         for future in concurrent.futures.as_completed(future_to_matiz):
@@ -1129,7 +1121,8 @@ def phase_3_page(model, go_to_phase2_results, go_to_phase4):
                                 success = ejecutar_generacion_con_gemini(
                                     model=model, credentials=credentials,
                                     project_folder_id=project_folder_id, active_lot_folder_id=active_lot_folder_id,
-                                    titulo=subapartado_titulo, indicaciones_completas=matiz, project_language=project_language,
+                                    titulo=subapartado_titulo, indicaciones_completas=matiz,
+                                    contexto_adicional_lotes=cargar_contexto_lotes(credentials), project_language=project_language,
                                     company_name=company_name 
                                 )
                                 if success: st.rerun()
@@ -1154,12 +1147,12 @@ def phase_3_page(model, go_to_phase2_results, go_to_phase4):
 # =============================================================================
 
 # ----------------- ¡NUEVA FUNCIÓN TRABAJADORA (WORKER)! -----------------
-def ejecutar_generacion_prompts_en_hilo(model, credentials, project_folder_id, active_lot_folder_id, matiz_info, generated_structure_dict, project_language):
+def ejecutar_generacion_prompts_en_hilo(model, credentials, project_folder_id, active_lot_folder_id, matiz_info, generated_structure_dict, project_language, force_regenerate=False):
     """
     Función segura para hilos que genera un plan de prompts para un subapartado.
+    Con force_regenerate=True se ignora la respuesta cacheada de Gemini.
     """
-    from googleapiclient.discovery import build
-    service = build('drive', 'v3', credentials=credentials)
+    service = get_thread_drive_service(credentials)
 
     apartado_titulo = matiz_info.get("apartado", "N/A")
     subapartado_titulo = matiz_info.get("subapartado", "N/A")
@@ -1209,7 +1202,7 @@ def ejecutar_generacion_prompts_en_hilo(model, credentials, project_folder_id, a
         else:
             print(f"ADVERTENCIA (hilo): No se encontró guion para '{subapartado_titulo}'.")
 
-        response = model.generate_content(contenido_ia, generation_config={"response_mime_type": "application/json"})
+        response = gemini_governor.generate_content(model, contenido_ia, force_regenerate=force_regenerate, generation_config={"response_mime_type": "application/json"})
         json_limpio_str = limpiar_respuesta_json(response.text)
         
         if json_limpio_str:
@@ -1217,9 +1210,7 @@ def ejecutar_generacion_prompts_en_hilo(model, credentials, project_folder_id, a
             json_bytes = json.dumps(plan_parcial_obj, indent=2, ensure_ascii=False).encode('utf-8')
             mock_file_obj = io.BytesIO(json_bytes); mock_file_obj.name = "prompts_individual.json"; mock_file_obj.type = "application/json"
             
-            old_plan_id = find_file_by_name(service, "prompts_individual.json", subapartado_folder_id)
-            if old_plan_id: delete_file_from_drive(service, old_plan_id)
-            upload_file_to_drive(service, mock_file_obj, subapartado_folder_id)
+            upsert_file_to_drive(service, mock_file_obj, subapartado_folder_id)
             return True
         return False
     except Exception as e:
@@ -1277,7 +1268,7 @@ def phase_4_page(model, go_to_phase3, go_to_phase5):
             if apartado_titulo: subapartados_a_mostrar.append({"apartado": apartado_titulo, "subapartado": apartado_titulo, "indicaciones": f"Generar prompts para: {apartado_titulo}"})
     if not subapartados_a_mostrar: st.warning("El índice está vacío o tiene un formato incorrecto."); return
 
-    def handle_individual_generation(matiz_info, show_toast=True):
+    def handle_individual_generation(matiz_info, show_toast=True, force_regenerate=False):
         credentials = get_credentials()
         project_language = st.session_state.get('project_language', 'Español')
         if not credentials:
@@ -1286,7 +1277,7 @@ def phase_4_page(model, go_to_phase3, go_to_phase5):
             
         success = ejecutar_generacion_prompts_en_hilo(
             model, credentials, project_folder_id, active_lot_folder_id, 
-            matiz_info, st.session_state.generated_structure, project_language
+            matiz_info, st.session_state.generated_structure, project_language, force_regenerate
         )
         if success:
             if show_toast: st.toast(f"Plan para '{matiz_info.get('subapartado')}' generado.")
@@ -1306,13 +1297,14 @@ def phase_4_page(model, go_to_phase3, go_to_phase5):
                 carpetas_de_guiones = list_project_folders(service, guiones_main_folder_id)
                 
                 plan_conjunto_final = {"plan_de_prompts": []}
-                for nombre_carpeta, folder_id in carpetas_de_guiones.items():
-                    plan_id = find_file_by_name(service, "prompts_individual.json", folder_id)
-                    if plan_id:
-                        json_bytes = download_file_from_drive_cached(service, plan_id).getvalue()
-                        plan_individual_obj = json.loads(json_bytes.decode('utf-8'))
-                        prompts_de_este_plan = plan_individual_obj.get("plan_de_prompts", [])
-                        plan_conjunto_final["plan_de_prompts"].extend(prompts_de_este_plan)
+                plan_ids, failed_lookups = batch_find_files_by_name(service, [("prompts_individual.json", folder_id) for folder_id in carpetas_de_guiones.values()])
+                if failed_lookups:
+                    st.error(f"No se pudo comprobar el plan de {len(failed_lookups)} guion(es) en Drive. Vuelve a intentar la unificación."); return
+                # Todos los planes individuales se descargan a la vez y se unen en orden.
+                for plan_bytes in download_many(get_credentials(), [plan_id for plan_id in plan_ids if plan_id]):
+                    plan_individual_obj = json.loads(plan_bytes.getvalue().decode('utf-8'))
+                    prompts_de_este_plan = plan_individual_obj.get("plan_de_prompts", [])
+                    plan_conjunto_final["plan_de_prompts"].extend(prompts_de_este_plan)
                 
                 if not plan_conjunto_final["plan_de_prompts"]:
                     st.warning("No se encontraron planes individuales para unificar. Genera al menos uno."); return
@@ -1324,10 +1316,7 @@ def phase_4_page(model, go_to_phase3, go_to_phase5):
                 json_bytes_finales = json.dumps(plan_conjunto_final, indent=2, ensure_ascii=False).encode('utf-8')
                 mock_file_obj = io.BytesIO(json_bytes_finales); mock_file_obj.name = nombre_archivo_final; mock_file_obj.type = "application/json"
                 
-                old_conjunto_id = find_file_by_name(service, nombre_archivo_final, lot_docs_app_folder_id)
-                if old_conjunto_id: delete_file_from_drive(service, old_conjunto_id)
-                
-                upload_file_to_drive(service, mock_file_obj, lot_docs_app_folder_id)
+                upsert_file_to_drive(service, mock_file_obj, lot_docs_app_folder_id)
                 st.success(f"¡Plan conjunto para '{st.session_state.selected_lot}' generado! Se unificaron {len(plan_conjunto_final['plan_de_prompts'])} prompts.")
                 st.balloons()
             except Exception as e:
@@ -1336,16 +1325,20 @@ def phase_4_page(model, go_to_phase3, go_to_phase5):
     with st.spinner("Verificando estado de los planes de prompts..."):
         guiones_main_folder_id = find_or_create_folder(service, "Guiones de Subapartados", parent_id=active_lot_folder_id)
         carpetas_de_guiones = list_project_folders(service, guiones_main_folder_id)
-        planes_individuales_existentes = {}
-        for nombre_carpeta, folder_id in carpetas_de_guiones.items():
-            plan_id = find_file_by_name(service, "prompts_individual.json", folder_id)
-            if plan_id: planes_individuales_existentes[nombre_carpeta] = plan_id
+        plan_ids, failed_lookups = batch_find_files_by_name(service, [("prompts_individual.json", folder_id) for folder_id in carpetas_de_guiones.values()])
+        planes_individuales_existentes = {nombre_carpeta: plan_id for nombre_carpeta, plan_id in zip(carpetas_de_guiones, plan_ids) if plan_id}
+        # Una búsqueda fallida no significa "sin plan": esos guiones quedan sin estado
+        # para no ofrecer generar (y sobrescribir) un plan que quizá ya existe.
+        planes_sin_comprobar = {nombre_carpeta for position, nombre_carpeta in enumerate(carpetas_de_guiones) if position in failed_lookups}
+    if planes_sin_comprobar:
+        st.error(f"No se pudo comprobar el plan de {len(planes_sin_comprobar)} guion(es) en Drive. Recarga la página para volver a intentarlo.")
 
     st.subheader("Generación de Planes de Prompts en Lote")
     pending_keys = [
         matiz.get('subapartado') for matiz in subapartados_a_mostrar
         if clean_folder_name(matiz.get('subapartado')) in carpetas_de_guiones
         and clean_folder_name(matiz.get('subapartado')) not in planes_individuales_existentes
+        and clean_folder_name(matiz.get('subapartado')) not in planes_sin_comprobar
     ]
 
     def toggle_all_prompt_checkboxes():
@@ -1363,7 +1356,7 @@ def phase_4_page(model, go_to_phase3, go_to_phase5):
             # ----------------- ¡BLOQUE MODIFICADO PARA USAR WORKERS! -----------------
             if st.button(f"🚀 Generar {num_selected} planes en paralelo", type="primary", use_container_width=True, disabled=(num_selected == 0)):
                 items_to_generate = [matiz for matiz in subapartados_a_mostrar if matiz.get('subapartado') in selected_keys]
-                MAX_WORKERS = 4
+                MAX_WORKERS = gemini_governor.pool_size(num_selected)
                 progress_bar = st.progress(0, text="Configurando generación en paralelo...")
                 st.info(f"Se generarán {num_selected} planes de prompts usando hasta {MAX_WORKERS} hilos.")
                 completed_count = 0
@@ -1421,17 +1414,20 @@ def phase_4_page(model, go_to_phase3, go_to_phase5):
         nombre_limpio = clean_folder_name(subapartado_titulo)
         guion_generado = nombre_limpio in carpetas_de_guiones
         plan_individual_id = planes_individuales_existentes.get(nombre_limpio)
+        plan_sin_comprobar = nombre_limpio in planes_sin_comprobar
         
         with st.container(border=True):
             col1, col2 = st.columns([2, 1])
             with col1:
-                if not plan_individual_id and guion_generado:
+                if not plan_individual_id and guion_generado and not plan_sin_comprobar:
                     st.checkbox(f"**{subapartado_titulo}**", key=f"pcb_{subapartado_titulo}")
                 else:
                     st.write(f"**{subapartado_titulo}**")
                 
                 if not guion_generado:
                     st.warning("⚠️ Guion no generado en Fase 3. No se puede crear un plan.")
+                elif plan_sin_comprobar:
+                    st.warning("⚠️ No se pudo comprobar si este guion ya tiene plan de prompts.")
                 elif plan_individual_id:
                     st.success("✔️ Plan generado")
                     with st.expander("Ver / Descargar Plan Individual"):
@@ -1442,10 +1438,10 @@ def phase_4_page(model, go_to_phase3, go_to_phase5):
                     st.info("⚪ Pendiente de generar plan de prompts")
 
             with col2:
-                if not plan_individual_id:
+                if not plan_individual_id and not plan_sin_comprobar:
                     st.button("Generar Plan de Prompts", key=f"gen_ind_{i}", on_click=handle_individual_generation, args=(matiz, True), use_container_width=True, type="primary", disabled=not guion_generado)
                 else:
-                    st.button("Re-generar Plan", key=f"gen_regen_{i}", on_click=handle_individual_generation, args=(matiz, True), use_container_width=True, type="secondary")
+                    st.button("Re-generar Plan", key=f"gen_regen_{i}", on_click=handle_individual_generation, args=(matiz, True, True), use_container_width=True, type="secondary")
                     st.button("🗑️ Borrar Plan", key=f"del_plan_{i}", on_click=handle_individual_deletion, args=(subapartado_titulo, plan_individual_id), use_container_width=True)
 
     st.markdown("---")
@@ -1495,36 +1491,73 @@ def phase_5_page(model, go_to_phase4, go_to_phase6):
 
     # --- 2. Lógica de Generación del Documento en Paralelo ---
     button_text = "🔁 Volver a Generar Cuerpo del Documento" if st.session_state.get("generated_doc_buffer") else "🚀 Iniciar Redacción y Generar Cuerpo"
+    streaming = st.checkbox(
+        "⚡ Redacción en streaming (progreso en tiempo real y corte de los fragmentos que se exceden de longitud)",
+        value=FRAGMENTOS_STREAMING, key="phase5_streaming"
+    )
+    empaquetar = st.checkbox(
+        "📦 Agrupar los fragmentos pequeños de cada subapartado en una sola petición (menos llamadas y menos cuota)",
+        value=FRAGMENTOS_EMPAQUETADOS, key="phase5_packing"
+    )
     
     if st.button(button_text, type="primary", use_container_width=True):
         if not lista_de_prompts:
             st.warning("El plan de acción está vacío. No hay nada que ejecutar."); return
             
-        MAX_WORKERS = 4
-        progress_bar = st.progress(0, text=f"Configurando redacción con {MAX_WORKERS} workers...")
+        progress_bar = st.progress(0, text="Configurando redacción en paralelo...")
         resultados_ordenados = {tarea.get("prompt_id"): None for tarea in lista_de_prompts}
-        
+        # En streaming llegan también los caracteres recibidos de cada fragmento en curso.
+        caracteres_recibidos = {}
+        limites = {tarea.get("prompt_id"): limite_caracteres_fragmento(tarea) for tarea in lista_de_prompts}
+
         with st.spinner(f"Redactando {len(lista_de_prompts)} fragmentos... Esto puede tardar varios minutos."):
+            # La redacción corre en segundo plano; aquí solo se leen sus eventos y se pinta el progreso.
+            eventos = start_fragment_writing(
+                model, lista_de_prompts, streaming=streaming, packing=empaquetar,
+                # "Volver a generar" pide respuestas nuevas en lugar de servir las cacheadas.
+                force_regenerate=bool(st.session_state.get("generated_doc_buffer"))
+            )
             completed_count = 0
-            with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-                future_to_id = {
-                    executor.submit(generar_fragmento_individual, model, tarea): tarea.get("prompt_id")
-                    for tarea in lista_de_prompts
-                }
-
-                for future in concurrent.futures.as_completed(future_to_id):
-                    prompt_id = future_to_id[future]
+            terminado = False
+            while not terminado:
+                lote = [eventos.get()]
+                while True:
                     try:
-                        resultado = future.result()
-                        resultados_ordenados[prompt_id] = resultado
-                    except Exception as exc:
-                        resultados_ordenados[prompt_id] = {'success': False, 'error': f"Error de hilo: {str(exc)}"}
-                    
-                    completed_count += 1
-                    progress_text = f"Fragmentos redactados: {completed_count}/{len(lista_de_prompts)}"
-                    progress_bar.progress(completed_count / len(lista_de_prompts), text=progress_text)
+                        lote.append(eventos.get_nowait())
+                    except queue.Empty:
+                        break
+                for tipo, prompt_id, dato in lote:
+                    if tipo == 'progreso':
+                        caracteres_recibidos[prompt_id] = dato
+                    elif tipo == 'completado':
+                        resultados_ordenados[prompt_id] = dato
+                        caracteres_recibidos.pop(prompt_id, None)
+                        completed_count += 1
+                    elif tipo == 'fin':
+                        terminado = True
+                        if dato:
+                            st.error(f"La redacción se interrumpió: {dato}")
+
+                # Los fragmentos en curso cuentan por la parte de su longitud que ya ha llegado.
+                en_curso = sum(
+                    min(0.95, caracteres / limites[prompt_id])
+                    for prompt_id, caracteres in caracteres_recibidos.items() if limites.get(prompt_id)
+                )
+                progress_text = f"Fragmentos redactados: {completed_count}/{len(lista_de_prompts)}"
+                progress_bar.progress(min(1.0, (completed_count + en_curso) / len(lista_de_prompts)), text=progress_text)
         
         st.toast("Redacción en paralelo completada. Ensamblando documento...")
+        if streaming:
+            metricas = [r['metricas'] for r in resultados_ordenados.values() if r and r.get('metricas')]
+            ttfts = sorted(m['ttft'] for m in metricas if m['ttft'])
+            velocidades = [m['tokens_por_segundo'] for m in metricas if m['tokens_por_segundo']]
+            cortados = sum(1 for m in metricas if m['cortado'])
+            if ttfts:
+                st.caption(
+                    f"⚡ Streaming: primer token en {ttfts[len(ttfts) // 2]:.1f} s (mediana), "
+                    f"{sum(velocidades) / max(1, len(velocidades)):.0f} tokens/s de media, "
+                    f"{cortados} fragmento(s) cortados por exceder su longitud."
+                )
 
         # --- FASE DE ENSAMBLAJE POST-GENERACIÓN ---
         documento = docx.Document()
@@ -1725,7 +1758,7 @@ def phase_6_page(model, go_to_phase5, back_to_project_selection_and_cleanup):
             st.toast("Paso 4/5: Generando introducción estratégica e índice...")
             with st.spinner("Creando introducción e índice final..."):
                 prompt_intro_formateado = PROMPT_GENERAR_INTRODUCCION.format(idioma=idioma, nombre_empresa=company_name)
-                response_intro = model.generate_content([prompt_intro_formateado, texto_cohesionado_final])
+                response_intro = gemini_governor.generate_content(model, [prompt_intro_formateado, texto_cohesionado_final])
                 introduccion_markdown = limpiar_respuesta_final(response_intro.text)
                 
                 documento_final = docx.Document()
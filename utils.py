@@ -7,15 +7,16 @@ import io
 import json
 import docx
 import imgkit
-from pypdf import PdfReader
+from pypdf import PdfReader, PdfWriter
 import pandas as pd
 import time
-import google.api_core.exceptions
+import hashlib
 from PIL import Image
 import google.generativeai as genai
 
 # Importación desde tus módulos
 from drive_utils import find_or_create_folder, get_or_create_lot_folder_id, clean_folder_name
+from gemini_governor import gemini_governor, is_retryable_gemini_error, CHARS_PER_TOKEN
 
 # =============================================================================
 #           FUNCIONES DE PROCESAMIENTO DE TEXTO Y JSON
@@ -25,6 +26,16 @@ from drive_utils import find_or_create_folder, get_or_create_lot_folder_id, clea
 CARACTERES_POR_PAGINA_MIN = 2100
 CARACTERES_POR_PAGINA_MAX = 2200
 
+# Una página de PDF con imágenes y menos texto que esto se considera escaneada:
+# su contenido solo lo puede leer Gemini a partir del PDF.
+PDF_MIN_CARACTERES_PAGINA_TEXTO = 200
+
+# Redacción en streaming de la fase 5 (opcional; "1" la activa por defecto en la interfaz).
+FRAGMENTOS_STREAMING = os.environ.get("IRVE_STREAM_FRAGMENTS", "0") == "1"
+# En streaming, un fragmento que supera su máximo de caracteres por más de este factor
+# se corta sin esperar a que Gemini termine.
+FRAGMENTO_FACTOR_CORTE = 1.25
+
 CONTEXTO_LOTE_TEMPLATE = """
 
 **INSTRUCCIÓN CRÍTICA DE ANÁLIS:** Tu análisis debe centrarse única y exclusivamente en la información relacionada con el **'{lote_seleccionado}'**. Ignora por completo cualquier dato, requisito o criterio de valoración que pertenezca a otros lotes.
@@ -58,41 +69,87 @@ def get_lot_context():
         return CONTEXTO_LOTE_TEMPLATE.format(lote_seleccionado=lote_seleccionado)
     return ""
     
-def enviar_mensaje_con_reintentos(chat, prompt_a_enviar, reintentos=5, delay=60):
+def enviar_mensaje_con_reintentos(chat, prompt_a_enviar, reintentos=5):
     """
-    Envía un mensaje a un chat de Gemini, con una lógica de reintentos para errores comunes.
+    Envía un mensaje a un chat de Gemini a través del gobernador del proceso, que
+    espera a que haya cuota y reintenta los errores de límite de la API.
     """
-    for i in range(reintentos):
-        try:
-            response = chat.send_message(prompt_a_enviar)
-            return response
-        except google.api_core.exceptions.ResourceExhausted as e:
-            st.warning(f"⚠️ Límite de la API alcanzado. Reintentando en {delay} segundos... ({i+1}/{reintentos})")
-            time.sleep(delay)
-        except Exception as e:
+    try:
+        return gemini_governor.send_message(chat, prompt_a_enviar, retries=reintentos)
+    except Exception as e:
+        if is_retryable_gemini_error(e):
+            st.error("No se pudo obtener una respuesta de la API después de varios intentos.")
+        else:
             st.error(f"Ocurrió un error inesperado al contactar la API: {e}")
-            return None 
-    
-    st.error("No se pudo obtener una respuesta de la API después de varios intentos.")
-    return None
+        return None
     
+def extraer_tablas_excel(archivo_excel_bytes):
+    """
+    Lee los bytes de un archivo Excel (.xlsx) y devuelve sus hojas como una lista de
+    tablas {'title': nombre de la hoja, 'csv': contenido en CSV}.
+    """
+    xls = pd.ExcelFile(archivo_excel_bytes)
+    return [
+        {'title': nombre_hoja, 'csv': pd.read_excel(xls, sheet_name=nombre_hoja).to_csv(index=False)}
+        for nombre_hoja in xls.sheet_names
+    ]
+
 def convertir_excel_a_texto_csv(archivo_excel_bytes, nombre_archivo):
     """
     Lee los bytes de un archivo Excel (.xlsx) y los convierte a texto CSV.
     """
     try:
-        xls = pd.ExcelFile(archivo_excel_bytes)
         texto_final_csv = ""
-        for nombre_hoja in xls.sheet_names:
-            df = pd.read_excel(xls, sheet_name=nombre_hoja)
-            texto_final_csv += f"--- Contenido de la Hoja: '{nombre_hoja}' del archivo '{nombre_archivo}' ---\n"
-            texto_final_csv += df.to_csv(index=False)
+        for tabla in extraer_tablas_excel(archivo_excel_bytes):
+            texto_final_csv += f"--- Contenido de la Hoja: '{tabla['title']}' del archivo '{nombre_archivo}' ---\n"
+            texto_final_csv += tabla['csv']
             texto_final_csv += "\n\n"
         return texto_final_csv
     except Exception as e:
         st.error(f"No se pudo procesar el archivo Excel '{nombre_archivo}': {e}")
         return ""
         
+def extraer_texto_pdf(archivo_pdf_bytes, nombre_archivo):
+    """
+    Extrae en local el texto de un PDF, etiquetado por página ("[Página N]").
+    Devuelve (texto, páginas_escaneadas, número_de_páginas), donde páginas_escaneadas
+    son los números (desde 1) de las páginas que son imagen y necesitan el PDF original.
+    Si el PDF no se puede leer devuelve ("", None, 0): hay que enviar el PDF completo.
+    """
+    try:
+        reader = PdfReader(archivo_pdf_bytes)
+        if reader.is_encrypted:
+            reader.decrypt("")
+        texto_paginas, paginas_escaneadas = [], []
+        for numero, page in enumerate(reader.pages, start=1):
+            texto = (page.extract_text() or "").strip()
+            if len(texto) < PDF_MIN_CARACTERES_PAGINA_TEXTO:
+                try:
+                    tiene_imagenes = len(page.images) > 0
+                except Exception:
+                    tiene_imagenes = True
+                if tiene_imagenes:
+                    paginas_escaneadas.append(numero)
+            if texto:
+                texto_paginas.append(f"[Página {numero}]\n{texto}")
+        texto_final = f"--- Texto del archivo '{nombre_archivo}' ---\n" + "\n\n".join(texto_paginas) if texto_paginas else ""
+        return texto_final, paginas_escaneadas, len(reader.pages)
+    except Exception as e:
+        print(f"AVISO: No se pudo extraer el texto de '{nombre_archivo}'; se enviará el PDF completo. {e}")
+        return "", None, 0
+
+def extraer_paginas_pdf(archivo_pdf_bytes, paginas):
+    """Devuelve los bytes de un PDF nuevo con solo las páginas indicadas (números desde 1)."""
+    reader = PdfReader(archivo_pdf_bytes)
+    if reader.is_encrypted:
+        reader.decrypt("")
+    writer = PdfWriter()
+    for numero in paginas:
+        writer.add_page(reader.pages[numero - 1])
+    salida = io.BytesIO()
+    writer.write(salida)
+    return salida.getvalue()
+
 def limpiar_respuesta_json(texto_sucio):
     """
     Extrae un objeto JSON de una cadena de texto potencialmente sucia.
@@ -330,7 +387,11 @@ def html_a_imagen(html_string, output_filename="temp_image.png"):
         return None
 
 def _analizar_docx_core(file_bytes_io, nombre_archivo):
-    """(FUNCIÓN INTERNA) Analiza un .docx extrayendo texto e imágenes."""
+    """
+    (FUNCIÓN INTERNA) Analiza un .docx extrayendo texto e imágenes.
+    Devuelve "" si el documento no tiene ni texto ni imágenes y lanza una excepción si
+    el análisis falla, para que un análisis válido nunca se confunda con un error.
+    """
     try:
         doc = docx.Document(file_bytes_io)
         prompt_parts = [
@@ -357,73 +418,211 @@ def _analizar_docx_core(file_bytes_io, nombre_archivo):
         safety_settings = [{"category": c, "threshold": "BLOCK_NONE"} for c in ["HARM_CATEGORY_HARASSMENT", "HARM_CATEGORY_HATE_SPEECH", "HARM_CATEGORY_SEXUALLY_EXPLICIT", "HARM_CATEGORY_DANGEROUS_CONTENT"]]
         
         model = st.session_state.gemini_model
-        response = model.generate_content(prompt_parts, safety_settings=safety_settings)
+        response = gemini_governor.generate_content(model, prompt_parts, safety_settings=safety_settings)
 
         if not response.candidates:
             reason = response.prompt_feedback.block_reason.name if hasattr(response, 'prompt_feedback') else "No especificado"
-            return f"Error: La API bloqueó la respuesta. Razón: {reason}"
+            raise ValueError(f"La API bloqueó la respuesta. Razón: {reason}")
 
         return f"--- ANÁLISIS MULTIMODAL DE '{nombre_archivo}' ---\n{response.text}"
 
     except Exception as e:
-        return f"Error al procesar el archivo DOCX: {str(e)}"
+        raise ValueError(f"Error al procesar el archivo DOCX: {str(e)}") from e
 
 @st.cache_data(show_spinner=False)
-def get_cached_multimodal_analysis(_file_content_bytes, nombre_archivo):
-    """(FUNCIÓN CACHEABLE) Envuelve la lógica de análisis principal."""
+def get_cached_multimodal_analysis(_file_content_bytes, nombre_archivo, content_hash):
+    """
+    (FUNCIÓN CACHEABLE) Envuelve la lógica de análisis principal. Los bytes no forman
+    parte de la clave, así que la clave es el nombre más la huella del contenido: un
+    documento sustituido con el mismo nombre se vuelve a analizar. Los errores no se cachean.
+    """
     print(f"CACHE MISS: Ejecutando análisis por primera vez para '{nombre_archivo}'.")
     return _analizar_docx_core(io.BytesIO(_file_content_bytes), nombre_archivo)
 
 def analizar_docx_multimodal_con_gemini(file_bytes_io, nombre_archivo):
-    """(FUNCIÓN PRINCIPAL) Llama a la función cacheable para obtener el análisis."""
+    """
+    (FUNCIÓN PRINCIPAL) Llama a la función cacheable para obtener el análisis.
+    Devuelve None si el análisis falla ("" es un documento sin contenido que analizar).
+    """
     with st.spinner(f"Analizando '{nombre_archivo}' (texto e imágenes)..."):
-        analysis_result = get_cached_multimodal_analysis(file_bytes_io.getvalue(), nombre_archivo)
-        if "Error" in analysis_result:
-            st.error(f"No se pudo analizar '{nombre_archivo}'.")
+        file_content_bytes = file_bytes_io.getvalue()
+        try:
+            analysis_result = get_cached_multimodal_analysis(
+                file_content_bytes, nombre_archivo, hashlib.sha256(file_content_bytes).hexdigest()
+            )
+        except Exception as e:
+            st.error(f"No se pudo analizar '{nombre_archivo}': {e}")
             return None
         st.success(f"Análisis de '{nombre_archivo}' completado.")
         return analysis_result
 
-def generar_fragmento_individual(model, prompt_info, reintentos=5, delay_inicial=60):
+def _numero_de_caracteres(valor):
+    """
+    Cifra que ha escrito el modelo ("1500", "1.500", "aprox. 1500", "1000-1500"...).
+    Se toma la última cifra (el máximo de un rango) sin separadores de miles. None si no hay.
+    """
+    if isinstance(valor, bool):
+        return None
+    if isinstance(valor, (int, float)):
+        return int(valor) or None
+    cifras = re.findall(r'\d[\d.,]*', str(valor))
+    if not cifras:
+        return None
+    return int(re.sub(r'\D', '', cifras[-1]) or 0) or None
+
+def limite_caracteres_fragmento(prompt_info):
+    """
+    Máximo de caracteres de un fragmento del plan de prompts: 'max_caracteres_sugeridos'
+    si lo trae, o el "entre X y Y caracteres" de su prompt. None si no tiene límite.
+    El plan lo genera el modelo: un valor que no se entiende equivale a no tener límite.
+    """
+    limite = _numero_de_caracteres(prompt_info.get("max_caracteres_sugeridos"))
+    if limite:
+        return limite
+    match = re.search(r'entre\s+([\d.,]+)\s+y\s+([\d.,]+)\s+caracteres', prompt_info.get("prompt_para_asistente") or "")
+    if match:
+        return _numero_de_caracteres(match.group(2))
+    return None
+
+def _recortar_fragmento(texto, limite):
+    """Recorta un fragmento cortado en streaming al último párrafo (o frase) completo dentro del límite."""
+    recorte = texto[:limite]
+    for separador in ("\n\n", ". "):
+        corte = recorte.rfind(separador)
+        if corte > limite // 2:
+            return recorte[:corte + 1].rstrip()
+    return recorte.rstrip()
+
+class MedicionStreaming:
+    """
+    Lleva la cuenta de un fragmento que llega en streaming: su texto, el tiempo hasta
+    el primer trozo, los tokens por segundo y si hay que cortarlo por pasarse del límite.
+    La usan tanto la redacción con hilos como la asíncrona.
+    """
+
+    def __init__(self, prompt_id, limite, on_progress=None):
+        self.prompt_id = prompt_id
+        self.limite = limite
+        self.corte = int(limite * FRAGMENTO_FACTOR_CORTE) if limite else None
+        self.on_progress = on_progress
+        self.iniciada = False  # Sigue en False si la respuesta sale de la caché.
+        self.cortado = False
+
+    def reiniciar(self, inicio):
+        """Empieza la medición de un intento ('inicio' es cuándo salió la petición)."""
+        self.iniciada = True
+        self.inicio = inicio
+        self.partes, self.caracteres = [], 0
+        self.ttft = self.primer_trozo = None
+        self.fin = None
+        self.cortado = False
+
+    def anotar(self, chunk):
+        """Añade un trozo de la respuesta. Devuelve True si hay que dejar de recibir."""
+        try:
+            texto = chunk.text
+        except ValueError:
+            return False  # Trozo sin texto (p. ej. solo metadatos de seguridad).
+        ahora = time.monotonic()
+        if self.ttft is None:
+            self.ttft, self.primer_trozo = ahora - self.inicio, ahora
+        self.partes.append(texto)
+        self.caracteres += len(texto)
+        if self.on_progress:
+            self.on_progress(self.prompt_id, self.caracteres)
+        self.cortado = bool(self.corte and self.caracteres > self.corte)
+        return self.cortado
+
+    def terminar(self, response):
+        """Cierra el intento. Una respuesta cortada no se devuelve: así no se cachea como si estuviera completa."""
+        self.fin = time.monotonic()
+        return None if self.cortado else response
+
+    def resultado(self, response):
+        """Texto final del fragmento y sus métricas."""
+        if not self.iniciada:
+            texto = response.text if response.candidates else ""
+            return texto, {'ttft': 0.0, 'tokens_por_segundo': None, 'caracteres': len(texto), 'cortado': False}
+        texto = "".join(self.partes)
+        tokens = None
+        if not self.cortado:
+            usage = getattr(response, 'usage_metadata', None)
+            tokens = getattr(usage, 'candidates_token_count', None) if usage else None
+        tokens = tokens or len(texto) / CHARS_PER_TOKEN
+        duracion = self.fin - self.primer_trozo if self.primer_trozo else 0
+        metricas = {
+            'ttft': self.ttft,
+            'tokens_por_segundo': tokens / duracion if duracion > 0 else None,
+            'caracteres': len(texto),
+            'cortado': self.cortado,
+        }
+        if self.cortado:
+            print(f"HILO {self.prompt_id}: Fragmento cortado en streaming al superar {self.corte} caracteres (máximo {self.limite}).")
+            texto = _recortar_fragmento(texto, self.limite)
+        return texto, metricas
+
+def _error_fragmento(prompt_id, error, reintentos):
+    """Resultado de un fragmento cuya llamada a Gemini ha fallado."""
+    if is_retryable_gemini_error(error):
+        return {'success': False, 'error': f"Límite de API excedido tras {reintentos} intentos.", 'prompt_id': prompt_id}
+    print(f"HILO {prompt_id}: Error inesperado. {str(error)}")
+    return {'success': False, 'error': str(error), 'prompt_id': prompt_id}
+
+def _resultado_fragmento(prompt_id, response, medicion=None):
+    """Resultado de un fragmento a partir de la respuesta de Gemini (y su medición, si fue en streaming)."""
+    if medicion is not None and medicion.cortado:
+        # Un fragmento cortado en streaming no tiene respuesta final que comprobar.
+        texto, metricas = medicion.resultado(response)
+        return {'success': True, 'content': texto, 'prompt_id': prompt_id, 'metricas': metricas}
+
+    if not response.candidates:
+        reason = "Bloqueado por filtros de seguridad"
+        if hasattr(response, 'prompt_feedback') and response.prompt_feedback.block_reason:
+            reason = response.prompt_feedback.block_reason.name
+        # Este no es un error de API, no reintentamos
+        return {'success': False, 'error': f"Respuesta bloqueada ({reason})", 'prompt_id': prompt_id}
+
+    # Éxito, devolvemos el resultado
+    if medicion is not None:
+        texto, metricas = medicion.resultado(response)
+        return {'success': True, 'content': texto, 'prompt_id': prompt_id, 'metricas': metricas}
+    return {'success': True, 'content': response.text, 'prompt_id': prompt_id}
+
+def generar_fragmento_individual(model, prompt_info, reintentos=5, streaming=False, on_progress=None, force_regenerate=False):
     """
-    (VERSIÓN MEJORADA CON REINTENTOS)
     Función segura para hilos que genera un único fragmento de texto.
-    Implementa una estrategia de reintentos con exponential backoff para errores de API.
+    La cuota, la concurrencia y los reintentos los gestiona el gobernador de Gemini.
+    Con streaming=True el texto se recibe a trozos: on_progress(prompt_id, caracteres)
+    se llama con cada uno, el resultado incluye 'metricas' y el fragmento se corta si
+    se pasa claramente de su máximo de caracteres. Con force_regenerate=True se ignora
+    la respuesta cacheada.
     """
-    subapartado = prompt_info.get("subapartado_referencia", "Desconocido")
     prompt_a_enviar = prompt_info.get("prompt_para_asistente")
     prompt_id = prompt_info.get("prompt_id")
 
     if not prompt_a_enviar:
         return {'success': False, 'error': 'El prompt estaba vacío.', 'prompt_id': prompt_id}
 
-    for i in range(reintentos):
-        try:
-            # Cada llamada es independiente
-            response = model.generate_content(prompt_a_enviar)
-            
-            if not response.candidates:
-                reason = "Bloqueado por filtros de seguridad"
-                if hasattr(response, 'prompt_feedback') and response.prompt_feedback.block_reason:
-                    reason = response.prompt_feedback.block_reason.name
-                # Este no es un error de API, no reintentamos
-                return {'success': False, 'error': f"Respuesta bloqueada ({reason})", 'prompt_id': prompt_id}
-            
-            # Éxito, devolvemos el resultado
-            return {'success': True, 'content': response.text, 'prompt_id': prompt_id}
+    medicion = MedicionStreaming(prompt_id, limite_caracteres_fragmento(prompt_info), on_progress) if streaming else None
 
-        except google.api_core.exceptions.ResourceExhausted as e:
-            delay = delay_inicial * (2 ** i)  # Exponential backoff
-            print(f"HILO {prompt_id}: Límite de API alcanzado. Reintentando en {delay} segundos... (Intento {i+1}/{reintentos})")
-            time.sleep(delay)
+    def consumir(response, inicio):
+        # Si el gobernador reintenta, la medición empieza de nuevo.
+        medicion.reiniciar(inicio)
+        for chunk in response:
+            if medicion.anotar(chunk):
+                break
+        return medicion.terminar(response)
 
-        except Exception as e:
-            # Para otros errores, fallamos directamente sin reintentar
-            print(f"HILO {prompt_id}: Error inesperado. {str(e)}")
-            return {'success': False, 'error': str(e), 'prompt_id': prompt_id}
-    
-    # Si todos los reintentos fallan
-    return {'success': False, 'error': f"Límite de API excedido tras {reintentos} intentos.", 'prompt_id': prompt_id}
+    try:
+        # Cada llamada es independiente
+        if streaming:
+            response = gemini_governor.generate_content_stream(model, prompt_a_enviar, consumir, retries=reintentos, force_regenerate=force_regenerate)
+        else:
+            response = gemini_governor.generate_content(model, prompt_a_enviar, retries=reintentos, force_regenerate=force_regenerate)
+    except Exception as e:
+        return _error_fragmento(prompt_id, e, reintentos)
+
+    return _resultado_fragmento(prompt_id, response, medicion)
 
 
 # -----------------------------------------------------------------------------
@@ -600,8 +799,8 @@ def ejecutar_pase_cohesion_fragmento(model, prompt_template, idioma, datos_maest
             texto_actual=texto_del_fragmento
         )
 
-        response = model.generate_content(
-            prompt_completo,
+        response = gemini_governor.generate_content(
+            model, prompt_completo,
             generation_config={"response_mime_type": "application/json"}
         )
 